@@ -1,11 +1,378 @@
+import os, shutil, uuid
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from .hll import HyperLogLog
+from .spill import resolve_format
+from .storage import ColumnarDbFile
+from .utils import key_array
 
-def aggregate_final(joined_parquet_path: str) -> pd.DataFrame:
+AGG_COLUMNS = ["song_id", "title", "age", "user_id"]
+WEIGHT_COLUMN = "listen_count"  # present when Listens was pre-aggregated below the Users join
+
+class _Dictionary:
+    """Global key -> dense code mapping that grows across batches."""
+    def __init__(self):
+        self.keys = None
+
+    def encode(self, index: pd.Index) -> np.ndarray:
+        codes, uniq = index.factorize()
+        if self.keys is None:
+            self.keys = uniq[:0]
+        g = self.keys.get_indexer(uniq)
+        new = g < 0
+        if new.any():
+            g[new] = len(self.keys) + np.arange(new.sum())
+            self.keys = self.keys.append(uniq[new])
+        return g[codes]
+
+    def encode_column(self, col) -> np.ndarray:
+        # Arrow dictionary-encodes the batch in C++ (dictionary columns already are); only the batch's
+        # distinct values hit the global map
+        arr = col.combine_chunks() if isinstance(col, pa.ChunkedArray) else col
+        if not pa.types.is_dictionary(arr.type) or arr.null_count:
+            arr = pc.dictionary_encode(arr.dictionary_decode() if pa.types.is_dictionary(arr.type) else arr,
+                                       null_encoding="encode")
+        g = self.encode(pd.Index(arr.dictionary.to_numpy(zero_copy_only=False)))
+        return g[arr.indices.to_numpy(zero_copy_only=False)]
+
+def _dedupe_pairs(g: np.ndarray, u: np.ndarray):
+    # Packed (group << 32 | user) int64 keys, sorted + adjacent-diff when users fit 32 bits, else a hash dedupe
+    if len(u) and u.min() >= 0 and u.max() < 2**32 and g.max() < 2**31:
+        packed = np.sort((g << 32) | u)
+        packed = packed[np.concatenate(([True], packed[1:] != packed[:-1]))]
+        return packed >> 32, packed & 0xFFFFFFFF
+    df = pd.DataFrame({"g": g, "u": u}).drop_duplicates()
+    return df["g"].to_numpy(), df["u"].to_numpy()
+
+
+class StreamingAggregator:
+    """
+    Streaming hash aggregation for the project query, fed one Arrow batch at a time.
+    Per (song_id, title) group it keeps a running sum/count of age for AVG and the exact set of
+    (group, user_id) pairs for COUNT DISTINCT. When the pair buffer outgrows memory_budget_mb it is
+    deduplicated, and if still too large spilled to disk hash-partitioned by group; each spill
+    partition is deduplicated and counted on its own at the end.
+    Spill partitions are written in spill_format ("parquet", "arrow", "arrow-lz4").
+    With approx_distinct=True the pairs are replaced by a fixed-size HyperLogLog sketch per group
+    (see HyperLogLog for the error bound) and nothing is ever spilled.
+    With title_rows=(songs ColumnarDbFile, row id column) batches carry a Songs row id instead of
+    the title (late materialization); finish() fetches titles for the distinct row ids and merges
+    (song_id, row id) groups into (song_id, title) groups.
+    """
+    def __init__(self, memory_budget_mb: float | None = None, temp_dir: str = "temp", spill_partitions: int = 16,
+                 approx_distinct: bool = False, hll_precision: int = 10, title_rows=None, spill_format="parquet"):
+        self.memory_budget_mb = memory_budget_mb
+        self.temp_dir = temp_dir
+        self.spill_partitions = spill_partitions
+        self.spill_format = resolve_format(spill_format)
+        self._songs, self._titles = _Dictionary(), _Dictionary()
+        self._groups, self._users = _Dictionary(), _Dictionary()
+        self._sum, self._cnt = np.zeros(0), np.zeros(0, dtype=np.int64)
+        self._pairs, self._pair_bytes = [], 0
+        self._spill_dir, self._spill_writers = None, None
+        self._hll = HyperLogLog(hll_precision) if approx_distinct else None
+        self.title_rows = title_rows
+        self._title_col = title_rows[1] if title_rows else "title"
+        self.stats = {"rows": 0, "spilled_pairs": 0}
+
+    def _encode_groups(self, songs, titles) -> np.ndarray:
+        # Group code: per-column codes packed into one int64, then mapped to a dense group id
+        s, t = songs.astype(np.int64), titles.astype(np.int64)
+        g = self._groups.encode(pd.Index((s << 32) | t))
+        n = len(self._groups.keys)
+        if n > len(self._sum):
+            self._sum = np.concatenate([self._sum, np.zeros(n - len(self._sum))])
+            self._cnt = np.concatenate([self._cnt, np.zeros(n - len(self._cnt), dtype=np.int64)])
+        return g
+
+    def consume(self, tbl: pa.Table):
+        cols = ["song_id", self._title_col, "age", "user_id"]
+        tbl = tbl.select(cols + ([WEIGHT_COLUMN] if WEIGHT_COLUMN in tbl.column_names else []))
+        tbl = tbl.filter(pc.and_(pc.is_valid(tbl.column("song_id")), pc.is_valid(tbl.column(self._title_col))))
+        if tbl.num_rows == 0:
+            return
+        self.stats["rows"] += tbl.num_rows
+        g = self._encode_groups(self._songs.encode_column(tbl.column("song_id")),
+                                self._titles.encode_column(tbl.column(self._title_col)))
+        n = len(self._sum)
+
+        age = tbl.column("age")
+        has_age = pc.is_valid(age).to_numpy(zero_copy_only=False)
+        ages = age.filter(pc.is_valid(age)).to_numpy().astype(np.float64)
+        if WEIGHT_COLUMN in tbl.column_names:
+            # Each row stands for listen_count listens: weighted AVG (integer ages keep the sums exact)
+            w = tbl.column(WEIGHT_COLUMN).to_numpy()[has_age]
+            self._sum += np.bincount(g[has_age], weights=ages * w, minlength=n)
+            self._cnt += np.bincount(g[has_age], weights=w, minlength=n).astype(np.int64)
+        else:
+            self._sum += np.bincount(g[has_age], weights=ages, minlength=n)
+            self._cnt += np.bincount(g[has_age], minlength=n)
+
+        user = tbl.column("user_id")
+        has_user = pc.is_valid(user).to_numpy(zero_copy_only=False)
+        users = user.filter(pc.is_valid(user))
+        if self._hll is not None:
+            self._hll.add(g[has_user], users)
+            return
+        u = users.to_numpy(zero_copy_only=False)
+        if u.dtype.kind not in "iu":
+            u = self._users.encode_column(users)
+        self._add_pairs(g[has_user].astype(np.int64), u.astype(np.int64))
+
+    def merge(self, other: "StreamingAggregator"):
+        """Fold in the partial aggregate of another aggregator (e.g. one per parallel partition); consumes other."""
+        if other._groups.keys is None:
+            return
+        packed = other._groups.keys.to_numpy()
+        g = self._encode_groups(self._songs.encode(other._songs.keys[packed >> 32]),
+                                self._titles.encode(other._titles.keys[packed & 0xFFFFFFFF]))
+        self._sum[g] += other._sum
+        self._cnt[g] += other._cnt
+        self.stats["rows"] += other.stats["rows"]
+        if self._hll is not None:
+            if other._hll is None:
+                raise ValueError("cannot merge an exact aggregate into an approximate one")
+            self._hll.merge(other._hll, g)
+            return
+        if other._hll is not None:
+            raise ValueError("cannot merge an approximate aggregate into an exact one")
+        for og, ou in other._pair_chunks():
+            if other._users.keys is not None:
+                ou = self._users.encode(other._users.keys[ou])
+            self._add_pairs(g[og], np.asarray(ou, dtype=np.int64))
+
+    def _add_pairs(self, g: np.ndarray, u: np.ndarray):
+        self._pairs.append((g, u))
+        self._pair_bytes += 16 * len(u)
+        if self.memory_budget_mb is not None and self._pair_bytes > self.memory_budget_mb * 1024 * 1024:
+            self._compact()
+            if self._pair_bytes > self.memory_budget_mb * 1024 * 1024 / 2:
+                self._spill()
+
+    def _compact(self):
+        if self._pairs:
+            g, u = _dedupe_pairs(np.concatenate([p[0] for p in self._pairs]), np.concatenate([p[1] for p in self._pairs]))
+            self._pairs, self._pair_bytes = [(g, u)], 16 * len(g)
+
+    def _spill(self):
+        if self._spill_dir is None:
+            self._spill_dir = os.path.join(self.temp_dir, f"agg_{uuid.uuid4().hex}")
+            os.makedirs(self._spill_dir, exist_ok=True)
+            self._spill_writers = [None] * self.spill_partitions
+        # Partition by song so groups that late materialization merges (same song_id) share a partition
+        songs = self._groups.keys.to_numpy() >> 32
+        for g, u in self._pairs:
+            part = songs[g] % self.spill_partitions
+            for b in np.unique(part):
+                rows = part == b
+                tbl = pa.table({"g": g[rows], "u": u[rows]})
+                if self._spill_writers[b] is None:
+                    path = os.path.join(self._spill_dir, f"part{b}{self.spill_format.suffix}")
+                    self._spill_writers[b] = self.spill_format.writer(path, tbl.schema)
+                self._spill_writers[b].write_table(tbl)
+            self.stats["spilled_pairs"] += len(g)
+        self._pairs, self._pair_bytes = [], 0
+
+    def _pair_chunks(self):
+        # In-memory pairs, or once anything spilled, one chunk per spill partition (which is then removed)
+        if self._spill_dir is None:
+            self._compact()
+            yield from self._pairs
+            return
+        self._spill()
+        for w in self._spill_writers:
+            if w: w.close()
+        for b in range(self.spill_partitions):
+            path = os.path.join(self._spill_dir, f"part{b}{self.spill_format.suffix}")
+            if os.path.exists(path):
+                part = self.spill_format.read(path)
+                yield part.column("g").to_numpy(), part.column("u").to_numpy()
+        shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._spill_dir, self._spill_writers = None, None
+
+    def _materialize_titles(self, titles=None) -> np.ndarray:
+        # Vectorized take of the distinct Songs rows' titles (unless already fetched), then regroup by (song_id, title)
+        cdf, _ = self.title_rows
+        if titles is None:
+            titles = cdf.take(self._titles.keys.to_numpy(), ["title"]).column("title")
+        else:
+            ids, values = titles
+            titles = values.take(np.searchsorted(ids, self._titles.keys.to_numpy()))
+        self._titles = _Dictionary()
+        tcode = self._titles.encode_column(titles).astype(np.int64)
+        packed = self._groups.keys.to_numpy()
+        self._groups = _Dictionary()
+        remap = self._groups.encode(pd.Index(((packed >> 32) << 32) | tcode[packed & 0xFFFFFFFF]))
+        n = len(self._groups.keys)
+        self._sum = np.bincount(remap, weights=self._sum, minlength=n)
+        self._cnt = np.bincount(remap, weights=self._cnt, minlength=n).astype(np.int64)
+        if self._hll is not None:
+            hll, self._hll = self._hll, HyperLogLog(self._hll.p, n, self._hll.seed)
+            hll.grow(len(remap))
+            self._hll.merge(hll, remap)
+        return remap
+
+    def _distinct_counts(self, n: int, remap: np.ndarray | None = None) -> np.ndarray:
+        if self._hll is not None:
+            self._hll.grow(n)
+            return np.rint(self._hll.estimate()).astype(np.int64)
+        counts = np.zeros(n, dtype=np.int64)
+        for g, u in self._pair_chunks():
+            g, _ = _dedupe_pairs(g if remap is None else remap[g], u)
+            counts += np.bincount(g, minlength=n)
+        return counts
+
+    def row_groups(self, into: "StreamingAggregator") -> pd.DataFrame:
+        """
+        title_rows only: the (song_id, row id, sum, cnt, distinct) aggregate of each group, titles not yet
+        fetched; consumes the aggregator. Groups of a song seen with several row ids may share a title, so
+        their users must be counted together: those are merged into `into` instead.
+        """
+        if self._groups.keys is None:
+            return pd.DataFrame({"song_id": [], "row": [], "sum": [], "cnt": [], "distinct": []})
+        packed = self._groups.keys.to_numpy()
+        song, n = packed >> 32, len(packed)
+        shared = np.bincount(song)[song] > 1
+        target = np.full(n, -1, dtype=np.int64)
+        target[shared] = into._encode_groups(into._songs.encode(self._songs.keys[song[shared]]),
+                                             into._titles.encode(self._titles.keys[packed[shared] & 0xFFFFFFFF]))
+        into._sum[target[shared]] += self._sum[shared]
+        into._cnt[target[shared]] += self._cnt[shared]
+        if self._hll is not None:
+            self._hll.grow(n)
+            counts = np.rint(self._hll.estimate()).astype(np.int64)
+            part = HyperLogLog(self._hll.p, 0, self._hll.seed)
+            part.registers = self._hll.registers[shared]
+            into._hll.merge(part, target[shared])
+        else:
+            counts = np.zeros(n, dtype=np.int64)
+            for g, u in self._pair_chunks():
+                g, u = _dedupe_pairs(g, u)
+                counts += np.bincount(g, minlength=n)
+                keep = shared[g]
+                u = u[keep] if self._users.keys is None else into._users.encode(self._users.keys[u[keep]])
+                into._add_pairs(target[g[keep]], np.asarray(u, dtype=np.int64))
+        own = ~shared
+        return pd.DataFrame({"song_id": self._songs.keys[song[own]], "row": self._titles.keys[packed[own] & 0xFFFFFFFF],
+                             "sum": self._sum[own], "cnt": self._cnt[own], "distinct": counts[own]})
+
+    def finish(self, titles=None) -> pd.DataFrame:
+        """The query result. With title_rows, titles=(sorted row ids, their titles) skips fetching them."""
+        if self._groups.keys is None:
+            return pd.DataFrame({"song_id": pd.Series(dtype="float64"), "avg_age": pd.Series(dtype="float64"),
+                                 "count_distinct_users": pd.Series(dtype="int64")})
+        remap = None
+        if self.title_rows is not None:
+            if self._spill_dir is not None:
+                self._spill()  # spill partitions are keyed by the pre-remap groups
+            remap = self._materialize_titles(titles)
+        n = len(self._groups.keys)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg = np.where(self._cnt > 0, self._sum / self._cnt, np.nan)
+        packed = self._groups.keys.to_numpy()
+        songs = self._songs.keys[packed >> 32]
+        if songs.dtype.kind == "i":
+            songs = songs.astype(np.int64)  # keys narrowed at scan time (narrowing.py) come back as int64
+        res = pd.DataFrame({"song_id": songs,
+                            "title": self._titles.keys[packed & 0xFFFFFFFF]})
+        res["avg_age"] = avg
+        res["count_distinct_users"] = self._distinct_counts(n, remap)
+        res = res[res["title"].notna()]
+        res = res.sort_values(["count_distinct_users", "song_id"], ascending=[False, True], kind="mergesort")
+        return res[["song_id", "avg_age", "count_distinct_users"]].reset_index(drop=True)
+
+
+class SortedAggregator:
+    """
+    Streaming sort-based aggregation for input clustered on `key`, a GROUP BY column (e.g. SMJ
+    output ordered by song_id): a group is complete once the key moves past it. Each batch's
+    finished key runs are aggregated and emitted; only the run still open at the batch end is
+    carried over, so memory stays at one key run no matter how many groups there are.
+    Runs go through StreamingAggregator, so AVG / COUNT DISTINCT / late titles behave the same.
+    With title_rows, runs emit (song_id, row id) groups and titles are fetched once, in finish().
+    """
+    def __init__(self, key: str = "song_id", **kw):
+        self.key = key
+        self.kw = kw
+        self._open = StreamingAggregator(**kw)
+        # Groups of songs with several Songs rows, which only regroup once titles are known
+        self._shared = StreamingAggregator(**kw) if kw.get("title_rows") else None
+        self._parts = []
+        self.stats = {"rows": 0, "flushes": 0}
+
+    def _flush(self):
+        res = self._open.finish() if self._shared is None else self._open.row_groups(self._shared)
+        self.stats["rows"] += self._open.stats["rows"]
+        self.stats["flushes"] += 1
+        if len(res):
+            self._parts.append(res)
+        self._open = StreamingAggregator(**self.kw)
+
+    def consume(self, tbl: pa.Table):
+        if tbl.num_rows == 0:
+            return
+        keys = key_array(tbl.column(self.key))
+        change = np.flatnonzero(keys[1:] != keys[:-1])
+        if len(change):
+            # Rows before the last key change close every run seen so far, including the one carried in
+            split = int(change[-1]) + 1
+            self._open.consume(tbl.slice(0, split))
+            self._flush()
+            tbl = tbl.slice(split)
+        self._open.consume(tbl)
+
+    def _resolve_titles(self) -> list:
+        # One take of every row id the runs handed back, then (song_id, title) results
+        cdf, _ = self.kw["title_rows"]
+        rows = pd.concat(self._parts, ignore_index=True) if self._parts else None
+        ids = [] if rows is None else [rows["row"].to_numpy()]
+        if self._shared._titles.keys is not None:
+            ids.append(self._shared._titles.keys.to_numpy())
+        if not ids:
+            return []
+        ids = np.unique(np.concatenate(ids).astype(np.int64))
+        titles = cdf.take(ids, ["title"]).column("title").combine_chunks()
+        parts = [self._shared.finish((ids, titles))] if self._shared._groups.keys is not None else []
+        if rows is not None:
+            has_title = titles.is_valid().to_numpy(zero_copy_only=False)
+            rows = rows[has_title[np.searchsorted(ids, rows["row"].to_numpy())]]
+            songs = rows["song_id"].to_numpy()
+            with np.errstate(invalid="ignore", divide="ignore"):
+                avg = np.where(rows["cnt"] > 0, rows["sum"] / rows["cnt"], np.nan)
+            parts.append(pd.DataFrame({"song_id": songs.astype(np.int64) if songs.dtype.kind == "i" else songs,
+                                       "avg_age": avg, "count_distinct_users": rows["distinct"].to_numpy(np.int64)}))
+        return parts
+
+    def finish(self) -> pd.DataFrame:
+        self._flush()
+        parts = self._parts if self._shared is None else self._resolve_titles()
+        if not parts:
+            return self._open.finish()
+        res = pd.concat(parts, ignore_index=True)
+        return res.sort_values(["count_distinct_users", "song_id"], ascending=[False, True],
+                               kind="mergesort").reset_index(drop=True)
+
+
+def aggregate_batches(batches, memory_budget_mb: float | None = None, temp_dir: str = "temp",
+                      approx_distinct: bool = False, hll_precision: int = 10, title_rows=None,
+                      sorted_by: str | None = None, spill_format="parquet") -> pd.DataFrame:
+    """
+    Pipeline sink: stream joined Arrow tables through a StreamingAggregator, or a SortedAggregator
+    when the input is known to be clustered on the GROUP BY column sorted_by.
+    """
+    kw = dict(memory_budget_mb=memory_budget_mb, temp_dir=temp_dir, approx_distinct=approx_distinct,
+              hll_precision=hll_precision, title_rows=title_rows, spill_format=spill_format)
+    agg = SortedAggregator(sorted_by, **kw) if sorted_by else StreamingAggregator(**kw)
+    for tbl in batches:
+        agg.consume(tbl)
+    return agg.finish()
+
+def aggregate_final(joined_parquet_path: str, memory_budget_mb: float | None = None, temp_dir: str = "temp") -> pd.DataFrame:
     # Expect columns: song_id, title, age, user_id (after both joins)
-    df = pd.read_parquet(joined_parquet_path, columns=["song_id", "title", "age", "user_id"])
-    res = (df.groupby(["song_id", "title"])
-             .agg(avg_age=("age", "mean"),
-                  count_distinct_users=("user_id", pd.Series.nunique))
-             .reset_index())
-    res = res.sort_values(["count_distinct_users", "song_id"], ascending=[False, True])
-    return res[["song_id", "avg_age", "count_distinct_users"]]
+    joined = ColumnarDbFile.from_path(joined_parquet_path)
+    batches = (pa.Table.from_batches([b]) for b in joined.iter_batches(AGG_COLUMNS, 100_000))
+    order = joined.sort_order or [None]
+    sorted_by = order[0] if order[0] in ("song_id", "title") else None  # e.g. SMJ output on song_id
+    return aggregate_batches(batches, memory_budget_mb, temp_dir, sorted_by=sorted_by)
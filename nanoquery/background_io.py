@@ -0,0 +1,165 @@
+import queue, threading, time
+
+_END = object()
+
+class IOStats:
+    """
+    Seconds an operator spent blocked on I/O queues (thread-safe; partitions run on a pool).
+    read/write_stall_s are summed across worker threads, so they can exceed the operator's wall
+    time; max_read/max_write_stall_s are the largest single thread's total, which cannot.
+    """
+    def __init__(self, depth: int = 0):
+        self.depth = depth
+        self.read_stall_s = 0.0
+        self.write_stall_s = 0.0
+        self._per_thread = {}  # (field, thread id) -> seconds
+        self._lock = threading.Lock()
+
+    def add(self, field: str, seconds: float):
+        key = (field, threading.get_ident())
+        with self._lock:
+            setattr(self, field, getattr(self, field) + seconds)
+            self._per_thread[key] = self._per_thread.get(key, 0.0) + seconds
+
+    def _max(self, field: str) -> float:
+        return max((s for (f, _), s in self._per_thread.items() if f == field), default=0.0)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"depth": self.depth, "read_stall_s": self.read_stall_s, "write_stall_s": self.write_stall_s,
+                    "max_read_stall_s": self._max("read_stall_s"), "max_write_stall_s": self._max("write_stall_s")}
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocking put that gives up once the consumer has gone away
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def read_ahead(items, depth: int = 2, stats: IOStats | None = None):
+    """
+    Iterate `items` (e.g. a file's record batches) on a background thread that stays up to `depth`
+    items ahead, so decoding overlaps with the caller's work. Time the caller waits for the next item
+    goes to stats.read_stall_s. depth <= 0 reads inline (the wait is then the whole read).
+    """
+    if depth <= 0:
+        it = iter(items)
+        while True:
+            t0 = time.perf_counter()
+            item = next(it, _END)
+            if stats is not None:
+                stats.add("read_stall_s", time.perf_counter() - t0)
+            if item is _END:
+                return
+            yield item
+    q, stop = queue.Queue(depth), threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(q, (item, None), stop):
+                    return
+            _put(q, (_END, None), stop)
+        except BaseException as e:
+            _put(q, (_END, e), stop)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            t0 = time.perf_counter()
+            item, err = q.get()
+            if stats is not None:
+                stats.add("read_stall_s", time.perf_counter() - t0)
+            if err is not None:
+                raise err
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class WriteBehind:
+    """
+    One background thread that runs queued writes (write_table / close on any number of writers)
+    in submission order, at most `depth` pending, so encoding and compression overlap with the
+    caller. Time the caller waits for queue space goes to stats.write_stall_s. flush() waits for
+    everything queued and re-raises the first failed write; close() also stops the thread.
+    depth <= 0 writes inline.
+    """
+    def __init__(self, depth: int = 4, stats: IOStats | None = None):
+        self.depth = depth
+        self.stats = stats
+        self._q, self._thread, self._error = None, None, None
+
+    def _run(self):
+        while True:
+            task = self._q.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    task[0](*task[1:])
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._q.task_done()
+
+    def submit(self, fn, *args):
+        t0 = time.perf_counter()
+        if self.depth <= 0:
+            fn(*args)
+        else:
+            if self._thread is None:
+                self._q = queue.Queue(self.depth)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._q.put((fn, *args))
+        if self.stats is not None:
+            self.stats.add("write_stall_s", time.perf_counter() - t0)
+
+    def wrap(self, writer) -> "_QueuedWriter":
+        return _QueuedWriter(writer, self)
+
+    def flush(self):
+        if self._thread is not None:
+            self._q.join()
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._q.put(None)
+                self._thread.join()
+                self._q, self._thread = None, None
+
+
+class _QueuedWriter:
+    """write_table / close of a file writer, run by a WriteBehind thread."""
+    def __init__(self, writer, queue: WriteBehind):
+        self.writer = writer
+        self.queue = queue
+
+    def write_table(self, tbl):
+        self.queue.submit(self.writer.write_table, tbl)
+
+    def close(self):
+        self.queue.submit(self.writer.close)
+
+
+def operator_io(depth: int) -> tuple:
+    """
+    (IOStats, WriteBehind) for one run of a spilling join operator with io_depth=depth: its reads
+    go through read_ahead up to depth batches ahead, its file writes queue up to depth tables on
+    the WriteBehind thread; depth 0 does both inline.
+    """
+    stats = IOStats(depth)
+    return stats, WriteBehind(depth, stats)
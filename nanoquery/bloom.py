@@ -0,0 +1,110 @@
+import math
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from .hashing import hash64
+from .utils import key_array
+
+class BloomFilter:
+    """
+    Runtime join filter over build-side keys: m-bit array, k probes by double hashing one 64-bit hash.
+    No false negatives; false positives at about `fp_rate` for `n_items` keys.
+    """
+    kind = "bloom"
+
+    def __init__(self, n_items: int, fp_rate: float = 0.01):
+        n = max(int(n_items), 1)
+        self.m = max(64, math.ceil(-n * math.log(fp_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / n * math.log(2)))
+        self.words = np.zeros((self.m + 63) // 64, dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    def _positions(self, keys) -> np.ndarray:
+        h = hash64(keys)
+        h1, h2 = h & np.uint64(0xFFFFFFFF), (h >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.k, dtype=np.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.m)
+
+    def add(self, keys):
+        pos = self._positions(keys).ravel()
+        np.bitwise_or.at(self.words, pos >> np.uint64(6), np.uint64(1) << (pos & np.uint64(63)))
+
+    def contains(self, keys) -> np.ndarray:
+        pos = self._positions(keys)
+        return (((self.words[pos >> np.uint64(6)] >> (pos & np.uint64(63))) & np.uint64(1)) == 1).all(axis=1)
+
+
+class BitmapFilter:
+    """Exact join filter for dense integer keys: one bit per value in [lo, hi]."""
+    kind = "bitmap"
+
+    def __init__(self, lo: int, hi: int):
+        self.lo, self.hi = int(lo), int(hi)
+        self.bits = np.zeros(self.hi - self.lo + 1, dtype=bool)
+
+    @property
+    def nbytes(self) -> int:
+        return (len(self.bits) + 7) // 8
+
+    def add(self, keys):
+        self.bits[key_array(keys).astype(np.int64) - self.lo] = True
+
+    def contains(self, keys) -> np.ndarray:
+        k = key_array(keys)
+        if k.dtype.kind not in "iub":
+            return np.ones(len(k), dtype=bool)  # not comparable as ints: let the join decide
+        inside = (k >= self.lo) & (k <= self.hi)
+        out = np.zeros(len(k), dtype=bool)
+        out[inside] = self.bits[k[inside].astype(np.int64) - self.lo]
+        return out
+
+
+def build_join_filter(keys, fp_rate: float = 0.01, max_bits_per_key: int = 16):
+    """Exact bitmap when integer keys are dense enough (<= max_bits_per_key bits per key), else a Bloom filter."""
+    keys = key_array(keys)
+    if keys.dtype.kind in "iub" and len(keys):
+        lo, hi = int(keys.min()), int(keys.max())  # Python ints: narrowed int8/int16 keys would overflow
+        if hi - lo + 1 <= max_bits_per_key * len(keys):
+            f = BitmapFilter(lo, hi)
+            f.add(keys)
+            return f
+    f = BloomFilter(len(keys), fp_rate)
+    if len(keys):
+        f.add(keys)
+    return f
+
+
+class RuntimeJoinFilter:
+    """
+    Inner-join runtime filter: collects build-side keys while the build input is scanned, then drops
+    probe rows that cannot match (and null keys) before they are partitioned, sorted, or spilled.
+    The filter itself is built lazily on the first probe batch.
+    """
+    def __init__(self, fp_rate: float = 0.01):
+        self.fp_rate = fp_rate
+        self.filter = None
+        self.rows_in = self.rows_out = 0
+        self._keys = []
+
+    def collect(self, tbl: pa.Table, key: str):
+        self._keys.append(key_array(pc.drop_null(tbl.column(key))))
+
+    def apply(self, tbl: pa.Table, key: str) -> pa.Table:
+        if self.filter is None:
+            self.filter = build_join_filter(np.concatenate(self._keys) if self._keys else np.empty(0, np.int64),
+                                            self.fp_rate)
+            self._keys = []
+        self.rows_in += tbl.num_rows
+        tbl = tbl.filter(pc.is_valid(tbl.column(key)))
+        tbl = tbl.filter(pa.array(self.filter.contains(tbl.column(key)), type=pa.bool_()))
+        self.rows_out += tbl.num_rows
+        return tbl
+
+    def stats(self) -> dict:
+        return {"kind": self.filter.kind if self.filter else None,
+                "bytes": self.filter.nbytes if self.filter else 0,
+                "probe_rows_in": self.rows_in, "probe_rows_out": self.rows_out,
+                "selectivity": self.rows_out / self.rows_in if self.rows_in else 1.0}
@@ -0,0 +1,114 @@
+import os, json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from .hll import HyperLogLog
+from .storage import fragment_paths, table_fingerprint
+from .utils import file_size_mb, parquet_column_stats
+
+CATALOG_FILE = "nanoquery_stats.json"
+
+def _equi_depth(sample: np.ndarray, buckets: int) -> list:
+    # Bucket boundaries (buckets + 1 values); each bucket holds about the same number of rows
+    if len(sample) == 0:
+        return []
+    return np.quantile(sample, np.linspace(0, 1, buckets + 1), method="inverted_cdf").tolist()
+
+def analyze_table(path: str, batch_rows: int = 100_000, hll_precision: int = 14, histogram_buckets: int = 32,
+                  sample_rows: int = 100_000) -> dict:
+    """
+    One full scan of a Parquet table (file plus appended fragments): per column row/null counts,
+    HyperLogLog NDV estimate, min/max, average in-memory value width and (numeric columns) an
+    equi-depth histogram over a strided sample.
+    """
+    files = fragment_paths(path)
+    pfs = [pq.ParquetFile(p) for p in files]
+    rows = sum(pf.metadata.num_rows for pf in pfs)
+    stride = max(1, rows // sample_rows)
+    footer = parquet_column_stats(files)
+    cols = {}
+    for name in pfs[0].schema_arrow.names:
+        cols[name] = {"nulls": 0, "bytes_in_memory": 0, "min": None, "max": None, "sample": [],
+                      "hll": HyperLogLog(hll_precision, 1)}
+    offset = 0
+    for batch in (b for pf in pfs for b in pf.iter_batches(batch_size=batch_rows)):
+        for name in batch.schema.names:
+            arr, c = batch.column(name), cols[name]
+            c["nulls"] += arr.null_count
+            c["bytes_in_memory"] += arr.nbytes
+            valid = arr.drop_null()
+            if len(valid) == 0:
+                continue
+            c["hll"].add(np.zeros(len(valid), dtype=np.int64), valid)
+            mm = pc.min_max(valid)
+            lo, hi = mm["min"].as_py(), mm["max"].as_py()
+            c["min"] = lo if c["min"] is None else min(c["min"], lo)
+            c["max"] = hi if c["max"] is None else max(c["max"], hi)
+            if pa.types.is_integer(arr.type) or pa.types.is_floating(arr.type):
+                first = (-offset) % stride
+                c["sample"].append(arr.slice(first).to_numpy(zero_copy_only=False)[::stride])
+        offset += batch.num_rows
+    out = {}
+    for name, c in cols.items():
+        sample = np.concatenate(c["sample"]) if c["sample"] else np.zeros(0)
+        sample = sample[~np.isnan(sample)] if sample.dtype.kind == "f" else sample
+        non_null = rows - c["nulls"]
+        out[name] = {"type": footer.get(name, {}).get("type"), "bytes": footer.get(name, {}).get("bytes", 0),
+                     "nulls": c["nulls"], "min": c["min"], "max": c["max"], "distinct": None,
+                     "ndv": int(min(round(c["hll"].estimate()[0]), non_null)) if non_null else 0,
+                     "avg_width": c["bytes_in_memory"] / rows if rows else 0.0,
+                     "histogram": _equi_depth(sample, histogram_buckets) if len(sample) else None}
+    return {"fingerprint": table_fingerprint(path), "rows": rows,
+            "row_groups": sum(pf.metadata.num_row_groups for pf in pfs),
+            "disk_mb": sum(file_size_mb(p) for p in files), "columns": out}
+
+
+class StatsCatalog:
+    """
+    Persistent table statistics for the Parquet files of one directory, in a JSON file next to them.
+    Entries are keyed by file name and only served while the table's fingerprint (file size/mtime,
+    manifest version) matches.
+    """
+    def __init__(self, data_dir: str):
+        self.path = os.path.join(data_dir, CATALOG_FILE)
+        self.tables = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.tables = json.load(f)
+
+    @classmethod
+    def for_file(cls, path: str) -> "StatsCatalog":
+        return cls(os.path.dirname(os.path.abspath(path)))
+
+    def get(self, path: str) -> dict | None:
+        entry = self.tables.get(os.path.basename(path))
+        if entry is None or entry["fingerprint"] != table_fingerprint(path):
+            return None
+        return entry
+
+    def analyze(self, path: str, **kw) -> dict:
+        """ANALYZE: rescan the file, replace its entry and save the catalog."""
+        entry = analyze_table(path, **kw)
+        self.tables[os.path.basename(path)] = entry
+        self.save()
+        return entry
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.tables, f, indent=1, default=str)
+        os.replace(tmp, self.path)
+
+
+def table_metadata(path: str, use_catalog: bool = True) -> dict | None:
+    """Planner metadata from the catalog when a fresh entry exists (no Parquet footer read), else None."""
+    if not use_catalog:
+        return None
+    entry = StatsCatalog.for_file(path).get(path)
+    if entry is None:
+        return None
+    cols = entry["columns"]
+    return {"rows": entry["rows"], "columns": list(cols), "row_groups": entry["row_groups"],
+            "disk_mb": entry["disk_mb"], "uncompressed_mb": sum(c["bytes"] for c in cols.values()) / (1024*1024),
+            "column_stats": cols, "stats_source": "catalog"}
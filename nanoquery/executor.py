@@ -1,60 +1,129 @@
-import os
-import pandas as pd
+import itertools, os
 from .storage import ColumnarDbFile
 from .parser import parse_sql_hardcoded
-from .planner import QueryPlanner
+from .planner import QueryPlanner, aggregation_strategy
 from .hash_join import HashPartitionJoin
 from .sort_merge_join import SortMergeJoin
-from .aggregation import aggregate_final
+from .aggregation import aggregate_batches
+from .hll import HyperLogLog
+from .pipeline import Scan, PreAggregate, HashJoin, MaterializedJoin, AdaptiveJoin
+
+SONGS_ROW_ID = "songs_row_id"
 
 class QueryExecutor:
-    def __init__(self, parquet_paths: dict, working_dir: str = "temp", planner: QueryPlanner | None = None):
+    def __init__(self, parquet_paths: dict, working_dir: str = "temp", planner: QueryPlanner | None = None,
+                 num_workers: int | None = None, approx_distinct: bool = False, hll_precision: int = 10,
+                 late_materialize: bool = False, adaptive: bool = True, spill_format: str = "arrow",
+                 io_depth: int = 2):
         """
         parquet_paths: {"Songs": ".../songs.parquet", "Listens": "...", "Users": "..."}
+        num_workers: join worker threads (default: all cores)
+        approx_distinct: HyperLogLog COUNT DISTINCT (also enabled by APPROX_COUNT_DISTINCT in the query)
+        late_materialize: carry a Songs row id through the joins instead of s.title, fetched after aggregation
+        adaptive: re-plan each later step from the observed output of the step before it
+        spill_format: format of join partitions, sort runs and intermediate outputs ("arrow", "arrow-lz4",
+            "parquet"); these are read back once, so the default skips Parquet encoding and memory-maps them
+        io_depth: batches read ahead / tables queued for writing on background threads per scan or join (0: inline)
         """
         self.paths = parquet_paths
         self.working_dir = working_dir
         os.makedirs(self.working_dir, exist_ok=True)
         self.planner = planner or QueryPlanner()
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.approx_distinct = approx_distinct
+        self.hll_precision = hll_precision
+        self.late_materialize = late_materialize
+        self.adaptive = adaptive
+        self.spill_format = spill_format
+        self.io_depth = io_depth
+
+    def _join_op(self, plan: dict, step: dict):
+        if step["algo"] == "HPJ":
+            # At least one partition per worker; resident partitions are joined during partitioning (hybrid),
+            # oversized spilled ones are repartitioned at run time, keys with >= 1% of probe rows are broadcast
+            return HashPartitionJoin(max(step.get("partitions", 8), self.num_workers), num_workers=self.num_workers,
+                                     memory_budget_mb=plan.get("memory_budget_mb"), hybrid=True,
+                                     skew_threshold=0.01 if step.get("skew", True) else None, join_filter=True,
+                                     bucketed=bool(step.get("bucketed")), spill_format=self.spill_format,
+                                     io_depth=self.io_depth)
+        return SortMergeJoin(num_workers=self.num_workers, join_filter=True, spill_format=self.spill_format,
+                             io_depth=self.io_depth)
+
+    def _join_node(self, plan: dict, step: dict, left, right):
+        # A hash join whose build side fits in one partition runs pipelined in memory;
+        # anything that has to spill runs as a materializing HPJ/SMJ.
+        # Co-bucketed inputs always take the bucket-wise HPJ.
+        if step["algo"] == "HPJ" and step.get("partitions", 1) <= 1 and not step.get("bucketed"):
+            return HashJoin(left, right, step["left_key"], step["right_key"], build=step.get("build", "right"),
+                            num_workers=self.num_workers)
+        return MaterializedJoin(self._join_op(plan, step), left, right, step["left_key"], step["right_key"],
+                                temp_dir=self.working_dir, spill_format=self.spill_format)
 
-    def _load_cols_to_temp(self, table_name: str, cols: list[str]) -> ColumnarDbFile:
-        cdf_src = ColumnarDbFile(table_name, file_dir=os.path.dirname(self.paths[table_name]))
-        df = pd.read_parquet(self.paths[table_name], columns=cols)
-        cdf_dst = ColumnarDbFile(f"{table_name}_loaded", file_dir=self.working_dir)
-        cdf_dst.build_table(df)
-        return cdf_dst
+    def _adaptive_node(self, plan: dict, i: int, left, right):
+        # Step i is planned again once step i-1's output has been observed (buffered up to a
+        # budget share in memory, else spilled); the planner records what it changed.
+        step = plan["steps"][i]
+        def decide(observed, source):
+            return self._join_node(plan, self.planner.replan(plan, i, observed), source, right)
+        return AdaptiveJoin(left, step["left_key"], decide, temp_dir=self.working_dir,
+                            buffer_mb=plan["memory_budget_mb"] / self.planner.overhead, spill_format=self.spill_format)
 
     def execute(self, sql: str):
         parsed = parse_sql_hardcoded(sql)
         plan = self.planner.plan(self.paths, parsed)
 
-        # Column pruning loads
-        songs = self._load_cols_to_temp("Songs", plan["columns"]["Songs"])
-        listens = self._load_cols_to_temp("Listens", plan["columns"]["Listens"])
-        users = self._load_cols_to_temp("Users", plan["columns"]["Users"])
-
-        # Step 1: Songs ⨝ Listens on song_id
-        if plan["steps"][0]["algo"] == "HPJ":
-            step1_out = HashPartitionJoin(8).join(songs, listens, "song_id", "song_id",
-                                                  temp_dir=self.working_dir,
-                                                  cols_left=plan["columns"]["Songs"],
-                                                  cols_right=plan["columns"]["Listens"])
-        else:
-            step1_out = SortMergeJoin().join(songs, listens, "song_id", "song_id",
-                                             temp_dir=self.working_dir,
-                                             cols_left=plan["columns"]["Songs"],
-                                             cols_right=plan["columns"]["Listens"])
-
-        # Step 2: (step1) ⨝ Users on user_id
-        if plan["steps"][1]["algo"] == "HPJ":
-            step2_out = HashPartitionJoin(8).join(step1_out, users, "user_id", "user_id",
-                                                  temp_dir=self.working_dir,
-                                                  cols_left=None, cols_right=plan["columns"]["Users"])
-        else:
-            step2_out = SortMergeJoin().join(step1_out, users, "user_id", "user_id",
-                                             temp_dir=self.working_dir,
-                                             cols_left=None, cols_right=plan["columns"]["Users"])
-
-        # Final aggregation
-        result = aggregate_final(step2_out.path)
+        # Column-pruned scans straight over the source files (no staging copy), read at the planned narrower
+        # types; joins and spills that take a scan's file read it the same way
+        files = {t: ColumnarDbFile.from_path(self.paths[t]).narrowed(plan.get("narrowing", {}).get(t, {}))
+                 for t in ("Songs", "Listens", "Users")}
+        scans = {t: Scan(files[t], plan["columns"][t], io_depth=self.io_depth) for t in files}
+        late = plan.get("late_materialize", {})
+        title_rows = None
+        if self.late_materialize and late.get("columns") == {"Songs": ["title"]}:
+            # Joins and spills carry an int64 Songs row id; titles are taken from Songs.parquet after aggregation
+            songs = files["Songs"]
+            title_rows = (songs, SONGS_ROW_ID)
+            scans["Songs"] = Scan(songs, [c for c in plan["columns"]["Songs"] if c != "title"], row_id=SONGS_ROW_ID,
+                                  io_depth=self.io_depth)
+            late["applied"] = True
+        pre = plan.get("preaggregate", {})
+        if pre.get("applied"):
+            # Listens -> (song_id, user_id, listen_count) before it meets Songs and Users
+            scans[pre["table"]] = PreAggregate(scans[pre["table"]], pre["keys"], pre["count_col"])
+
+        # Operator pipeline: scan -> join -> join -> aggregate, streaming Arrow batches between operators.
+        # Steps follow the planner's join order, e.g. (Songs ⨝ Listens) ⨝ Users; "__prev__" is the previous step
+        node, joins = None, []
+        for i, step in enumerate(plan["steps"]):
+            if step["left"] == "__prev__" and self.adaptive and hasattr(self.planner, "replan"):
+                node = self._adaptive_node(plan, i, node, scans[step["right"]])
+            else:
+                left = node if step["left"] == "__prev__" else scans[step["left"]]
+                node = self._join_node(plan, step, left, scans[step["right"]])
+            joins.append(node)
+
+        # Final streaming aggregation pulls the whole pipeline. Its first batch settles the input's
+        # actual ordering (forced/re-planned operators may differ from the plan): sorted on a GROUP BY
+        # column -> sort-based aggregation, else hash aggregation
+        approx = self.approx_distinct or parsed["aggregations"]["count_distinct_users"]["func"] == "APPROX_COUNT_DISTINCT"
+        batches = node.batches()
+        first = next(batches, None)
+        agg = aggregation_strategy(parsed, node.ordering)
+        agg["planned_strategy"] = plan.get("aggregation", {}).get("strategy")
+        agg["count_distinct"] = "exact"
+        if approx:
+            agg.update(count_distinct="hll", precision=self.hll_precision,
+                       relative_error=HyperLogLog(self.hll_precision).relative_error)
+        plan["aggregation"] = agg
+        result = aggregate_batches(itertools.chain([first] if first is not None else [], batches),
+                                   memory_budget_mb=plan.get("memory_budget_mb"), temp_dir=self.working_dir,
+                                   approx_distinct=approx, hll_precision=self.hll_precision, title_rows=title_rows,
+                                   sorted_by=agg.get("key"), spill_format=self.spill_format)
+
+        # Runtime operator stats (join filter selectivity, resident partitions, I/O stalls, ...) go into the plan output
+        for step, op in zip(plan["steps"], joins):
+            step["runtime"] = dict(op.stats)
+        plan["scans"] = {t: dict(scan.stats) for t, scan in scans.items() if isinstance(scan, Scan)}
+        if pre.get("applied"):
+            pre["runtime"] = dict(scans[pre["table"]].stats)
         return result, plan
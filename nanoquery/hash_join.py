@@ -1,100 +1,351 @@
-import os, uuid
+import os, uuid, math
+import numpy as np
 import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
-from .storage import ColumnarDbFile
-from .utils import hash_value
+from .storage import ColumnarDbFile, co_bucketed
+from .background_io import operator_io, read_ahead
+from .bloom import RuntimeJoinFilter
+from .hash_table import ColumnarHashTable
+from .spill import resolve_format
+from .hashing import hash_partitions
+from .utils import join_output, key_array, parallel_map
 
 class HashPartitionJoin:
     """
     Hash-partition both sides; per-partition build+probe; emit partition results.
-    Uses pandas.merge *inside a single partition only* after real partitioning.
+    Each partition is joined with a columnar hash table and vectorized take(), not per-key merges.
     """
-    def __init__(self, num_partitions: int = 8, batch_rows: int = 100_000):
+    def __init__(self, num_partitions: int = 8, batch_rows: int = 100_000, num_workers: int = 1,
+                 memory_budget_mb: float | None = None, build_overhead: float = 2.0, max_depth: int = 3,
+                 hybrid: bool = False, skew_threshold: float | None = None, skew_sample_rows: int = 100_000,
+                 join_filter: bool = False, bucketed: bool = False, spill_format="parquet", io_depth: int = 0):
         self.B = num_partitions
         self.batch_rows = batch_rows
+        self.num_workers = num_workers  # partitions joined concurrently on a thread pool
+        # Grace recursion: a partition whose build side (decoded size * overhead) exceeds its share of
+        # the budget is repartitioned with a fresh hash seed, up to max_depth levels.
+        self.memory_budget_mb = memory_budget_mb
+        self.build_overhead = build_overhead
+        self.max_depth = max_depth
+        # Hybrid hash join: keep as many build partitions resident as the budget allows (needs a budget)
+        self.hybrid = hybrid
+        # Runtime Bloom/bitmap filter on build-side keys, applied to the probe scan
+        self.join_filter = join_filter
+        # Skew: probe-side keys holding >= skew_threshold of a row sample bypass hash partitioning
+        self.skew_threshold = skew_threshold
+        self.skew_sample_rows = skew_sample_rows
+        # Co-bucketed inputs (same key, bucket count and hash) are joined bucket by bucket, no partition phase
+        self.bucketed = bucketed
+        # File format of partitions, hot slices and the join output ("parquet", "arrow", "arrow-lz4")
+        self.spill_format = resolve_format(spill_format)
+        self.io_depth = io_depth  # background reads / writes, see background_io.operator_io
+        self._io, self._writes = operator_io(io_depth)
+        self.stats = {}
 
-    def _partition_to_disk(self, cdf: ColumnarDbFile, key: str, out_dir: str, tag: str, columns=None):
+    def _write_part(self, writers: list, paths: list, b: int, chunk: pa.Table):
+        if writers[b] is None:
+            writers[b] = self._writes.wrap(self.spill_format.writer(paths[b], chunk.schema))
+        writers[b].write_table(chunk)
+
+    def _batches(self, cdf: ColumnarDbFile, key: str, columns=None, divert=None, collect=None, keep=None):
+        """
+        Arrow batches of one input. collect/keep: a RuntimeJoinFilter fed with (build) or applied to (probe)
+        each batch; with divert=(hot_keys, sink), rows with a hot key go to sink instead.
+        """
+        for batch in read_ahead(cdf.iter_batches(columns, self.batch_rows), self.io_depth, self._io):
+            tbl = pa.Table.from_batches([batch])
+            if collect is not None:
+                collect.collect(tbl, key)
+            if keep is not None:
+                tbl = keep.apply(tbl, key)
+            if divert is not None:
+                hot_keys, sink = divert
+                is_hot = hot_keys.get_indexer(key_array(tbl.column(key))) >= 0
+                if is_hot.any():
+                    sink(tbl.take(np.flatnonzero(is_hot)))
+                    tbl = tbl.take(np.flatnonzero(~is_hot))
+            yield tbl
+
+    def _partition_to_disk(self, cdf: ColumnarDbFile, key: str, out_dir: str, tag: str, columns=None,
+                           num_partitions: int | None = None, seed: int = 0, divert=None, collect=None, keep=None):
         os.makedirs(out_dir, exist_ok=True)
-        pf = pq.ParquetFile(cdf.path)
-        part_paths = [os.path.join(out_dir, f"{tag}_part{b}.parquet") for b in range(self.B)]
-        writers = [None]*self.B
+        B = num_partitions or self.B
+        part_paths = [os.path.join(out_dir, f"{tag}_part{b}{self.spill_format.suffix}") for b in range(B)]
+        writers = [None]*B
         try:
-            for batch in pf.iter_batches(batch_size=self.batch_rows, columns=columns):
-                df = batch.to_pandas()
-                buckets = df[key].apply(lambda x: hash_value(x, self.B)).to_numpy()
-                for b in range(self.B):
-                    chunk = df[buckets == b]
-                    if chunk.empty: continue
-                    tbl = pa.Table.from_pandas(chunk, preserve_index=False)
-                    if writers[b] is None:
-                        writers[b] = pq.ParquetWriter(part_paths[b], tbl.schema, compression="snappy")
-                    writers[b].write_table(tbl)
+            for tbl in self._batches(cdf, key, columns, divert, collect, keep):
+                for b, chunk in _scatter(tbl, hash_partitions(tbl.column(key), B, seed=seed), B):
+                    self._write_part(writers, part_paths, b, chunk)
         finally:
             for w in writers:
                 if w: w.close()
+        self._writes.flush()
         return part_paths
 
-    def join(self, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str,
-             temp_dir="temp", cols_left=None, cols_right=None) -> ColumnarDbFile:
-        work = os.path.join(temp_dir, f"hpj_{uuid.uuid4().hex}")
-        os.makedirs(work, exist_ok=True)
-        Lparts = self._partition_to_disk(left, left_key, work, "L", columns=cols_left)
-        Rparts = self._partition_to_disk(right, right_key, work, "R", columns=cols_right)
+    def _hybrid_partition(self, build: ColumnarDbFile, probe: ColumnarDbFile, build_key: str, probe_key: str,
+                          build_cols, probe_cols, out_dir: str, tags, emit, diverts=(None, None), join_filter=None):
+        """
+        Partition phase of a hybrid hash join. Build buckets stay in memory while they fit the budget
+        (the highest resident bucket is evicted first), probe rows of resident buckets are joined on the fly
+        via emit(build_tbl, probe_tbl, build_rows, probe_rows), and only the other buckets are spilled.
+        Returns (build_paths, probe_paths); resident buckets have no files.
+        """
+        B = self.B
+        budget = self.memory_budget_mb * 1024 * 1024 / self.build_overhead
+        build_bytes = build.decoded_mb(build_cols) * 1024 * 1024
+        resident = np.zeros(B, dtype=bool)
+        resident[:B if build_bytes <= budget else int(B * budget / build_bytes)] = True
+        bpaths = [os.path.join(out_dir, f"{tags[0]}_part{b}{self.spill_format.suffix}") for b in range(B)]
+        ppaths = [os.path.join(out_dir, f"{tags[1]}_part{b}{self.spill_format.suffix}") for b in range(B)]
+        held, held_bytes, writers = [[] for _ in range(B)], 0, [None]*B
+        try:
+            for tbl in self._batches(build, build_key, build_cols, diverts[0], collect=join_filter):
+                for b, chunk in _scatter(tbl, hash_partitions(tbl.column(build_key), B), B):
+                    if resident[b]:
+                        held[b].append(chunk); held_bytes += chunk.nbytes
+                    else:
+                        self._write_part(writers, bpaths, b, chunk)
+                while held_bytes > budget and resident.any():
+                    b = np.flatnonzero(resident)[-1]
+                    resident[b] = False
+                    for chunk in held[b]:
+                        self._write_part(writers, bpaths, b, chunk); held_bytes -= chunk.nbytes
+                    held[b] = []
+        finally:
+            for w in writers:
+                if w: w.close()
 
-        out = ColumnarDbFile("HPJ_out", file_dir=work)
-        writer = None
+        chunks = [c for b in range(B) for c in held[b]]
+        build_tbl = pa.concat_tables(chunks) if chunks else None
+        table = ColumnarHashTable(build_tbl.column(build_key)) if chunks else None
+        writers = [None]*B
+        try:
+            for tbl in self._batches(probe, probe_key, probe_cols, diverts[1], keep=join_filter):
+                buckets = hash_partitions(tbl.column(probe_key), B)
+                hit = resident[buckets]
+                if table is not None and hit.any():
+                    hit_tbl = tbl.take(np.flatnonzero(hit))
+                    brows, prows = table.probe(hit_tbl.column(probe_key))
+                    if len(brows):
+                        emit(build_tbl, hit_tbl, brows, prows)
+                if not hit.all():
+                    rest = np.flatnonzero(~hit)
+                    for b, chunk in _scatter(tbl.take(rest), buckets[rest], B):
+                        self._write_part(writers, ppaths, b, chunk)
+        finally:
+            for w in writers:
+                if w: w.close()
+        self._writes.flush()
+        self.stats["resident_partitions"] = int(resident.sum())
+        return bpaths, ppaths
+
+    def _fit_pairs(self, lpath: str, rpath: str, left_key: str, right_key: str, depth: int = 0,
+                   parent_mb: float = float("inf")) -> list:
+        """(L, R) partition pairs whose build side fits one worker's memory share, repartitioning recursively."""
+        build_mb = min(self.spill_format.decoded_mb(lpath), self.spill_format.decoded_mb(rpath)) * self.build_overhead
+        share_mb = self.memory_budget_mb / max(self.num_workers, 1) if self.memory_budget_mb else None
+        # Stop when it fits, at max depth, or when the last split did not shrink it (one hot key)
+        if share_mb is None or build_mb <= share_mb or depth >= self.max_depth or build_mb >= parent_mb:
+            return [(lpath, rpath)]
+        sub = os.path.join(os.path.dirname(lpath), f"d{depth + 1}_{uuid.uuid4().hex[:8]}")
+        B = max(2, math.ceil(build_mb / share_mb))
+        Ls = self._partition_to_disk(ColumnarDbFile.from_path(lpath), left_key, sub, "L", num_partitions=B, seed=depth + 1)
+        Rs = self._partition_to_disk(ColumnarDbFile.from_path(rpath), right_key, sub, "R", num_partitions=B, seed=depth + 1)
+        os.remove(lpath); os.remove(rpath)
+        pairs = []
+        for l, r in zip(Ls, Rs):
+            if os.path.exists(l) and os.path.exists(r):
+                pairs += self._fit_pairs(l, r, left_key, right_key, depth + 1, build_mb)
+        return pairs
+
+    def _heavy_hitters(self, cdf: ColumnarDbFile, key: str) -> pd.Index:
+        """Keys whose share of a sample (evenly spaced row groups) reaches skew_threshold."""
+        sample = cdf.sample_column(key, self.skew_sample_rows)
+        if sample.empty:
+            return pd.Index([])
+        share = sample.value_counts(normalize=True)
+        return pd.Index(share.index[share >= self.skew_threshold])
+
+    def _join_hot(self, path: str, bcast_tbl: pa.Table, bcast: ColumnarHashTable, bcast_is_left: bool,
+                  left_key: str, right_key: str) -> list:
+        """Probe one slice of hot-key probe rows against the broadcast (small-side) hot rows."""
+        probe_key = right_key if bcast_is_left else left_key
+        out = []
+        batches = self.spill_format.iter_batches(path, batch_rows=self.batch_rows)
+        for batch in read_ahead(batches, self.io_depth, self._io):
+            probe_tbl = pa.Table.from_batches([batch])
+            brows, prows = bcast.probe(probe_tbl.column(probe_key))
+            if len(brows):
+                out.append(join_output(bcast_tbl, probe_tbl, brows, prows, left_key, right_key) if bcast_is_left
+                           else join_output(probe_tbl, bcast_tbl, prows, brows, left_key, right_key))
+        return out
+
+    def _join_partition(self, lpath: str, rpath: str, left_key: str, right_key: str) -> list:
+        fmt = self.spill_format
+
+        # Estimate rows and choose smaller to build the hash table in memory
+        build_left = fmt.num_rows(lpath) <= fmt.num_rows(rpath)
+        build_path, build_key = (lpath, left_key) if build_left else (rpath, right_key)
+        probe_path, probe_key = (rpath, right_key) if build_left else (lpath, left_key)
 
-        for b in range(self.B):
-            if not (os.path.exists(Lparts[b]) and os.path.exists(Rparts[b])): 
+        # Build: whole partition as one Arrow table + columnar hash table on its key
+        build_tbl = fmt.read(build_path)
+        table = ColumnarHashTable(build_tbl.column(build_key))
+
+        # Probe: all matching (build, probe) row pairs of a batch at once, then gather with take()
+        out = []
+        for batch in read_ahead(fmt.iter_batches(probe_path, batch_rows=self.batch_rows), self.io_depth, self._io):
+            probe_tbl = pa.Table.from_batches([batch])
+            brows, prows = table.probe(probe_tbl.column(probe_key))
+            if len(brows) == 0:
                 continue
-            lpf, rpf = pq.ParquetFile(Lparts[b]), pq.ParquetFile(Rparts[b])
-
-            # Estimate rows and choose smaller to build hash dict in memory
-            l_rows = sum(lpf.metadata.row_group(i).num_rows for i in range(lpf.metadata.num_row_groups))
-            r_rows = sum(rpf.metadata.row_group(i).num_rows for i in range(rpf.metadata.num_row_groups))
-            build_pf, build_key = (lpf, left_key) if l_rows <= r_rows else (rpf, right_key)
-            probe_pf, probe_key = (rpf, right_key) if l_rows <= r_rows else (lpf, left_key)
-
-            # Build dict: key -> DataFrame (concatenated batches)
-            build_map = {}
-            for batch in build_pf.iter_batches(batch_size=self.batch_rows):
-                dfb = batch.to_pandas()
-                for k, g in dfb.groupby(build_key):
-                    if k in build_map:
-                        build_map[k] = pd.concat([build_map[k], g], ignore_index=True)
-                    else:
-                        build_map[k] = g
-
-            # Probe and emit matches
-            for batch in probe_pf.iter_batches(batch_size=self.batch_rows):
-                dfo = batch.to_pandas()
-                out_buf = []
-                for k, probe_group in dfo.groupby(probe_key):
-                    if k in build_map:
-                        if build_pf is lpf:
-                            joined = build_map[k].merge(probe_group, left_on=left_key, right_on=right_key, how="inner")
-                        else:
-                            joined = probe_group.merge(build_map[k], left_on=left_key, right_on=right_key, how="inner")
-                        if not joined.empty:
-                            out_buf.append(joined)
-                if out_buf:
-                    tbl = pa.Table.from_pandas(pd.concat(out_buf, ignore_index=True), preserve_index=False)
-                    if writer is None:
-                        writer = pq.ParquetWriter(out.path, tbl.schema, compression="snappy")
-                    writer.write_table(tbl)
+            if build_left:
+                out.append(join_output(build_tbl, probe_tbl, brows, prows, left_key, right_key))
+            else:
+                out.append(join_output(probe_tbl, build_tbl, prows, brows, left_key, right_key))
+        return out
 
-        if writer: writer.close()
+    def _join_bucket(self, left: ColumnarDbFile, right: ColumnarDbFile, b: int, left_key: str, right_key: str,
+                     cols_left=None, cols_right=None) -> list:
+        """Bucket b of two co-bucketed tables: read both buckets, build on the smaller one."""
+        ltbl, rtbl = left.read_bucket(b, cols_left), right.read_bucket(b, cols_right)
+        if ltbl.num_rows == 0 or rtbl.num_rows == 0:
+            return []
+        if ltbl.num_rows <= rtbl.num_rows:
+            brows, prows = ColumnarHashTable(ltbl.column(left_key)).probe(rtbl.column(right_key))
+            return [join_output(ltbl, rtbl, brows, prows, left_key, right_key)] if len(brows) else []
+        brows, prows = ColumnarHashTable(rtbl.column(right_key)).probe(ltbl.column(left_key))
+        return [join_output(ltbl, rtbl, prows, brows, left_key, right_key)] if len(brows) else []
+
+    def _ensure_output(self, out: ColumnarDbFile, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str,
+                       right_key: str, cols_left=None, cols_right=None) -> ColumnarDbFile:
         # Ensure output file exists even if there were no matches
         if not os.path.exists(out.path):
             # Derive output columns similar to a merge result
-            l_cols = cols_left if cols_left is not None else pq.ParquetFile(left.path).schema.names
-            r_cols = cols_right if cols_right is not None else pq.ParquetFile(right.path).schema.names
+            l_cols = cols_left if cols_left is not None else left.schema.names
+            r_cols = cols_right if cols_right is not None else right.schema.names
             # Drop duplicate right key if names are equal to emulate merge(on=key)
             if left_key == right_key and right_key in r_cols:
                 r_cols = [c for c in r_cols if c != right_key]
             cols = list(l_cols) + list(r_cols)
             empty = pd.DataFrame({c: pd.Series(dtype="float64") for c in cols})
             tbl = pa.Table.from_pandas(empty, preserve_index=False)
-            pq.write_table(tbl, out.path, compression="snappy")
+            out.format.write_table(tbl, out.path)
         return out
+
+    def join(self, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str,
+             temp_dir="temp", cols_left=None, cols_right=None) -> ColumnarDbFile:
+        self.stats = {}
+        self._io, self._writes = operator_io(self.io_depth)
+        try:
+            return self._join(left, right, left_key, right_key, temp_dir, cols_left, cols_right)
+        finally:
+            self._writes.close()  # queued output writes land before the output is handed back
+            self.stats["io"] = self._io.as_dict()
+
+    def _join(self, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str,
+              temp_dir: str, cols_left, cols_right) -> ColumnarDbFile:
+        work = os.path.join(temp_dir, f"hpj_{uuid.uuid4().hex}")
+        os.makedirs(work, exist_ok=True)
+        out = ColumnarDbFile("HPJ_out", file_dir=work, file_format=self.spill_format)
+        writer = None
+
+        def write(tbl):
+            nonlocal writer
+            if writer is None:
+                writer = self._writes.wrap(out.writer(tbl.schema))
+            writer.write_table(tbl)
+
+        n_buckets = co_bucketed(left, right, left_key, right_key) if self.bucketed else None
+        if n_buckets:
+            # Bucket b only matches bucket b: no partitioning, spilling or filters needed
+            self.stats["bucketed"] = n_buckets
+            run = lambda b: self._join_bucket(left, right, b, left_key, right_key, cols_left, cols_right)
+            for tables in parallel_map(run, range(n_buckets), self.num_workers):
+                for tbl in tables:
+                    write(tbl)
+            if writer: writer.close()
+            return self._ensure_output(out, left, right, left_key, right_key, cols_left, cols_right)
+
+        # Build on the smaller projected side
+        build_left = left.decoded_mb(cols_left) <= right.decoded_mb(cols_right)
+
+        # Runtime filter from the build side's keys drops non-matching probe rows before they are spilled
+        jf = RuntimeJoinFilter() if self.join_filter else None
+        collect_l, keep_l = (jf, None) if build_left else (None, jf)
+        collect_r, keep_r = keep_l, collect_l
+
+        # Skew: hot probe keys skip partitioning. The small side's hot rows are broadcast in memory and the
+        # hot probe rows are split round-robin into one slice per worker, each joined as its own task.
+        diverts, hot_paths, bcast_parts = (None, None), [], []
+        if self.skew_threshold:
+            hot = self._heavy_hitters(right if build_left else left, right_key if build_left else left_key)
+            self.stats["heavy_hitters"] = len(hot)
+            if len(hot):
+                hot_paths = [os.path.join(work, f"hot_part{i}{self.spill_format.suffix}")
+                             for i in range(max(self.num_workers, 1))]
+                hot_writers, n_hot = [None]*len(hot_paths), 0
+                def hot_sink(tbl):
+                    nonlocal n_hot
+                    self._write_part(hot_writers, hot_paths, n_hot % len(hot_paths), tbl); n_hot += 1
+                diverts = ((hot, bcast_parts.append), (hot, hot_sink))
+                diverts = diverts if build_left else diverts[::-1]
+
+        try:
+            if self.hybrid and self.memory_budget_mb:
+                # Resident build buckets are joined while the probe side streams
+                if build_left:
+                    Lparts, Rparts = self._hybrid_partition(
+                        left, right, left_key, right_key, cols_left, cols_right, work, ("L", "R"),
+                        lambda bt, pt, bi, pi: write(join_output(bt, pt, bi, pi, left_key, right_key)),
+                        diverts, jf)
+                else:
+                    Rparts, Lparts = self._hybrid_partition(
+                        right, left, right_key, left_key, cols_right, cols_left, work, ("R", "L"),
+                        lambda bt, pt, bi, pi: write(join_output(pt, bt, pi, bi, left_key, right_key)),
+                        diverts[::-1], jf)
+            else:
+                # Build side first, so its keys are collected before the probe side is filtered
+                part_l = lambda: self._partition_to_disk(left, left_key, work, "L", columns=cols_left,
+                                                         divert=diverts[0], collect=collect_l, keep=keep_l)
+                part_r = lambda: self._partition_to_disk(right, right_key, work, "R", columns=cols_right,
+                                                         divert=diverts[1], collect=collect_r, keep=keep_r)
+                if build_left:
+                    Lparts, Rparts = part_l(), part_r()
+                else:
+                    Rparts, Lparts = part_r(), part_l()
+        finally:
+            if hot_paths:
+                for w in hot_writers:
+                    if w: w.close()
+                self._writes.flush()
+
+        # Partition pairs (and hot slices) are independent: join them concurrently, stream into one writer
+        tasks = [pair for b in range(self.B) if os.path.exists(Lparts[b]) and os.path.exists(Rparts[b])
+                 for pair in self._fit_pairs(Lparts[b], Rparts[b], left_key, right_key)]
+        if bcast_parts:
+            bcast_tbl = pa.concat_tables(bcast_parts)
+            bcast = ColumnarHashTable(bcast_tbl.column(left_key if build_left else right_key))
+            tasks += [(p,) for p in hot_paths if os.path.exists(p)]
+        def run(task):
+            if len(task) == 1:
+                return self._join_hot(task[0], bcast_tbl, bcast, build_left, left_key, right_key)
+            return self._join_partition(task[0], task[1], left_key, right_key)
+        for tables in parallel_map(run, tasks, self.num_workers):
+            for tbl in tables:
+                write(tbl)
+
+        if jf is not None:
+            self.stats["join_filter"] = jf.stats()
+        if writer: writer.close()
+        return self._ensure_output(out, left, right, left_key, right_key, cols_left, cols_right)
+
+
+def _scatter(tbl: pa.Table, buckets: np.ndarray, B: int):
+    """Yield (bucket, rows) slices of one batch: a single stable sort by bucket id, then contiguous slices."""
+    order = np.argsort(buckets, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(buckets, minlength=B))))
+    scattered = tbl.take(order)
+    for b in range(B):
+        if offsets[b+1] > offsets[b]:
+            yield b, scattered.slice(offsets[b], offsets[b+1] - offsets[b])
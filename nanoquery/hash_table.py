@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+from .utils import expand_ranges, key_array
+
+class ColumnarHashTable:
+    """
+    In-memory join hash table over a build-side key column.
+    Rows sharing a key are stored as one contiguous run: slot -> rows[offsets[slot]:offsets[slot+1]].
+    Null keys never match (same as the old groupby-based build).
+    """
+    def __init__(self, keys):
+        codes, uniques = pd.factorize(key_array(keys))
+        order = np.argsort(codes, kind="stable")
+        self.rows = order[np.count_nonzero(codes < 0):]  # -1 (null) codes sort first; drop them
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.index = pd.Index(uniques)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def probe(self, keys):
+        """Return (build_rows, probe_rows) index arrays for every matching pair of a probe batch."""
+        slots = self.index.get_indexer(key_array(keys))
+        hits = np.flatnonzero(slots >= 0)
+        starts = self.offsets[slots[hits]]
+        counts = self.offsets[slots[hits] + 1] - starts
+        return self.rows[expand_ranges(starts, counts)], np.repeat(hits, counts)
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Recorded with bucketed tables: files bucketed under another hash scheme are not co-bucketed
+HASH_PARTITIONS_VERSION = "hash_partitions/v2"
+
+_PRIME1 = np.uint64(0x9E3779B185EBCA87)  # xxHash64 primes
+_PRIME2 = np.uint64(0xC2B2AE3D27D4EB4F)
+_GOLDEN = 0x9E3779B97F4A7C15
+
+def mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: a bijection on uint64 with full avalanche (uint64 arithmetic wraps)."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _salt(seed: int) -> np.uint64:
+    # Distinct, well-spread per seed (also for seed 0)
+    with np.errstate(over="ignore"):
+        return mix64(np.uint64(((seed + 1) * _GOLDEN) & 0xFFFFFFFFFFFFFFFF))
+
+def hash_ints(values: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Seeded 64-bit hashes of integer keys; strides and runs of keys spread like random ones."""
+    with np.errstate(over="ignore"):
+        return mix64((values.astype(np.int64).view(np.uint64) ^ _salt(seed)) * _PRIME1)
+
+def hash_bytes(arr: pa.Array, seed: int = 0) -> np.ndarray:
+    """
+    Seeded 64-bit hashes of a string/binary Arrow array, straight from its offsets and data buffers.
+    Each value is read as zero-padded little-endian 8-byte words; word i is mixed with its position
+    and the seed, the mixes are summed per value and finalized together with the length
+    (multiply/xorshift mixing in the style of xxHash/murmur finalizers).
+    Null slots hash like the empty value.
+    """
+    n = len(arr)
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    large = pa.types.is_large_string(arr.type) or pa.types.is_large_binary(arr.type)
+    _, obuf, dbuf = arr.buffers()
+    offsets = np.frombuffer(obuf, dtype=np.int64 if large else np.int32)[arr.offset:arr.offset + n + 1].astype(np.int64)
+    data = np.frombuffer(dbuf, dtype=np.uint8) if dbuf is not None else np.zeros(0, dtype=np.uint8)
+    data = np.concatenate([data, np.zeros(8, dtype=np.uint8)])  # every 8-byte read stays in bounds
+    starts, lens = offsets[:-1], np.diff(offsets)
+    words = np.maximum(1, (lens + 7) // 8)
+    salt = _salt(seed)
+    with np.errstate(over="ignore"):
+        if (words == 1).all():
+            # Short keys: one word per value
+            pos, first, rest = np.zeros(n, dtype=np.int64), None, lens
+            at = starts
+        else:
+            first = np.cumsum(words) - words
+            owner = np.repeat(np.arange(n), words)
+            pos = np.arange(words.sum()) - first[owner]
+            rest, at = lens[owner] - pos * 8, starts[owner] + pos * 8
+        # Unaligned 8-byte reads through a sliding window view, bytes past the value's end masked off
+        w = np.lib.stride_tricks.sliding_window_view(data, 8)[at].copy().view("<u8").ravel()
+        keep = np.clip(rest, 0, 8).astype(np.uint64) * np.uint64(8)
+        w &= np.where(keep == 64, np.uint64(0xFFFFFFFFFFFFFFFF), (np.uint64(1) << (keep & np.uint64(63))) - np.uint64(1))
+        g = mix64(w ^ mix64(pos.astype(np.uint64) * _PRIME2 + salt))
+        h = g if first is None else np.add.reduceat(g, first)
+        return mix64(h ^ (lens.astype(np.uint64) * _PRIME1) ^ salt)
+
+def _normalize(values):
+    """Keys -> int64 NumPy array, string/binary Arrow array, or (fallback) object NumPy array."""
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks() if values.num_chunks else pa.array([], type=values.type)
+    if isinstance(values, pa.Array):
+        if pa.types.is_string(values.type) or pa.types.is_large_string(values.type) \
+                or pa.types.is_binary(values.type) or pa.types.is_large_binary(values.type):
+            return values
+        values = values.to_numpy(zero_copy_only=False)
+    arr = np.asarray(values)
+    if arr.dtype.kind in "OUS":
+        try:
+            converted = pa.array(arr, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return arr.astype(object)
+        return _normalize(converted) if not pa.types.is_null(converted.type) else arr.astype(object)
+    if arr.dtype.kind == "f":
+        # An int column with nulls decodes as float+NaN: hash integral values as ints so both join sides
+        # agree (NaN rows hash like 0, harmless: they never match); other floats hash their bits
+        finite = np.isfinite(arr)
+        if (arr[finite] == np.floor(arr[finite])).all():
+            return np.where(finite, arr, 0).astype(np.int64)
+        return (arr.astype(np.float64) + 0.0).view(np.int64)  # + 0.0 folds -0.0 into 0.0
+    if arr.dtype.kind in "mM":
+        return arr.view(np.int64)
+    return arr.astype(np.int64)
+
+def hash64(values, seed: int = 0) -> np.ndarray:
+    """Vectorized seeded 64-bit key hashes (uint64) of an Arrow/pandas/NumPy key column."""
+    if isinstance(values, pa.ChunkedArray) and pa.types.is_dictionary(values.type):
+        return np.concatenate([hash64(c, seed) for c in values.chunks] or [np.zeros(0, dtype=np.uint64)])
+    if isinstance(values, pa.Array) and pa.types.is_dictionary(values.type):
+        # Dictionary columns stay encoded: each distinct value is hashed once. Null slots point past the
+        # dictionary at a 0 sentinel (an all-null chunk may come with an empty dictionary)
+        h = np.append(hash64(values.dictionary, seed), np.uint64(0))
+        return h[values.indices.fill_null(len(values.dictionary)).to_numpy()]
+    keys = _normalize(values)
+    if isinstance(keys, pa.Array):
+        return hash_bytes(keys, seed)
+    if keys.dtype.kind == "O":
+        with np.errstate(over="ignore"):
+            return mix64(pd.util.hash_array(keys, categorize=False) ^ _salt(seed))
+    return hash_ints(keys, seed)
+
+def hash_partitions(values, B: int, seed: int = 0) -> np.ndarray:
+    """
+    Vectorized partition ids in [0, B) for a whole key column. Each seed is an independent hash,
+    so recursive repartitioning with a new seed splits a partition evenly.
+    """
+    return (hash64(values, seed) % np.uint64(B)).astype(np.int64)
@@ -0,0 +1,72 @@
+import numpy as np
+from .hashing import hash64
+
+def _bit_length(w: np.ndarray) -> np.ndarray:
+    # Exact bit length of uint64 values (float log2 rounds near powers of two)
+    w = w.copy()
+    n = np.zeros(len(w), dtype=np.int64)
+    for s in (32, 16, 8, 4, 2, 1):
+        big = w >= (np.uint64(1) << np.uint64(s))
+        n[big] += s
+        w[big] >>= np.uint64(s)
+    return n + (w > 0)
+
+def _alpha(m: int) -> float:
+    return {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+
+class HyperLogLog:
+    """
+    A row of HyperLogLog sketches, one per group: 2**precision one-byte registers each, so
+    memory per group is fixed no matter how many distinct values it sees. Standard error of an
+    estimate is about 1.04 / sqrt(2**precision) (1.6% at precision 12, 3.3% at 10). Sketches
+    merge by register-wise max, so partial aggregates from any split of the input combine exactly.
+    """
+    def __init__(self, precision: int = 10, n_groups: int = 0, seed: int = 0):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be in [4, 16]")
+        self.p, self.m, self.seed = precision, 1 << precision, seed
+        self.registers = np.zeros((n_groups, self.m), dtype=np.uint8)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / np.sqrt(self.m)
+
+    @property
+    def nbytes(self) -> int:
+        return self.registers.nbytes
+
+    def __len__(self):
+        return len(self.registers)
+
+    def grow(self, n_groups: int):
+        if n_groups > len(self.registers):
+            pad = np.zeros((n_groups - len(self.registers), self.m), dtype=np.uint8)
+            self.registers = np.concatenate([self.registers, pad])
+
+    def add(self, groups: np.ndarray, values):
+        """Add values[i] to the sketch of groups[i]."""
+        h = hash64(values, self.seed)
+        bucket = (h >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = h & np.uint64((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - _bit_length(rest) + 1
+        self.grow(int(groups.max()) + 1 if len(groups) else 0)
+        np.maximum.at(self.registers.reshape(-1), groups.astype(np.int64) * self.m + bucket, rank.astype(np.uint8))
+
+    def merge(self, other: "HyperLogLog", mapping: np.ndarray | None = None):
+        """Fold other's sketches in; other's group i lands on mapping[i] (default: same index)."""
+        if (other.p, other.seed) != (self.p, self.seed):
+            raise ValueError("can only merge sketches with the same precision and seed")
+        mapping = np.arange(len(other)) if mapping is None else np.asarray(mapping, dtype=np.int64)
+        self.grow(int(mapping.max()) + 1 if len(mapping) else 0)
+        np.maximum.at(self.registers, mapping, other.registers)
+
+    def estimate(self) -> np.ndarray:
+        """Estimated distinct count per group (linear counting for small cardinalities)."""
+        regs = self.registers.astype(np.float64)
+        est = _alpha(self.m) * self.m ** 2 / np.exp2(-regs).sum(axis=1)
+        zeros = (self.registers == 0).sum(axis=1)
+        small = (est <= 2.5 * self.m) & (zeros > 0)
+        with np.errstate(divide="ignore"):
+            est[small] = self.m * np.log(self.m / zeros[small])
+        return est
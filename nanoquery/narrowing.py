@@ -0,0 +1,65 @@
+import pyarrow as pa
+from .utils import parquet_column_stats
+
+# Narrower signed integer types, smallest first, with the range each one holds
+_INT_TYPES = [(pa.int8(), -2**7, 2**7 - 1), (pa.int16(), -2**15, 2**15 - 1), (pa.int32(), -2**31, 2**31 - 1)]
+
+def int_type_for_range(lo: int, hi: int, current: pa.DataType = pa.int64()) -> pa.DataType:
+    """Smallest signed integer type holding every value in [lo, hi]; current if none is narrower."""
+    for t, t_lo, t_hi in _INT_TYPES:
+        if t.bit_width >= current.bit_width:
+            break
+        if t_lo <= lo and hi <= t_hi:
+            return t
+    return current
+
+def _is_string(t: pa.DataType) -> bool:
+    return pa.types.is_string(t) or pa.types.is_large_string(t) or pa.types.is_binary(t) \
+        or pa.types.is_large_binary(t)
+
+def _sample_share(cdf, column: str, sample_rows: int) -> float:
+    # Distinct share of a sample: never below the table's (a sample repeats values less), so errs towards plain
+    sample = cdf.sample_column(column, sample_rows)
+    return sample.nunique() / len(sample) if len(sample) else 1.0
+
+def narrowed_types(cdf, columns=None, column_stats: dict | None = None, dictionary_ratio: float = 0.5,
+                   sample_rows: int = 20_000) -> dict:
+    """
+    Read-time types for the columns of a table file (ColumnarDbFile) that have a narrower safe
+    representation: integers -> the smallest signed type holding the column's min/max, strings with
+    at most dictionary_ratio distinct values per row -> dictionary<int32, string>.
+    Statistics are the planner's (catalog or footer entries), else the Parquet footer's; string NDVs
+    missing from them are measured on a sample.
+    """
+    schema = cdf.schema
+    if column_stats is None:
+        column_stats = parquet_column_stats(cdf.fragments) if cdf.format.name == "parquet" else {}
+    rows = cdf.num_rows
+    types = {}
+    for c in columns if columns is not None else schema.names:
+        t, st = schema.field(c).type, column_stats.get(c, {})
+        new = t
+        if pa.types.is_integer(t) and isinstance(st.get("min"), int) and isinstance(st.get("max"), int):
+            new = int_type_for_range(st["min"], st["max"], t)
+        elif _is_string(t) and rows:
+            ndv = st.get("ndv") if st.get("ndv") is not None else st.get("distinct")
+            share = ndv / rows if ndv is not None else _sample_share(cdf, c, sample_rows)
+            if share <= dictionary_ratio:
+                new = pa.dictionary(pa.int32(), t)
+        if new != t:
+            types[c] = new
+    return types
+
+def narrow(data, types: dict):
+    """
+    Cast the columns of an Arrow table / record batch named in `types` (checked casts: a value that
+    does not fit raises). Dictionary targets accept plain or differently typed dictionary columns.
+    """
+    if not types:
+        return data
+    cols, fields = data.columns, list(data.schema)
+    for i, f in enumerate(fields):
+        t = types.get(f.name)
+        if t is not None and f.type != t:
+            cols[i], fields[i] = cols[i].cast(t), f.with_type(t)
+    return type(data).from_arrays(cols, schema=pa.schema(fields))
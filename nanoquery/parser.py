@@ -1,7 +1,16 @@
+import re
+
+# Comments and quoted literals / identifiers, which may mention function names without calling them
+_NOT_CODE = re.compile(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", re.S)
+_APPROX_CALL = re.compile(r"\bAPPROX_COUNT_DISTINCT\s*\(", re.I)
+
 def parse_sql_hardcoded(sql: str):
     """
     Hand-parses the specific project query structure and returns a plan dict.
+    APPROX_COUNT_DISTINCT(l.user_id) in place of COUNT(DISTINCT l.user_id) selects the sketch-based count.
     """
+    approx = _APPROX_CALL.search(_NOT_CODE.sub(" ", sql))
+    distinct = "APPROX_COUNT_DISTINCT" if approx else "COUNT_DISTINCT"
     return {
         "tables": {"Songs": "s", "Listens": "l", "Users": "u"},
         "joins": [
@@ -11,7 +20,7 @@ def parse_sql_hardcoded(sql: str):
         "group_by": ["s.song_id", "s.title"],
         "aggregations": {
             "avg_age": {"func": "AVG", "expr": "u.age"},
-            "count_distinct_users": {"func": "COUNT_DISTINCT", "expr": "l.user_id"},
+            "count_distinct_users": {"func": distinct, "expr": "l.user_id"},
         },
         "select": ["s.song_id", "avg_age", "count_distinct_users"],
         "order_by": [("count_distinct_users", "DESC"), ("s.song_id", "ASC")],
@@ -0,0 +1,273 @@
+import itertools, os, uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from .storage import ColumnarDbFile
+from .background_io import IOStats, read_ahead
+from .hash_table import ColumnarHashTable
+from .utils import join_output, key_array, parallel_map
+
+class Scan:
+    """
+    Leaf operator: column-pruned Arrow record batches of one table file, read in place.
+    row_id names an extra int64 column of file row positions (for late materialization).
+    io_depth > 0 decodes up to that many batches ahead on a background thread.
+
+    Every operator reports `ordering`: the columns its output is sorted on (ascending), [] if none.
+    It is final once the operator has produced its first batch.
+    """
+    def __init__(self, cdf: ColumnarDbFile, columns=None, batch_rows: int = 100_000, row_id: str | None = None,
+                 io_depth: int = 0):
+        self.cdf = cdf
+        self.columns = columns
+        self.batch_rows = batch_rows
+        self.row_id = row_id
+        self.io_depth = io_depth
+        self.stats = {}
+
+    def materialize(self):
+        # The file has no row id column: a row-id scan has to be streamed instead
+        return None if self.row_id else (self.cdf, self.columns)
+
+    @property
+    def ordering(self) -> list:
+        # The file's recorded sort order, as far as its columns are read
+        order = self.cdf.sort_order or []
+        return order if self.columns is None else list(itertools.takewhile(lambda c: c in self.columns, order))
+
+    def batches(self):
+        offset, io = 0, IOStats(self.io_depth)
+        try:
+            for batch in read_ahead(self.cdf.iter_batches(self.columns, self.batch_rows), self.io_depth, io):
+                tbl = pa.Table.from_batches([batch])
+                if self.row_id:
+                    tbl = tbl.append_column(self.row_id, pa.array(np.arange(offset, offset + tbl.num_rows)))
+                offset += tbl.num_rows
+                yield tbl
+        finally:
+            self.stats = {"rows": offset, "io": io.as_dict()}
+
+
+class PreAggregate:
+    """
+    Eager GROUP BY keys / COUNT(*) below a join: duplicate key rows of the child collapse into one
+    row carrying their count. In-memory pipeline breaker; output streams in batch_rows slices.
+    """
+    ordering = []
+
+    def __init__(self, child, keys, count_col: str = "listen_count", batch_rows: int = 100_000):
+        self.child = child
+        self.keys = list(keys)
+        self.count_col = count_col
+        self.batch_rows = batch_rows
+        self.stats = {}
+
+    def batches(self):
+        parts = [tbl.select(self.keys) for tbl in self.child.batches()]
+        if not parts:
+            return
+        tbl = pa.concat_tables(parts)
+        out = tbl.group_by(self.keys, use_threads=False).aggregate([([], "count_all")])
+        out = out.rename_columns([self.count_col if c == "count_all" else c for c in out.column_names])
+        self.stats = {"rows_in": tbl.num_rows, "rows_out": out.num_rows}
+        for off in range(0, out.num_rows, self.batch_rows):
+            yield out.slice(off, self.batch_rows)
+
+
+class HashJoin:
+    """
+    Pipelined in-memory hash join. The build child is drained into a ColumnarHashTable
+    (the only pipeline breaker); probe batches stream through and matches stream out.
+    """
+    def __init__(self, left, right, left_key: str, right_key: str, build: str = "right", num_workers: int = 1):
+        self.left, self.right = left, right
+        self.left_key, self.right_key = left_key, right_key
+        self.build = build
+        self.num_workers = num_workers
+        self.stats = {}
+
+    @property
+    def ordering(self) -> list:
+        # Matches come out in probe row order
+        return (self.right if self.build == "left" else self.left).ordering
+
+    def batches(self):
+        build_left = self.build == "left"
+        build_child, probe_child = (self.left, self.right) if build_left else (self.right, self.left)
+        build_key, probe_key = (self.left_key, self.right_key) if build_left else (self.right_key, self.left_key)
+        parts = list(build_child.batches())
+        if not parts:
+            return
+        build_tbl = pa.concat_tables(parts)
+        table = ColumnarHashTable(build_tbl.column(build_key))
+        self.stats = {"mode": "pipelined", "build_rows": build_tbl.num_rows, "probe_rows": 0, "output_rows": 0}
+
+        def probe(tbl):
+            brows, prows = table.probe(tbl.column(probe_key))
+            if build_left:
+                return tbl.num_rows, join_output(build_tbl, tbl, brows, prows, self.left_key, self.right_key)
+            return tbl.num_rows, join_output(tbl, build_tbl, prows, brows, self.left_key, self.right_key)
+
+        for n_in, out in parallel_map(probe, probe_child.batches(), self.num_workers):
+            self.stats["probe_rows"] += n_in
+            if out.num_rows:
+                self.stats["output_rows"] += out.num_rows
+                yield out
+
+
+def _remove_pipe(cdf: ColumnarDbFile):
+    # Intermediate written for a join that has finished reading it: the file and its sort-order metadata go
+    cdf._drop_meta()
+    if os.path.exists(cdf.path):
+        os.remove(cdf.path)
+
+
+class MaterializedJoin:
+    """
+    Runs a spilling join operator (HashPartitionJoin / SortMergeJoin) inside a pipeline.
+    Scans and other materialized joins are handed over as files; a streaming child is
+    written to a temp file (in spill_format) first, removed once the join has run. The join
+    output is then scanned back out.
+    """
+    def __init__(self, op, left, right, left_key: str, right_key: str, temp_dir: str = "temp",
+                 batch_rows: int = 100_000, spill_format="parquet"):
+        self.op = op
+        self.left, self.right = left, right
+        self.left_key, self.right_key = left_key, right_key
+        self.temp_dir = temp_dir
+        self.batch_rows = batch_rows
+        self.spill_format = spill_format
+        self.stats = {}
+        self.ordering = []
+        self._pipes = []
+
+    def _input(self, child):
+        got = child.materialize() if hasattr(child, "materialize") else None
+        if got is not None:
+            return got
+        cdf = ColumnarDbFile(f"pipe_{uuid.uuid4().hex}", file_dir=self.temp_dir, file_format=self.spill_format)
+        self._pipes.append(cdf)
+        writer = None
+        for tbl in child.batches():
+            if writer is None:
+                writer = cdf.writer(tbl.schema)
+            writer.write_table(tbl)
+        if writer is None:
+            return None, None
+        writer.close()
+        if child.ordering:
+            cdf.write_meta(sort_order=child.ordering)
+        return cdf, None
+
+    def materialize(self):
+        try:
+            (lcdf, lcols), (rcdf, rcols) = self._input(self.left), self._input(self.right)
+            if lcdf is None or rcdf is None:
+                return None, None
+            out = self.op.join(lcdf, rcdf, self.left_key, self.right_key, temp_dir=self.temp_dir,
+                               cols_left=lcols, cols_right=rcols)
+        finally:
+            for cdf in self._pipes:
+                _remove_pipe(cdf)
+            self._pipes = []
+        self.stats = dict(self.op.stats, mode="materialized")
+        self.ordering = (out.sort_order or []) if os.path.exists(out.path) else []
+        return (out, None) if os.path.exists(out.path) else (None, None)
+
+    def batches(self):
+        out, _ = self.materialize()
+        if out is not None:
+            yield from Scan(out, batch_rows=self.batch_rows).batches()
+
+
+class Tables:
+    """Source operator over Arrow tables already in memory."""
+    def __init__(self, tables, ordering=None):
+        self.tables = tables
+        self.ordering = list(ordering or [])
+        self.stats = {}
+
+    def batches(self):
+        yield from self.tables
+
+
+def _observed(source: str, rows: int, nbytes: float, sample: pd.Series) -> dict:
+    share = float(sample.value_counts(normalize=True).iloc[0]) if len(sample) else 0.0
+    return {"source": source, "rows": int(rows), "mb": nbytes / (1024*1024), "sample_rows": len(sample),
+            "sample_ndv": int(sample.nunique()), "top_key_share": share}
+
+
+class AdaptiveJoin:
+    """
+    Defers picking a join operator until its left input (the previous step) has run.
+    A materialized child is observed through its output file; a streaming child is buffered
+    in memory up to buffer_mb and spilled to a temp file beyond that. The observed row count,
+    size and key sample go to decide(observed, source), which returns the operator to run with
+    `source` standing in for the left child. A spill file is removed once that operator is done.
+    """
+    def __init__(self, left, key: str, decide, temp_dir: str = "temp", buffer_mb: float = 256.0,
+                 sample_rows: int = 100_000, batch_rows: int = 100_000, spill_format="parquet"):
+        self.left = left
+        self.key = key
+        self.decide = decide
+        self.temp_dir = temp_dir
+        self.buffer_mb = buffer_mb
+        self.sample_rows = sample_rows
+        self.batch_rows = batch_rows
+        self.spill_format = spill_format
+        self.stats = {}
+        self._node = None
+        self._pipe = None
+
+    @property
+    def ordering(self) -> list:
+        return self._node.ordering if self._node is not None else []
+
+    def _observe_file(self, cdf, columns):
+        observed = _observed("file", cdf.num_rows, cdf.decoded_mb(columns) * 1024 * 1024,
+                             cdf.sample_column(self.key, self.sample_rows))
+        return observed, Scan(cdf, columns, self.batch_rows)
+
+    def _observe(self):
+        got = self.left.materialize() if hasattr(self.left, "materialize") else None
+        if got is not None:
+            cdf, columns = got
+            if cdf is None:
+                return _observed("file", 0, 0, pd.Series([], dtype="float64")), Tables([])
+            return self._observe_file(cdf, columns)
+        tables, nbytes, rows, samples, writer = [], 0, 0, [], None
+        per_batch = max(1, self.sample_rows // 10)
+        for tbl in self.left.batches():
+            if writer is None and nbytes + tbl.nbytes > self.buffer_mb * 1024 * 1024:
+                cdf = self._pipe = ColumnarDbFile(f"pipe_{uuid.uuid4().hex}", file_dir=self.temp_dir,
+                                                  file_format=self.spill_format)
+                writer = cdf.writer(tbl.schema)
+                for t in tables:
+                    writer.write_table(t)
+                tables = []
+            if writer is None:
+                tables.append(tbl)
+            else:
+                writer.write_table(tbl)
+            keys = key_array(tbl.column(self.key))
+            samples.append(keys[np.linspace(0, len(keys) - 1, min(per_batch, len(keys))).astype(int)])
+            nbytes += tbl.nbytes
+            rows += tbl.num_rows
+        if writer is not None:
+            writer.close()
+            if self.left.ordering:
+                cdf.write_meta(sort_order=self.left.ordering)
+            return self._observe_file(cdf, None)
+        sample = pd.Series(np.concatenate(samples) if samples else []).dropna()
+        return _observed("memory", rows, nbytes, sample), Tables(tables, self.left.ordering)
+
+    def batches(self):
+        try:
+            observed, source = self._observe()
+            node = self._node = self.decide(observed, source)
+            yield from node.batches()
+        finally:
+            if self._pipe is not None:
+                _remove_pipe(self._pipe)
+                self._pipe = None
+        self.stats = dict(node.stats, observed=observed)
@@ -1,28 +1,309 @@
-import os
-from .utils import parquet_metadata
+import itertools, math
+import numpy as np
+import psutil
+import pyarrow as pa
+from .catalog import table_metadata
+from .narrowing import narrowed_types
+from .storage import ColumnarDbFile, co_bucketed, fragment_paths
+from .utils import parquet_column_stats, parquet_metadata
 
 def choose_algo(size_smaller_mb: float, avail_mem_mb: float = 10_000, overhead: float = 5.0) -> str:
     return "HPJ" if size_smaller_mb * overhead < avail_mem_mb else "SMJ"
 
+def choose_partitions(size_build_mb: float, avail_mem_mb: float = 10_000, overhead: float = 5.0) -> int:
+    # Enough partitions that one partition's build side fits the budget
+    return max(1, math.ceil(size_build_mb * overhead / avail_mem_mb))
+
+def preaggregation(parsed_query: dict) -> dict | None:
+    """
+    Eager aggregation below the Users join: when the query groups by Songs columns, averages a
+    Users column and counts distinct Listens.user_id (the Users join key), Listens can be collapsed
+    to (song_id, user_id, listen_count) first; AVG becomes a listen_count-weighted average.
+    """
+    alias = {a: t for t, a in parsed_query["tables"].items()}
+    if any(alias.get(c.split(".")[0]) != "Songs" for c in parsed_query["group_by"]):
+        return None
+    users_join = next((j for j in parsed_query["joins"] if j["right"] == "Users"), None)
+    if users_join is None or users_join["left"] != "Listens":
+        return None
+    for agg in parsed_query["aggregations"].values():
+        t, col = agg["expr"].split(".")
+        if agg["func"] == "AVG" and alias.get(t) == "Users":
+            continue
+        if agg["func"] in ("COUNT_DISTINCT", "APPROX_COUNT_DISTINCT") and alias.get(t) == "Listens" \
+                and col == users_join["left_key"]:
+            continue
+        return None
+    songs_join = next(j for j in parsed_query["joins"] if j["right"] == "Listens")
+    return {"table": "Listens", "keys": [songs_join["right_key"], users_join["left_key"]], "count_col": "listen_count"}
+
+def late_columns(parsed_query: dict) -> dict:
+    """Needed columns referenced only by GROUP BY (no join key, select or aggregate): fetchable after aggregation."""
+    alias = {a: t for t, a in parsed_query["tables"].items()}
+    used = set(parsed_query["select"]) | {a["expr"] for a in parsed_query["aggregations"].values()}
+    used |= {c for c, _ in parsed_query["order_by"]}
+    keys = {(j[side], j[f"{side}_key"]) for j in parsed_query["joins"] for side in ("left", "right")}
+    late = {}
+    for ref in parsed_query["group_by"]:
+        a, col = ref.split(".")
+        t = alias[a]
+        if ref not in used and (t, col) not in keys:
+            late.setdefault(t, []).append(col)
+    return late
+
+def expected_distinct_pairs(n_rows: int, n_songs: int, n_users: int) -> float:
+    # Distinct (song, user) pairs among n_rows uniform independent draws from n_songs * n_users combinations
+    combos = max(n_songs * n_users, 1)
+    return combos * -math.expm1(-n_rows / combos)
+
+def step_ordering(step: dict, left_ordering: list, right_ordering: list) -> list:
+    """Output ordering of a join step as the executor runs it (see pipeline operators' `ordering`)."""
+    if step.get("bucketed"):
+        return []
+    if step["algo"] == "SMJ":
+        return [step["left_key"]]
+    if step.get("partitions", 1) <= 1:
+        # Pipelined hash join: probe row order
+        return right_ordering if step.get("build") == "left" else left_ordering
+    return []
+
+def aggregation_strategy(parsed_query: dict, ordering: list) -> dict:
+    """Sort-based streaming aggregation when the aggregation input is sorted on a GROUP BY column, else hash."""
+    group_cols = [ref.split(".")[1] for ref in parsed_query["group_by"]]
+    if ordering and ordering[0] in group_cols:
+        return {"strategy": "sort", "key": ordering[0], "input_ordering": list(ordering)}
+    return {"strategy": "hash", "input_ordering": list(ordering)}
+
+def detect_memory_budget_mb(fraction: float = 0.5) -> float:
+    """Planner memory budget: a fraction of the memory currently available on this machine."""
+    return psutil.virtual_memory().available * fraction / (1024*1024)
+
+def column_ndv(stats: dict, rows: int) -> int:
+    # Catalog NDV estimate, else writer's distinct count / integer min-max range / all non-null values differ
+    non_null = max(rows - stats["nulls"], 0)
+    if stats.get("ndv") is not None:
+        return min(stats["ndv"], non_null)
+    ndv = non_null
+    if stats["distinct"] is not None:
+        ndv = min(ndv, stats["distinct"])
+    if isinstance(stats["min"], int) and isinstance(stats["max"], int):
+        ndv = min(ndv, stats["max"] - stats["min"] + 1)
+    return max(ndv, 1 if non_null else 0)
+
+# In-memory width of fixed-size Parquet physical types; variable-size columns use decoded bytes per row
+_FIXED_WIDTH = {"BOOLEAN": 1, "INT32": 4, "FLOAT": 4, "INT64": 8, "DOUBLE": 8, "INT96": 12}
+
+def column_width(stats: dict, rows: int, read_type: pa.DataType | None = None) -> float:
+    # read_type: the narrower type the column is scanned as (narrowed integers, dictionary strings)
+    if read_type is not None and pa.types.is_integer(read_type):
+        return read_type.bit_width / 8
+    if stats.get("avg_width") is not None:
+        width = max(float(stats["avg_width"]), 1.0)
+    else:
+        width = float(_FIXED_WIDTH.get(stats["type"], max(stats["bytes"] / max(rows, 1), 1.0)))
+    if read_type is not None and pa.types.is_dictionary(read_type):
+        # One index per row, each distinct value once
+        return read_type.index_type.bit_width / 8 + width * column_ndv(stats, rows) / max(rows, 1)
+    return width
+
+def histogram_fraction(hist: list, lo: float, hi: float) -> float:
+    """Share of rows in [lo, hi] under an equi-depth histogram (uniform within each bucket)."""
+    b = np.asarray(hist, dtype=np.float64)
+    if len(b) < 2:
+        return 1.0
+    left, right = b[:-1], b[1:]
+    width = right - left
+    overlap = np.clip(np.minimum(right, hi) - np.maximum(left, lo), 0, None)
+    point = ((left >= lo) & (left <= hi)).astype(np.float64)
+    return float(np.where(width > 0, overlap / np.where(width > 0, width, 1), point).mean())
+
+def base_relation(table: str, meta: dict, columns, read_types: dict | None = None) -> dict:
+    """Estimated projection of one table: rows, bytes per row, NDV and (catalog) histogram per column."""
+    rows = meta["rows"]
+    stats = meta["column_stats"]
+    read_types = read_types or {}
+    return {"tables": [table], "rows": rows,
+            "col_bytes": {c: column_width(stats[c], rows, read_types.get(c)) for c in columns},
+            "ndv": {c: column_ndv(stats[c], rows) for c in columns},
+            "hist": {c: stats[c]["histogram"] for c in columns if stats[c].get("histogram")}}
+
+def relation_mb(rel: dict) -> float:
+    return rel["rows"] * sum(rel["col_bytes"].values()) / (1024*1024)
+
+def join_relation(left: dict, right: dict, left_key: str, right_key: str) -> dict:
+    """
+    Equi-join estimate |L||R| / max(NDV_L(k), NDV_R(k)); with key histograms on both sides, only
+    the rows (and NDV) inside the other side's key range count. Output columns follow join_output naming.
+    """
+    f_l = f_r = 1.0
+    h_l, h_r = left.get("hist", {}).get(left_key), right.get("hist", {}).get(right_key)
+    if h_l and h_r:
+        f_l, f_r = histogram_fraction(h_l, h_r[0], h_r[-1]), histogram_fraction(h_r, h_l[0], h_l[-1])
+    ndv_l, ndv_r = left["ndv"][left_key] * f_l, right["ndv"][right_key] * f_r
+    rows = left["rows"] * f_l * right["rows"] * f_r / max(ndv_l, ndv_r, 1)
+    col_bytes, ndv, hist = dict(left["col_bytes"]), dict(left["ndv"]), dict(left.get("hist", {}))
+    for c, b in right["col_bytes"].items():
+        if c == right_key and c == left_key:
+            continue  # shared key column appears once
+        name = c if c not in col_bytes else f"{c}_y"
+        col_bytes[name], ndv[name] = b, right["ndv"][c]
+        if c in right.get("hist", {}):
+            hist[name] = right["hist"][c]
+    ndv[left_key] = max(int(min(ndv_l, ndv_r)), 1)
+    ndv = {c: min(n, max(int(rows), 1)) for c, n in ndv.items()}
+    return {"tables": left["tables"] + right["tables"], "rows": rows, "col_bytes": col_bytes, "ndv": ndv,
+            "hist": hist}
+
+def join_orders(joins: list):
+    """Left-deep join orders without cross products; the query's written order comes first."""
+    edges = {}
+    for j in joins:
+        edges[(j["left"], j["right"])] = (j["left_key"], j["right_key"])
+        edges[(j["right"], j["left"])] = (j["right_key"], j["left_key"])
+    tables = list(dict.fromkeys(t for j in joins for t in (j["left"], j["right"])))
+    written = [joins[0]["left"], joins[0]["right"]] + [j["right"] for j in joins[1:]]
+    for order in [written] + [list(p) for p in itertools.permutations(tables) if list(p) != written]:
+        steps = []
+        for i in range(1, len(order)):
+            prev = [t for t in order[:i] if (t, order[i]) in edges]
+            if not prev:
+                break
+            lk, rk = edges[(prev[0], order[i])]
+            steps.append({"left": order[0] if i == 1 else "__prev__", "right": order[i],
+                          "left_key": lk, "right_key": rk})
+        else:
+            yield order, steps
+
+def step_cost_mb(build_mb: float, probe_mb: float, out_mb: float, partitions: int) -> float:
+    # Read both inputs and produce the output; a partitioned (spilling) join writes and rereads its inputs once more
+    io = build_mb + probe_mb
+    return io + out_mb + (2 * io if partitions > 1 else 0.0)
+
 class QueryPlanner:
     """
-    Uses Parquet metadata + hardcoded query semantics to:
-    - choose join order (Songs ⨝ Listens) → ⨝ Users
-    - pick HPJ vs SMJ per step
-    - determine exact columns to read
+    Cost-based planner over table statistics (the ANALYZE catalog when it is fresh, else Parquet
+    footer metadata) and the parsed query:
+    - projection sizes from average value widths / column-chunk decoded bytes, key NDVs and histograms
+    - scan-time type narrowing (narrow_types): integers to the smallest width their min/max allow,
+      low-cardinality strings to dictionaries; sizes are estimated at the narrowed widths
+    - join cardinalities |L||R| / max(NDV) (histogram range overlap when known) and enumeration of left-deep join orders
+      (cheapest total step cost wins; near-ties keep the written order (Songs ⨝ Listens) ⨝ Users)
+    - per step: build side, HPJ vs SMJ and partition count against the memory budget
+    - exact columns to read
     """
-    def plan(self, parquet_paths: dict, parsed_query: dict, avail_mem_mb: float = 10_000):
-        meta = {t: parquet_metadata(p) for t, p in parquet_paths.items()}
+    overhead = 5.0
+    # Orders within 5% or 64KB of the best so far count as ties (estimates are rough; earlier order wins)
+    tie_fraction, tie_mb = 0.05, 1 / 16
+    # Observed top-key share of a join input that turns on skew handling
+    skew_share = 0.01
+
+    def __init__(self, use_catalog: bool = True, narrow_types: bool = True):
+        self.use_catalog = use_catalog
+        self.narrow_types = narrow_types
+
+    def plan(self, parquet_paths: dict, parsed_query: dict, avail_mem_mb: float | None = None):
+        if avail_mem_mb is None:
+            avail_mem_mb = detect_memory_budget_mb()
+        meta = {}
+        for t, p in parquet_paths.items():
+            files = fragment_paths(p)  # the table file and any appended fragments
+            meta[t] = table_metadata(p, self.use_catalog) \
+                or dict(parquet_metadata(files), column_stats=parquet_column_stats(files), stats_source="footer")
         cols = parsed_query["needed_columns"]
+        narrowing = {t: narrowed_types(ColumnarDbFile.from_path(parquet_paths[t]), cols[t], meta[t]["column_stats"])
+                     if self.narrow_types else {} for t in cols}
+        rels = {t: base_relation(t, meta[t], cols[t], narrowing[t]) for t in cols}
+
+        # Pre-aggregating Listens is an in-memory hash aggregate: only when its projection fits the budget
+        # and the expected number of distinct (song, user) pairs is at least 10% below the listen count
+        pre = preaggregation(parsed_query)
+        preagg = {"applied": False}
+        if pre is not None:
+            listens = rels[pre["table"]]
+            pairs = expected_distinct_pairs(listens["rows"], *(listens["ndv"][k] for k in pre["keys"]))
+            applied = pairs <= 0.9 * listens["rows"] and relation_mb(listens) * self.overhead < avail_mem_mb
+            preagg = dict(pre, applied=applied, est_rows_out=int(pairs))
+            if applied:
+                rels[pre["table"]] = dict(listens, rows=pairs,
+                                          col_bytes=dict(listens["col_bytes"], **{pre["count_col"]: 8.0}),
+                                          ndv=dict(listens["ndv"], **{pre["count_col"]: 1}))
+
+        # Pairs of base tables stored co-bucketed on their join keys (pre-aggregated inputs lose the layout)
+        files = {t: ColumnarDbFile.from_path(p) for t, p in parquet_paths.items()
+                 if not (preagg["applied"] and t == preagg["table"])}
+        bucketed = {}
+        for j in parsed_query["joins"]:
+            if j["left"] in files and j["right"] in files:
+                n = co_bucketed(files[j["left"]], files[j["right"]], j["left_key"], j["right_key"])
+                if n:
+                    bucketed[(j["left"], j["right"], j["left_key"], j["right_key"])] = n
+                    bucketed[(j["right"], j["left"], j["right_key"], j["left_key"])] = n
+
+        best, candidates = None, []
+        for order, steps in join_orders(parsed_query["joins"]):
+            cost, rel = 0.0, None
+            for step in steps:
+                left = rel if step["left"] == "__prev__" else rels[step["left"]]
+                right = rels[step["right"]]
+                rel = join_relation(left, right, step["left_key"], step["right_key"])
+                left_mb, right_mb = relation_mb(left), relation_mb(right)
+                build_mb = min(left_mb, right_mb)
+                step["build"] = "left" if left_mb <= right_mb else "right"
+                step["algo"] = choose_algo(build_mb, avail_mem_mb, self.overhead)
+                step["partitions"] = choose_partitions(build_mb, avail_mem_mb, self.overhead)
+                step["est_rows"], step["est_mb"] = int(rel["rows"]), relation_mb(rel)
+                step["skew"] = True  # HPJ samples for heavy hitters unless an observed input rules skew out
+                n_buckets = bucketed.get((step["left"], step["right"], step["left_key"], step["right_key"]))
+                if n_buckets and choose_partitions(build_mb / n_buckets, avail_mem_mb, self.overhead) == 1:
+                    # Co-bucketed base tables whose buckets fit in memory: bucket-wise hash join, no partition phase
+                    step["algo"], step["bucketed"] = "HPJ", n_buckets
+                step["planned"] = {k: step[k] for k in ("algo", "partitions", "build", "skew")}
+                cost += step_cost_mb(build_mb, max(left_mb, right_mb), step["est_mb"],
+                                     1 if step.get("bucketed") else step["partitions"])
+            candidates.append({"order": order, "cost_mb": cost})
+            if best is None or cost < best[0] - max(self.tie_fraction * best[0], self.tie_mb):
+                best = (cost, order, steps)
+        _, order, steps = best
+
+        late = {"columns": late_columns(parsed_query), "applied": False}
 
-        # naive in-memory size est: each int64 ≈ 8B/val; MB = rows*8/1e6 * num_needed_cols
-        est_mb = {t: (meta[t]["rows"] * 8 * len(cols[t])) / (1024*1024) for t in cols}
-        step1 = {"left": "Songs", "right": "Listens", "left_key": "song_id", "right_key": "song_id"}
-        step2 = {"left": "__prev__", "right": "Users",  "left_key": "user_id", "right_key": "user_id"}
+        # Predicted ordering of the final join output decides hash vs sort-based aggregation
+        # (a pre-aggregated table has no ordering; a base table's sort order counts as far as its columns are read)
+        ordering = {t: list(itertools.takewhile(lambda c: c in cols[t], files[t].sort_order or [])) if t in files else []
+                    for t in cols}
+        prev = []
+        for step in steps:
+            left = prev if step["left"] == "__prev__" else ordering[step["left"]]
+            prev = step_ordering(step, left, ordering[step["right"]])
 
-        algo1 = choose_algo(min(est_mb["Songs"], est_mb["Listens"]), avail_mem_mb)
-        algo2 = choose_algo(min(est_mb["Users"], est_mb["Listens"]), avail_mem_mb)
-        step1["algo"] = algo1
-        step2["algo"] = algo2
+        return {"columns": cols, "steps": steps, "metadata": meta, "memory_budget_mb": avail_mem_mb,
+                "table_estimates": {t: {"rows": int(r["rows"]), "mb": relation_mb(r)} for t, r in rels.items()},
+                "join_order": order, "join_order_candidates": candidates, "adaptive": [],
+                "preaggregate": preagg, "late_materialize": late, "narrowing": narrowing,
+                "aggregation": aggregation_strategy(parsed_query, prev)}
 
-        return {"columns": cols, "steps": [step1, step2], "metadata": meta}
+    def replan(self, plan: dict, i: int, observed: dict) -> dict:
+        """
+        Re-decide step i once its left input (the previous step's output) has been observed:
+        build side, HPJ/SMJ and partitions from the actual size, skew handling from the key sample.
+        Settings changed after planning (e.g. a forced algorithm) are left alone. Each call is
+        recorded in plan["adaptive"].
+        """
+        step = plan["steps"][i]
+        budget = plan["memory_budget_mb"]
+        left_mb, right_mb = observed["mb"], plan["table_estimates"][step["right"]]["mb"]
+        build_mb = min(left_mb, right_mb)
+        new = {"build": "left" if left_mb <= right_mb else "right",
+               "algo": choose_algo(build_mb, budget, self.overhead),
+               "partitions": choose_partitions(build_mb, budget, self.overhead),
+               "skew": observed["top_key_share"] >= self.skew_share}
+        planned = step.get("planned", {})
+        changes = {}
+        for k, v in new.items():
+            if k in planned and step[k] != planned[k]:
+                continue
+            if step.get(k, v) != v:
+                changes[k] = [step[k], v]
+            step[k] = v
+        plan["adaptive"].append({"step": i, "est_rows": step.get("est_rows"), "observed": observed, "changes": changes})
+        return step
@@ -1,150 +1,190 @@
-import os, uuid, heapq
-import pandas as pd
+import os, uuid
+import numpy as np
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
 from .storage import ColumnarDbFile
+from .background_io import operator_io, read_ahead
+from .bloom import RuntimeJoinFilter
+from .spill import resolve_format
+from .utils import expand_ranges, join_output, key_array, parallel_map
 
 class SortMergeJoin:
     """
     External sort both sides by key; streaming merge that handles duplicates (many-to-many).
+    An input whose recorded sort order starts with its join key is merged as is (no sort).
+    The output is ordered by the join key and recorded as such.
     """
-    def __init__(self, run_rows: int = 250_000, merge_batch_rows: int = 200_000):
+    def __init__(self, run_rows: int = 250_000, merge_batch_rows: int = 200_000, num_workers: int = 1,
+                 join_filter: bool = False, spill_format="parquet", io_depth: int = 0):
         self.run_rows = run_rows
         self.merge_batch_rows = merge_batch_rows
+        self.num_workers = num_workers  # runs sorted and written concurrently on a thread pool
+        self.join_filter = join_filter  # Bloom/bitmap filter from the smaller side's keys, applied to the other
+        self.spill_format = resolve_format(spill_format)  # sort runs, sorted sides and the join output
+        self.io_depth = io_depth  # background reads / writes, see background_io.operator_io
+        self._io, self._writes = operator_io(io_depth)
+        self.stats = {}
 
-    def _external_sort(self, cdf: ColumnarDbFile, key: str, out_dir: str, tag: str, columns=None) -> str:
+    def _external_sort(self, cdf: ColumnarDbFile, key: str, out_dir: str, tag: str, columns=None,
+                       collect=None, keep=None) -> str:
         os.makedirs(out_dir, exist_ok=True)
-        pf = pq.ParquetFile(cdf.path)
-        run_paths = []
-        for batch in pf.iter_batches(batch_size=self.run_rows, columns=columns):
-            df = batch.to_pandas().sort_values(key, kind="mergesort")
-            p = os.path.join(out_dir, f"{tag}_run_{uuid.uuid4().hex}.parquet")
-            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), p, compression="snappy")
-            run_paths.append(p)
-        out_path = os.path.join(out_dir, f"{tag}_sorted.parquet")
-        self._kway_merge(run_paths, out_path, key)
+        schema = cdf.schema
+        schema = schema if columns is None else pa.schema([schema.field(c) for c in columns])
+        def batches():
+            for batch in read_ahead(cdf.iter_batches(columns, self.run_rows), self.io_depth, self._io):
+                tbl = pa.Table.from_batches([batch])
+                if collect is not None:
+                    collect.collect(tbl, key)
+                if keep is not None:
+                    tbl = keep.apply(tbl, key)
+                if tbl.num_rows:
+                    yield tbl
+        def write_run(tbl):
+            p = os.path.join(out_dir, f"{tag}_run_{uuid.uuid4().hex}{self.spill_format.suffix}")
+            self.spill_format.write_table(tbl.sort_by(key), p)
+            return p
+        run_paths = list(parallel_map(write_run, batches(), self.num_workers))
+        out_path = os.path.join(out_dir, f"{tag}_sorted{self.spill_format.suffix}")
+        self._kway_merge(run_paths, out_path, key, schema)
         for p in run_paths: os.remove(p)
         return out_path
 
-    def _kway_merge(self, paths, out_path, key):
-        readers = [pq.ParquetFile(p) for p in paths]
-        iters = []
-        for r in readers:
-            gen = r.iter_batches(batch_size=self.merge_batch_rows)
-            first = next(gen, None)
-            iters.append({"gen": gen, "df": first.to_pandas() if first is not None else None, "i": 0})
-        heap = []
-        def push(idx):
-            row = iters[idx]["df"].iloc[iters[idx]["i"]]
-            heapq.heappush(heap, (row[key], idx, row))
-        for i, st in enumerate(iters):
-            if st["df"] is not None and len(st["df"]) > 0:
-                push(i)
-        writer, out_buf = None, []
-        while heap:
-            _, i, row = heapq.heappop(heap)
-            out_buf.append(row)
-            iters[i]["i"] += 1
-            if iters[i]["i"] >= len(iters[i]["df"]):
-                nxt = next(iters[i]["gen"], None)
-                if nxt is None:
-                    iters[i]["df"] = None
-                else:
-                    iters[i]["df"] = nxt.to_pandas()
-                iters[i]["i"] = 0
-            if iters[i]["df"] is not None and len(iters[i]["df"]) > 0:
-                push(i)
-            if len(out_buf) >= self.merge_batch_rows:
-                tbl = pa.Table.from_pandas(pd.DataFrame(out_buf), preserve_index=False)
-                if writer is None:
-                    writer = pq.ParquetWriter(out_path, tbl.schema, compression="snappy")
-                writer.write_table(tbl); out_buf.clear()
-        if out_buf:
-            tbl = pa.Table.from_pandas(pd.DataFrame(out_buf), preserve_index=False)
+    @staticmethod
+    def _presorted(cdf: ColumnarDbFile, key: str) -> bool:
+        order = cdf.sort_order
+        return bool(order) and order[0] == key
+
+    def _kway_merge(self, paths, out_path, key, schema=None):
+        """
+        Batch-level merge of sorted runs. Each step takes the smallest last-buffered key among runs
+        that still have unread data as a safe bound, emits every buffered row <= bound from all runs
+        with one concat + stable sort, and writes the Arrow table directly.
+        """
+        runs = [self._stream(ColumnarDbFile.from_path(p), key) for p in paths]
+        writer = None
+        while True:
+            for r in runs:
+                while len(r) == 0 and not r.done:
+                    r.fill()
+            live = [r for r in runs if len(r)]
+            if not live:
+                break
+            open_lasts = [r.keys[-1] for r in live if not r.done]
+            bound = min(open_lasts) if open_lasts else None
+            pieces = [r.pop(len(r) if bound is None else np.searchsorted(r.keys, bound, "right"))[0] for r in live]
+            tbl = pa.concat_tables([p for p in pieces if p.num_rows]).sort_by(key)
             if writer is None:
-                writer = pq.ParquetWriter(out_path, tbl.schema, compression="snappy")
+                writer = self._writes.wrap(self.spill_format.writer(out_path, tbl.schema))
             writer.write_table(tbl)
-        if writer: writer.close()
+        if writer:
+            writer.close()
+            self._writes.flush()
+        else:
+            schema = schema if schema is not None else self.spill_format.schema(paths[0])
+            self.spill_format.write_table(schema.empty_table(), out_path)
+
+    def _stream(self, cdf: ColumnarDbFile, key: str, columns=None) -> "_SortedStream":
+        return _SortedStream(read_ahead(cdf.iter_batches(columns, self.merge_batch_rows), self.io_depth, self._io), key)
 
     def join(self, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str,
              temp_dir="temp", cols_left=None, cols_right=None) -> ColumnarDbFile:
+        self.stats = {}
+        self._io, self._writes = operator_io(self.io_depth)
+        try:
+            return self._join(left, right, left_key, right_key, temp_dir, cols_left, cols_right)
+        finally:
+            self._writes.close()  # queued output writes land before the output is handed back
+            self.stats["io"] = self._io.as_dict()
+
+    def _join(self, left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str,
+              temp_dir: str, cols_left, cols_right) -> ColumnarDbFile:
         work = os.path.join(temp_dir, f"smj_{uuid.uuid4().hex}")
         os.makedirs(work, exist_ok=True)
-        L_sorted = self._external_sort(left, left_key, work, "L", columns=cols_left)
-        R_sorted = self._external_sort(right, right_key, work, "R", columns=cols_right)
+        l_pre, r_pre = self._presorted(left, left_key), self._presorted(right, right_key)
+        self.stats["presorted"] = [side for side, pre in (("left", l_pre), ("right", r_pre)) if pre]
+        if self.join_filter and not (l_pre or r_pre):
+            # Sort the smaller side first; its keys filter the other side's rows before they hit a run
+            jf = RuntimeJoinFilter()
+            if left.decoded_mb(cols_left) <= right.decoded_mb(cols_right):
+                L_sorted = self._external_sort(left, left_key, work, "L", columns=cols_left, collect=jf)
+                R_sorted = self._external_sort(right, right_key, work, "R", columns=cols_right, keep=jf)
+            else:
+                R_sorted = self._external_sort(right, right_key, work, "R", columns=cols_right, collect=jf)
+                L_sorted = self._external_sort(left, left_key, work, "L", columns=cols_left, keep=jf)
+            self.stats["join_filter"] = jf.stats()
+            cols_left = cols_right = None
+        else:
+            # A pre-sorted side is streamed straight from its file (the filter needs a sort pass to build/apply);
+            # it is read through its own ColumnarDbFile, so read-time narrowing still applies
+            L_sorted = left if l_pre else self._external_sort(left, left_key, work, "L", columns=cols_left)
+            R_sorted = right if r_pre else self._external_sort(right, right_key, work, "R", columns=cols_right)
+            cols_left, cols_right = (cols_left if l_pre else None), (cols_right if r_pre else None)
 
-        out = ColumnarDbFile("SMJ_out", file_dir=work)
+        out = ColumnarDbFile("SMJ_out", file_dir=work, file_format=self.spill_format)
         writer = None
-        lpf, rpf = pq.ParquetFile(L_sorted), pq.ParquetFile(R_sorted)
-        li, ri = lpf.iter_batches(batch_size=self.merge_batch_rows), rpf.iter_batches(batch_size=self.merge_batch_rows)
-        ldf = next(li, None); ldf = ldf.to_pandas() if ldf is not None else None
-        rdf = next(ri, None); rdf = rdf.to_pandas() if rdf is not None else None
-        lp = rp = 0
-        out_buf = []
+        L = self._stream(L_sorted if l_pre else ColumnarDbFile.from_path(L_sorted), left_key, cols_left)
+        R = self._stream(R_sorted if r_pre else ColumnarDbFile.from_path(R_sorted), right_key, cols_right)
+        while True:
+            for side in (L, R):
+                while len(side) == 0 and not side.done:
+                    side.fill()
+            if not (len(L) and len(R)):
+                break
+            # Every row strictly below the smallest "last buffered key" of an unfinished side is complete
+            # on both sides, so key groups spanning batch boundaries are never split.
+            open_lasts = [s.keys[-1] for s in (L, R) if not s.done]
+            if open_lasts:
+                bound = min(open_lasts)
+                nl, nr = np.searchsorted(L.keys, bound, "left"), np.searchsorted(R.keys, bound, "left")
+            else:
+                nl, nr = len(L), len(R)
+            (ltbl, lkeys), (rtbl, rkeys) = L.pop(nl), R.pop(nr)
+            if len(lkeys) and len(rkeys):
+                # Equal-key runs via searchsorted; cross product of each run emitted in one shot
+                lo, hi = np.searchsorted(rkeys, lkeys, "left"), np.searchsorted(rkeys, lkeys, "right")
+                lrows = np.repeat(np.arange(len(lkeys)), hi - lo)
+                if len(lrows):
+                    tbl = join_output(ltbl, rtbl, lrows, expand_ranges(lo, hi - lo), left_key, right_key)
+                    if writer is None:
+                        writer = self._writes.wrap(out.writer(tbl.schema))
+                    writer.write_table(tbl)
+            if not open_lasts:
+                break
+            for side in (L, R):
+                if not side.done and len(side) and side.keys[-1] == bound:
+                    side.fill()
+        if writer:
+            writer.close()
+            self._writes.flush()  # the fingerprint is of the finished file
+            out.write_meta(sort_order=[left_key])
+        return out
 
-        def refill_left():
-            nonlocal ldf, lp
-            batch = next(li, None)
-            ldf = batch.to_pandas() if batch is not None else None; lp = 0
 
-        def refill_right():
-            nonlocal rdf, rp
-            batch = next(ri, None)
-            rdf = batch.to_pandas() if batch is not None else None; rp = 0
+class _SortedStream:
+    """Rows of a key-sorted file (an iterator of its batches) that the merge has read but not yet consumed."""
+    def __init__(self, batches, key: str):
+        self._batches = iter(batches)
+        self.key = key
+        self.buf = None
+        self.keys = np.empty(0)
+        self.done = False
 
-        while ldf is not None and rdf is not None and lp < len(ldf) and rp < len(rdf):
-            lv, rv = ldf.iloc[lp][left_key], rdf.iloc[rp][right_key]
-            if lv < rv:
-                lp += 1
-                if lp >= len(ldf): refill_left()
-            elif lv > rv:
-                rp += 1
-                if rp >= len(rdf): refill_right()
-            else:
-                # Collect full equal-key groups across batch boundaries on both sides
-                match_key = lv
-                # Left group
-                l_parts = []
-                while True:
-                    lstart = lp
-                    while lp < len(ldf) and ldf.iloc[lp][left_key] == match_key: lp += 1
-                    l_parts.append(ldf.iloc[lstart:lp])
-                    if lp < len(ldf):  # next left value differs
-                        break
-                    # need to refill and check if next batch continues same key
-                    prev_ldf = ldf
-                    refill_left()
-                    if ldf is None or len(ldf) == 0 or ldf.iloc[lp if lp < len(ldf) else 0][left_key] != match_key:
-                        break
-                Lgrp = pd.concat(l_parts, ignore_index=True) if len(l_parts) > 1 else l_parts[0]
-                # Right group
-                r_parts = []
-                while True:
-                    rstart = rp
-                    while rp < len(rdf) and rdf.iloc[rp][right_key] == match_key: rp += 1
-                    r_parts.append(rdf.iloc[rstart:rp])
-                    if rp < len(rdf):
-                        break
-                    prev_rdf = rdf
-                    refill_right()
-                    if rdf is None or len(rdf) == 0 or rdf.iloc[rp if rp < len(rdf) else 0][right_key] != match_key:
-                        break
-                Rgrp = pd.concat(r_parts, ignore_index=True) if len(r_parts) > 1 else r_parts[0]
-                out_buf.append(Lgrp.merge(Rgrp, left_on=left_key, right_on=right_key, how="inner"))
-                if len(out_buf) >= 16:
-                    chunk = pd.concat(out_buf, ignore_index=True)
-                    tbl = pa.Table.from_pandas(chunk, preserve_index=False)
-                    if writer is None:
-                        writer = pq.ParquetWriter(out.path, tbl.schema, compression="snappy")
-                    writer.write_table(tbl); out_buf.clear()
-                if ldf is not None and lp >= len(ldf): refill_left()
-                if rdf is not None and rp >= len(rdf): refill_right()
+    def __len__(self):
+        return len(self.keys)
 
-        if out_buf:
-            chunk = pd.concat(out_buf, ignore_index=True)
-            tbl = pa.Table.from_pandas(chunk, preserve_index=False)
-            if writer is None:
-                writer = pq.ParquetWriter(out.path, tbl.schema, compression="snappy")
-            writer.write_table(tbl)
-        if writer: writer.close()
-        return out
+    def fill(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            self.done = True
+            return
+        tbl = pa.Table.from_batches([batch])
+        tbl = tbl.filter(pc.is_valid(tbl.column(self.key)))  # null keys never join
+        self.buf = tbl if self.buf is None else pa.concat_tables([self.buf, tbl])
+        self.keys = key_array(self.buf.column(self.key))
+
+    def pop(self, n: int):
+        if self.buf is None:
+            return None, self.keys[:0]
+        head, head_keys = self.buf.slice(0, n), self.keys[:n]
+        self.buf, self.keys = self.buf.slice(n), self.keys[n:]
+        return head, head_keys
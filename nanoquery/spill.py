@@ -0,0 +1,167 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .utils import key_array, parquet_uncompressed_mb, sample_key_column
+
+class ParquetFormat:
+    """Parquet: compressed, column-pruned reads, footer statistics. The format for durable tables."""
+    name, suffix = "parquet", ".parquet"
+
+    def __init__(self, compression: str | None = "snappy"):
+        self.compression = compression
+
+    def writer(self, path: str, schema: pa.Schema):
+        return pq.ParquetWriter(path, schema, compression=self.compression)
+
+    def write_table(self, tbl: pa.Table, path: str):
+        pq.write_table(tbl, path, compression=self.compression)
+
+    def schema(self, path: str) -> pa.Schema:
+        return pq.read_schema(path)
+
+    def num_rows(self, path: str) -> int:
+        return pq.ParquetFile(path).metadata.num_rows
+
+    def read(self, path: str, columns=None, dictionary=None) -> pa.Table:
+        return pq.read_table(path, columns=columns, read_dictionary=dictionary)
+
+    def read_pandas(self, path: str, columns=None) -> pd.DataFrame:
+        return pd.read_parquet(path, columns=columns)
+
+    def iter_batches(self, path: str, columns=None, batch_rows: int = 100_000, dictionary=None):
+        # dictionary: columns to read as Arrow dictionaries straight from their Parquet dictionary pages
+        yield from pq.ParquetFile(path, read_dictionary=dictionary).iter_batches(batch_size=batch_rows, columns=columns)
+
+    def decoded_mb(self, path: str, columns=None) -> float:
+        return parquet_uncompressed_mb(path, columns)
+
+    def sample_column(self, path: str, key: str, sample_rows: int = 100_000) -> pd.Series:
+        return sample_key_column(path, key, sample_rows)
+
+
+class ArrowFormat:
+    """
+    Arrow IPC file format (Feather v2), uncompressed or LZ4-compressed, for files written once and
+    read back shortly after (spilled partitions, sort runs, intermediate join outputs). Writing
+    is a copy of the Arrow buffers; reads memory-map the file, and uncompressed batches are
+    zero-copy views of the mapping.
+    """
+    name, suffix = "arrow", ".arrow"
+
+    def __init__(self, compression: str | None = None):
+        self.compression = compression
+
+    def writer(self, path: str, schema: pa.Schema):
+        if any(pa.types.is_dictionary(f.type) for f in schema):
+            return _DictionaryFileWriter(path, schema, self.compression)
+        return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+
+    def write_table(self, tbl: pa.Table, path: str):
+        with self.writer(path, tbl.schema) as w:
+            w.write_table(tbl)
+
+    def _reader(self, path: str):
+        # Compression is recorded per buffer, so any ArrowFormat reads any IPC file
+        return pa.ipc.open_file(pa.memory_map(path, "r"))
+
+    def schema(self, path: str) -> pa.Schema:
+        return self._reader(path).schema
+
+    def num_rows(self, path: str) -> int:
+        return self._reader(path).count_rows()
+
+    def _batches(self, path: str, columns=None):
+        # Record batches projected to `columns` at read time: unselected columns are never decompressed
+        if columns is None:
+            reader = self._reader(path)
+        else:
+            names = self.schema(path).names
+            reader = pa.ipc.open_file(pa.memory_map(path, "r"), options=pa.ipc.IpcReadOptions(
+                included_fields=sorted(names.index(c) for c in columns)))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield batch if columns is None else batch.select(columns)
+
+    def read(self, path: str, columns=None, dictionary=None) -> pa.Table:
+        schema = self.schema(path)
+        schema = schema if columns is None else pa.schema([schema.field(c) for c in columns])
+        return pa.Table.from_batches(list(self._batches(path, columns)), schema=schema)
+
+    def read_pandas(self, path: str, columns=None) -> pd.DataFrame:
+        return self.read(path, columns).to_pandas()
+
+    def iter_batches(self, path: str, columns=None, batch_rows: int = 100_000, dictionary=None):
+        # Dictionary columns are stored as such; `dictionary` only matters for Parquet
+        for batch in self._batches(path, columns):
+            for off in range(0, batch.num_rows, batch_rows):
+                yield batch.slice(off, batch_rows)
+
+    def decoded_mb(self, path: str, columns=None) -> float:
+        return sum(b.nbytes for b in self._batches(path, columns)) / (1024*1024)
+
+    def sample_column(self, path: str, key: str, sample_rows: int = 100_000) -> pd.Series:
+        """Non-null keys from evenly spaced record batches, about sample_rows of them."""
+        reader = self._reader(path)
+        n = reader.num_record_batches
+        if n == 0:
+            return pd.Series([], dtype="float64")
+        avg_rows = max(1, reader.count_rows() // n)
+        picks = np.unique(np.linspace(0, n - 1, max(1, min(n, sample_rows // avg_rows))).astype(int))
+        keys = pa.chunked_array([reader.get_batch(int(i)).column(key) for i in picks])
+        return pd.Series(key_array(keys)).dropna()
+
+
+class _DictionaryFileWriter:
+    """
+    IPC file writer for schemas with dictionary columns. An IPC file holds one dictionary per column
+    that may only grow (delta batches), while incoming batches (e.g. Parquet row groups) each bring
+    their own: every batch is re-encoded against the column's dictionary so far plus its new values.
+    """
+    def __init__(self, path: str, schema: pa.Schema, compression: str | None = None):
+        self.schema = schema
+        self._writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(
+            compression=compression, emit_dictionary_deltas=True))
+        self._values = {}  # column index -> pd.Index of the dictionary written so far
+
+    def _unify(self, i: int, arr: pa.DictionaryArray) -> pa.DictionaryArray:
+        values = pd.Index(arr.dictionary.to_numpy(zero_copy_only=False))
+        known = self._values.get(i, values[:0])
+        pos = known.get_indexer(values)
+        new = np.flatnonzero(pos < 0)
+        if len(new):
+            pos[new] = len(known) + np.arange(len(new))
+            known = self._values[i] = known.append(values[new])
+        indices = pa.array(pos, type=arr.indices.type).take(arr.indices)  # null indices stay null
+        return pa.DictionaryArray.from_arrays(indices, pa.array(known, type=arr.dictionary.type))
+
+    def write_table(self, tbl: pa.Table):
+        for batch in tbl.cast(self.schema).to_batches():
+            cols = [self._unify(i, c) if pa.types.is_dictionary(c.type) else c for i, c in enumerate(batch.columns)]
+            self._writer.write_batch(pa.RecordBatch.from_arrays(cols, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+SPILL_FORMATS = {"parquet": ParquetFormat(), "arrow": ArrowFormat(), "arrow-lz4": ArrowFormat("lz4")}
+
+def resolve_format(fmt="parquet"):
+    """A format object, by name ("parquet", "arrow", "arrow-lz4") or passed through as is."""
+    if isinstance(fmt, str):
+        if fmt not in SPILL_FORMATS:
+            raise ValueError(f"unknown spill format {fmt!r}; expected one of {sorted(SPILL_FORMATS)}")
+        return SPILL_FORMATS[fmt]
+    return fmt
+
+def format_for_path(path: str):
+    """Format of an existing file, from its extension (Parquet unless .arrow / .feather)."""
+    ext = os.path.splitext(path)[1].lower()
+    return SPILL_FORMATS["arrow"] if ext in (".arrow", ".feather") else SPILL_FORMATS["parquet"]
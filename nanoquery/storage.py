@@ -1,29 +1,349 @@
-import os
+import copy, os, json, shutil, threading, uuid
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+from .spill import format_for_path, resolve_format
+from .hashing import HASH_PARTITIONS_VERSION, hash_partitions
+from .narrowing import narrow
+from .utils import file_fingerprint
+
+# Serializes manifest updates (appends, compaction swaps) within the process; one writer process per table
+_manifest_lock = threading.Lock()
+
+def _manifest_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".manifest.json"
+
+def _read_manifest(path: str) -> dict:
+    mp = _manifest_path(path)
+    if not os.path.exists(mp):
+        return {"version": 0, "fragments": [], "retired": []}
+    with open(mp) as f:
+        return json.load(f)
+
+def _write_manifest(path: str, manifest: dict, bump: bool = True) -> None:
+    # Readers see the old or the new fragment list, never a partial one. The version (part of
+    # table_fingerprint) moves only when the fragment list does
+    manifest = dict(manifest, version=manifest["version"] + bump)
+    tmp = _manifest_path(path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, _manifest_path(path))
+
+def _new_fragment(path: str) -> str:
+    # Fragment file name relative to the table's directory: <table>.fragments/<uuid>.parquet
+    name = os.path.join(os.path.splitext(os.path.basename(path))[0] + ".fragments", f"{uuid.uuid4().hex}.parquet")
+    os.makedirs(os.path.join(os.path.dirname(path), os.path.dirname(name)), exist_ok=True)
+    return name
+
+def fragment_paths(path: str) -> list:
+    """Files holding a table's rows, in row order: the table file, then its appended fragments."""
+    d = os.path.dirname(path)
+    return [path] + [os.path.join(d, f) for f in _read_manifest(path)["fragments"]]
+
+def table_fingerprint(path: str) -> dict:
+    """file_fingerprint of the table file plus its manifest version: changes on every append and compaction."""
+    fp = file_fingerprint(path)
+    version = _read_manifest(path)["version"]
+    return dict(fp, manifest=version) if version else fp
+
 
 class ColumnarDbFile:
     """
-    Thin wrapper: one Parquet file per logical table, with column pruning reads.
+    A logical table: a base file plus the immutable fragment files appended to it, listed in
+    <table>.manifest.json (see append_data, compact); column-pruned reads cover them in order.
+    Intermediate files (join outputs, pipeline spills) may use another file_format, e.g. "arrow"
+    (see spill.py); the build/bucket/take/append methods are for Parquet tables.
+    read_types narrows columns on every read (see narrowed() and narrowing.py).
     """
-    def __init__(self, table_name: str, file_dir: str = "data", file_pfx: str = ""):
+    def __init__(self, table_name: str, file_dir: str = "data", file_pfx: str = "", file_format="parquet"):
         self.table_name = table_name
         self.file_dir = file_dir
+        self.format = resolve_format(file_format)
         os.makedirs(self.file_dir, exist_ok=True)
-        self.path = os.path.join(self.file_dir, f"{file_pfx}{table_name}.parquet")
+        self.path = os.path.join(self.file_dir, f"{file_pfx}{table_name}{self.format.suffix}")
+        self.read_types = {}
+
+    @classmethod
+    def from_path(cls, path: str) -> "ColumnarDbFile":
+        """Wrap an existing file in place (no copy); the format follows the extension."""
+        cdf = cls(os.path.splitext(os.path.basename(path))[0], file_dir=os.path.dirname(path) or ".",
+                  file_format=format_for_path(path))
+        cdf.path = path
+        return cdf
 
-    def build_table(self, df: pd.DataFrame, compression="snappy", row_group_size=50_000) -> None:
+    def build_table(self, df: pd.DataFrame, compression="snappy", row_group_size=50_000, sort_by=None) -> None:
+        """sort_by: key columns to sort the rows on (ascending, nulls last); recorded as the table's sort order."""
         table = pa.Table.from_pandas(df, preserve_index=False)
+        if sort_by:
+            table = table.sort_by([(c, "ascending") for c in sort_by])
+        self._drop_meta()
+        self._drop_fragments()
         pq.write_table(table, self.path, compression=compression, row_group_size=row_group_size)
+        if sort_by:
+            self.write_meta(sort_order=list(sort_by))
+
+    def build_bucketed_table(self, df: pd.DataFrame, key: str, num_buckets: int, compression="snappy",
+                             row_group_size=50_000) -> None:
+        """
+        Hash-bucketed layout: rows are grouped by hash_partitions(key, num_buckets) and every bucket
+        gets its own row groups, so a bucket can be read on its own. The bucket spec (key, count,
+        hash scheme, row-group range per bucket, file fingerprint) goes to <table>.meta.json.
+        """
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        buckets = hash_partitions(table.column(key), num_buckets)
+        table = table.take(np.argsort(buckets, kind="stable"))
+        counts = np.bincount(buckets, minlength=num_buckets)
+        ranges, rg, start = [], 0, 0
+        self._drop_meta()
+        self._drop_fragments()
+        with pq.ParquetWriter(self.path, table.schema, compression=compression) as w:
+            for n in counts:
+                first = rg
+                for off in range(0, n, row_group_size):
+                    w.write_table(table.slice(start + off, min(row_group_size, n - off)), row_group_size=row_group_size)
+                    rg += 1
+                ranges.append([first, rg])
+                start += n
+        self.write_meta(bucketing={"key": key, "num_buckets": num_buckets, "hash": HASH_PARTITIONS_VERSION,
+                                   "row_groups": ranges})
+
+    def narrowed(self, types: dict) -> "ColumnarDbFile":
+        """The same file, read with the given narrower column types (e.g. narrowing.narrowed_types)."""
+        cdf = copy.copy(self)
+        cdf.read_types = dict(self.read_types, **types)
+        return cdf
+
+    def _dictionary_columns(self, columns=None) -> list | None:
+        cols = [c for c, t in self.read_types.items() if pa.types.is_dictionary(t) and (columns is None or c in columns)]
+        return cols or None
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.splitext(self.path)[0] + ".meta.json"
+
+    def read_meta(self) -> dict:
+        """Layout metadata (bucketing, sort order); empty if there is none or the file changed since it was written."""
+        if not os.path.exists(self.meta_path) or not os.path.exists(self.path):
+            return {}
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        return meta if meta.get("fingerprint") == table_fingerprint(self.path) else {}
+
+    def write_meta(self, **fields) -> None:
+        """Record layout metadata for the file as it is now (merged into what is already recorded)."""
+        meta = dict(self.read_meta(), **fields, fingerprint=table_fingerprint(self.path))
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def _drop_meta(self):
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+    @property
+    def fragments(self) -> list:
+        """Files holding the table's rows: the table file, then appended fragments in append order."""
+        return fragment_paths(self.path)
+
+    def _drop_fragments(self):
+        # The table is being rewritten: its appended fragments go with the old contents
+        if os.path.exists(_manifest_path(self.path)):
+            os.remove(_manifest_path(self.path))
+        shutil.rmtree(os.path.splitext(self.path)[0] + ".fragments", ignore_errors=True)
+
+    @property
+    def bucket_spec(self) -> dict | None:
+        """Bucket spec of a bucketed table; None if not bucketed or the file changed since it was written."""
+        return self.read_meta().get("bucketing")
+
+    @property
+    def sort_order(self) -> list | None:
+        """Columns the rows are sorted on (ascending, nulls last); None if not known to be sorted."""
+        return self.read_meta().get("sort_order")
+
+    def read_bucket(self, b: int, columns=None) -> pa.Table:
+        """All rows of bucket b (its row groups only)."""
+        first, end = self.bucket_spec["row_groups"][b]
+        pf = pq.ParquetFile(self.path, read_dictionary=self._dictionary_columns(columns))
+        if first == end:
+            schema = pf.schema_arrow
+            return narrow(schema.empty_table().select(columns) if columns else schema.empty_table(), self.read_types)
+        return narrow(pf.read_row_groups(list(range(first, end)), columns=columns), self.read_types)
 
     def retrieve_data(self, columns=None) -> pd.DataFrame:
-        return pd.read_parquet(self.path, columns=columns)
+        parts = [self.format.read_pandas(p, columns=columns) for p in self.fragments]
+        return parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+
+    def iter_batches(self, columns=None, batch_rows: int = 100_000):
+        """Column-projecting scan: Arrow record batches straight from the file(s), no pandas conversion."""
+        dictionary = self._dictionary_columns(columns)
+        batches = (b for p in self.fragments for b in self.format.iter_batches(p, columns, batch_rows, dictionary=dictionary))
+        if not self.read_types:
+            yield from batches
+            return
+        for batch in batches:
+            yield narrow(batch, self.read_types)
+
+    def read(self, columns=None) -> pa.Table:
+        dictionary = self._dictionary_columns(columns)
+        tables = [self.format.read(p, columns, dictionary=dictionary) for p in self.fragments]
+        return narrow(tables[0] if len(tables) == 1 else pa.concat_tables(tables), self.read_types)
+
+    def writer(self, schema: pa.Schema):
+        """Incremental writer (write_table / close) for this file in its format."""
+        return self.format.writer(self.path, schema)
+
+    @property
+    def schema(self) -> pa.Schema:
+        schema = self.format.schema(self.path)
+        for c, t in self.read_types.items():
+            i = schema.get_field_index(c)
+            if i >= 0:
+                schema = schema.set(i, schema.field(i).with_type(t))
+        return schema
+
+    @property
+    def num_rows(self) -> int:
+        return sum(self.format.num_rows(p) for p in self.fragments)
+
+    def decoded_mb(self, columns=None) -> float:
+        """In-memory size of (a projection of) the table."""
+        return sum(self.format.decoded_mb(p, columns) for p in self.fragments)
+
+    def sample_column(self, key: str, sample_rows: int = 100_000) -> pd.Series:
+        """About sample_rows non-null values of one column, spread over the table (fragments by their row share)."""
+        paths = self.fragments
+        if len(paths) == 1:
+            return self.format.sample_column(self.path, key, sample_rows)
+        rows = [self.format.num_rows(p) for p in paths]
+        total = max(sum(rows), 1)
+        return pd.concat([self.format.sample_column(p, key, max(1, sample_rows * n // total))
+                          for p, n in zip(paths, rows) if n], ignore_index=True)
+
+    def _take_file(self, path: str, rows: np.ndarray, columns=None) -> pa.Table:
+        pf = pq.ParquetFile(path, read_dictionary=self._dictionary_columns(columns))
+        if len(rows) == 0:
+            schema = pf.schema_arrow
+            return schema.empty_table().select(columns) if columns else schema.empty_table()
+        md = pf.metadata
+        starts = np.cumsum([0] + [md.row_group(i).num_rows for i in range(md.num_row_groups)])
+        rg = np.searchsorted(starts, rows, side="right") - 1
+        needed = np.unique(rg)
+        local = np.cumsum(np.concatenate(([0], starts[needed + 1] - starts[needed])))[:-1]
+        tbl = pf.read_row_groups(needed.tolist(), columns=columns)
+        return tbl.take(local[np.searchsorted(needed, rg)] + rows - starts[rg])
+
+    def take(self, rows, columns=None) -> pa.Table:
+        """Rows by position (vectorized), reading only the row groups (of any fragment) that contain them."""
+        rows = np.asarray(rows, dtype=np.int64)
+        paths = self.fragments
+        if len(paths) == 1:
+            return narrow(self._take_file(self.path, rows, columns), self.read_types)
+        starts = np.cumsum([0] + [pq.ParquetFile(p).metadata.num_rows for p in paths])
+        frag = np.searchsorted(starts, rows, side="right") - 1
+        order = np.argsort(frag, kind="stable")
+        parts = [self._take_file(paths[f], rows[order][frag[order] == f] - starts[f], columns) for f in np.unique(frag)]
+        if not parts:
+            return narrow(self._take_file(self.path, rows, columns), self.read_types)
+        return narrow(pa.concat_tables(parts).take(np.argsort(order)), self.read_types)
 
     def append_data(self, df: pd.DataFrame, compression="snappy") -> None:
+        """
+        Append rows as a new immutable fragment; the table file and earlier fragments are never rewritten.
+        The fragment becomes part of the table atomically, with the manifest update. Appending voids a
+        recorded sort order / bucketing (the table fingerprint changes).
+        """
         table = pa.Table.from_pandas(df, preserve_index=False)
         if not os.path.exists(self.path):
-            pq.write_table(table, self.path, compression=compression)
-        else:
-            with pq.ParquetWriter(self.path, table.schema, compression=compression, use_dictionary=True) as w:
-                w.write_table(table)
+            pq.write_table(table, self.path + ".tmp", compression=compression)
+            os.replace(self.path + ".tmp", self.path)
+            return
+        schema = self.format.schema(self.path)
+        table = table.select(schema.names).cast(schema)  # fragments share the table's schema
+        name = _new_fragment(self.path)
+        pq.write_table(table, os.path.join(os.path.dirname(self.path), name), compression=compression)
+        with _manifest_lock:
+            manifest = _read_manifest(self.path)
+            _write_manifest(self.path, dict(manifest, fragments=manifest["fragments"] + [name]))
+
+    def compact(self, target_rows: int = 1_000_000, row_group_size: int = 50_000, compression="snappy",
+                background: bool = False):
+        """
+        Merge runs of consecutive appended fragments below target_rows rows into fragments of about
+        target_rows rows with row_group_size row groups (row order is kept; the table file is left as
+        is). Appends may continue meanwhile: only the merged runs are swapped out, atomically, in the
+        manifest. Merged-away files are deleted by the following compaction, so scans that already
+        listed them can finish. Returns the number of fragments merged away, or with background=True
+        the daemon thread running the compaction.
+        """
+        if background:
+            t = threading.Thread(target=self.compact, args=(target_rows, row_group_size, compression), daemon=True)
+            t.start()
+            return t
+        d = os.path.dirname(self.path)
+        runs, run, run_rows = [], [], 0
+        for name in _read_manifest(self.path)["fragments"]:
+            n = pq.ParquetFile(os.path.join(d, name)).metadata.num_rows
+            if n >= target_rows:
+                runs.append(run)  # large fragments stay and close the run before them
+                run, run_rows = [], 0
+                continue
+            run, run_rows = run + [name], run_rows + n
+            if run_rows >= target_rows:
+                runs.append(run)
+                run, run_rows = [], 0
+        runs.append(run)
+        merged = [(r, self._merge_fragments(r, row_group_size, compression)) for r in runs if len(r) > 1]
+        with _manifest_lock:
+            manifest = _read_manifest(self.path)
+            if not merged and not manifest["retired"]:
+                return 0
+            frags, retired = list(manifest["fragments"]), []
+            for r, name in merged:
+                i = frags.index(r[0]) if r[0] in frags else -1
+                if i < 0 or frags[i:i + len(r)] != r:
+                    os.remove(os.path.join(d, name))  # a concurrent compaction got there first
+                    continue
+                frags[i:i + len(r)] = [name]
+                retired += r
+            _write_manifest(self.path, dict(manifest, fragments=frags, retired=retired), bump=bool(retired))
+        for name in manifest["retired"]:
+            if os.path.exists(os.path.join(d, name)):
+                os.remove(os.path.join(d, name))
+        return len(retired)
+
+    def _merge_fragments(self, names: list, row_group_size: int, compression) -> str:
+        # Stream the fragments into one new fragment, re-chunked into full row_group_size row groups
+        d = os.path.dirname(self.path)
+        name = _new_fragment(self.path)
+        out = os.path.join(d, name)
+        schema = self.format.schema(self.path)
+        pending, rows = [], 0
+        with pq.ParquetWriter(out + ".tmp", schema, compression=compression) as w:
+            for n in names:
+                for batch in pq.ParquetFile(os.path.join(d, n)).iter_batches(batch_size=row_group_size):
+                    pending.append(batch)
+                    rows += batch.num_rows
+                    if rows >= row_group_size:
+                        tbl = pa.Table.from_batches(pending)
+                        full = rows - rows % row_group_size
+                        w.write_table(tbl.slice(0, full), row_group_size=row_group_size)
+                        rest = tbl.slice(full)
+                        pending, rows = rest.to_batches(), rest.num_rows
+            if rows:
+                w.write_table(pa.Table.from_batches(pending), row_group_size=row_group_size)
+        os.replace(out + ".tmp", out)
+        return name
+
+
+def co_bucketed(left: ColumnarDbFile, right: ColumnarDbFile, left_key: str, right_key: str) -> int | None:
+    """Bucket count if both tables are bucketed on their join keys with the same count and hash scheme."""
+    ls, rs = left.bucket_spec, right.bucket_spec
+    if ls is None or rs is None:
+        return None
+    if (ls["key"], rs["key"]) != (left_key, right_key) or ls["num_buckets"] != rs["num_buckets"] \
+            or ls["hash"] != rs["hash"]:
+        return None
+    return ls["num_buckets"]
@@ -1,20 +1,138 @@
 import os
-import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
+import pyarrow as pa
 import pyarrow.parquet as pq
+from .hashing import HASH_PARTITIONS_VERSION, hash64, hash_partitions  # hash64 / version re-exported
 
 def file_size_mb(path: str) -> float:
     return os.path.getsize(path) / (1024*1024)
 
-def parquet_metadata(path: str):
-    pf = pq.ParquetFile(path)
-    rows = sum(pf.metadata.row_group(i).num_rows for i in range(pf.metadata.num_row_groups))
+def file_fingerprint(path: str) -> dict:
+    """Size + mtime: changes whenever the file is rewritten or appended to."""
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def _files(path) -> list:
+    # One Parquet file, or the fragment files of a table (storage.fragment_paths)
+    return [path] if isinstance(path, (str, os.PathLike)) else list(path)
+
+def parquet_metadata(path):
+    files = _files(path)
+    mds = [pq.ParquetFile(p).metadata for p in files]
     # ParquetSchema may not expose num_columns on some pyarrow versions; use names directly.
-    cols = list(pf.schema.names)
-    return {"rows": rows, "columns": cols, "row_groups": pf.metadata.num_row_groups, "disk_mb": file_size_mb(path)}
+    cols = list(pq.ParquetFile(files[0]).schema.names)
+    return {"rows": sum(md.num_rows for md in mds), "columns": cols, "row_groups": sum(md.num_row_groups for md in mds),
+            "disk_mb": sum(file_size_mb(p) for p in files), "uncompressed_mb": parquet_uncompressed_mb(files)}
+
+def parquet_uncompressed_mb(path, columns=None) -> float:
+    """Decoded size of (a projection of) a Parquet file or fragment list, from column-chunk metadata only."""
+    total = 0
+    for p in _files(path):
+        md = pq.ParquetFile(p).metadata
+        for i in range(md.num_row_groups):
+            rg = md.row_group(i)
+            for j in range(rg.num_columns):
+                cc = rg.column(j)
+                if columns is None or cc.path_in_schema.split(".")[0] in columns:
+                    total += cc.total_uncompressed_size
+    return total / (1024*1024)
+
+def parquet_column_stats(path) -> dict:
+    """
+    Per-column statistics from footer metadata only (of one file or all fragments of a table): physical
+    type, decoded bytes, nulls, global min/max (when every row group has them) and the writer's distinct
+    count if it recorded one.
+    """
+    stats = {}
+    for rg in (md.row_group(i) for md in (pq.ParquetFile(p).metadata for p in _files(path))
+               for i in range(md.num_row_groups)):
+        for j in range(rg.num_columns):
+            cc = rg.column(j)
+            name = cc.path_in_schema.split(".")[0]
+            st = stats.setdefault(name, {"type": cc.physical_type, "bytes": 0, "nulls": 0, "min": None, "max": None,
+                                         "distinct": 0, "has_min_max": True, "has_distinct": True})
+            st["bytes"] += cc.total_uncompressed_size
+            s = cc.statistics
+            if s is None:
+                st["has_min_max"] = st["has_distinct"] = False
+                continue
+            st["nulls"] += s.null_count if s.has_null_count else 0
+            if s.has_min_max and st["has_min_max"]:
+                st["min"] = s.min if st["min"] is None else min(st["min"], s.min)
+                st["max"] = s.max if st["max"] is None else max(st["max"], s.max)
+            else:
+                st["has_min_max"] = False
+            if s.has_distinct_count and st["has_distinct"]:
+                st["distinct"] += s.distinct_count  # upper bound: row groups may share values
+            else:
+                st["has_distinct"] = False
+    for st in stats.values():
+        if not st.pop("has_min_max"):
+            st["min"] = st["max"] = None
+        if not st.pop("has_distinct"):
+            st["distinct"] = None
+    return stats
+
+def sample_key_column(path: str, key: str, sample_rows: int = 100_000) -> pd.Series:
+    """Non-null keys from evenly spaced row groups, about sample_rows of them."""
+    pf = pq.ParquetFile(path)
+    n_rg = pf.metadata.num_row_groups
+    if n_rg == 0:
+        return pd.Series([], dtype="float64")
+    avg_rows = max(1, pf.metadata.num_rows // n_rg)
+    picks = np.unique(np.linspace(0, n_rg - 1, max(1, min(n_rg, sample_rows // avg_rows))).astype(int))
+    return pd.Series(key_array(pf.read_row_groups(picks.tolist(), columns=[key]).column(key))).dropna()
+
+def parallel_map(fn, items, num_workers: int = 1):
+    """
+    Ordered, lazy map of `fn` over `items` on a thread pool (Arrow/NumPy kernels release the GIL).
+    At most 2*num_workers tasks are in flight, so results stream out with bounded memory.
+    """
+    if num_workers <= 1:
+        yield from map(fn, items)
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def key_array(values) -> np.ndarray:
+    """Arrow/pandas/NumPy key column -> NumPy array; integral floats collapse to int64 so both join sides agree."""
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        if pa.types.is_dictionary(values.type):
+            # Decode by cast: to_numpy mishandles all-null chunks with an empty dictionary
+            values = values.cast(values.type.value_type)
+        values = values.to_numpy(zero_copy_only=False)
+    arr = np.asarray(values)
+    if arr.dtype.kind == "f" and len(arr) and np.isfinite(arr).all() and (arr == np.floor(arr)).all():
+        arr = arr.astype(np.int64)
+    return arr
+
+def expand_ranges(starts, counts) -> np.ndarray:
+    """Concatenate arange(s, s+c) for every (s, c) pair, fully vectorized."""
+    starts, counts = np.asarray(starts, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + within
+
+def join_output(left: pa.Table, right: pa.Table, lidx, ridx, left_key: str, right_key: str) -> pa.Table:
+    """
+    Gather matched row pairs into one table with pandas.merge naming:
+    a shared key column appears once, other overlapping names get _x/_y suffixes.
+    """
+    lcols = left.column_names
+    rcols = [c for c in right.column_names if not (c == right_key and left_key == right_key)]
+    overlap = set(lcols) & set(rcols)
+    names = [f"{c}_x" if c in overlap else c for c in lcols] + [f"{c}_y" if c in overlap else c for c in rcols]
+    arrays = [left.column(c).take(lidx) for c in lcols] + [right.column(c).take(ridx) for c in rcols]
+    return pa.table(arrays, names=names)
 
 def hash_value(v, B: int) -> int:
-    if isinstance(v, (int, np.integer)): 
-        return int(v) % B
-    h = hashlib.sha256(str(v).encode()).hexdigest()
-    return int(h, 16) % B
+    """Partition of a single key; same as hash_partitions on a column holding it."""
+    return int(hash_partitions(np.array([v], dtype=object), B)[0])
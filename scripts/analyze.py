@@ -0,0 +1,10 @@
+import sys, glob
+from nanoquery.catalog import StatsCatalog
+
+# ANALYZE: python -m scripts.analyze [file.parquet ...]  (default: data/*.parquet)
+if __name__ == "__main__":
+    paths = sys.argv[1:] or sorted(glob.glob("data/*.parquet"))
+    for path in paths:
+        entry = StatsCatalog.for_file(path).analyze(path)
+        ndv = {c: s["ndv"] for c, s in entry["columns"].items()}
+        print(f"{path}: {entry['rows']} rows, ndv {ndv}")
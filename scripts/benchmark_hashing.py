@@ -0,0 +1,59 @@
+import hashlib, time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from nanoquery.hashing import hash_partitions, mix64
+
+# Partition balance and throughput of nanoquery.hashing against the schemes it replaced:
+#   python -m scripts.benchmark_hashing [n_keys]
+
+def sha256_partitions(values, B: int, seed: int = 0) -> np.ndarray:
+    # The original scalar hash_value: int % B, sha256 of str(v) for everything else
+    return np.array([v % B if isinstance(v, int) else int(hashlib.sha256(f"{seed}:{v}".encode()).hexdigest(), 16) % B
+                     for v in values.to_pylist()], dtype=np.int64)
+
+def v1_partitions(values, B: int, seed: int = 0) -> np.ndarray:
+    # hash_partitions/v1: raw int % B at seed 0, pandas' object hash for strings, splitmix remix for other seeds
+    arr = values.to_numpy(zero_copy_only=False)
+    salt = np.uint64((seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+    if arr.dtype.kind in "iu":
+        if seed == 0:
+            return arr.astype(np.int64) % B
+        h = mix64(arr.astype(np.int64).view(np.uint64) ^ salt)
+    else:
+        h = pd.util.hash_array(arr.astype(object), categorize=False)
+        h = mix64(h ^ salt) if seed else h
+    return (h % np.uint64(B)).astype(np.int64)
+
+def key_sets(n: int, B: int) -> dict:
+    rng = np.random.default_rng(0)
+    return {"sequential ints": pa.array(np.arange(n)),
+            f"strided ints (x{B})": pa.array(np.arange(n) * B),
+            "random ints": pa.array(rng.integers(0, 2**40, n)),
+            "strings": pa.array([f"song_{i:07d}" for i in rng.integers(0, 10**7, n)])}
+
+def balance(parts: np.ndarray, B: int) -> float:
+    """Largest partition over the mean partition size (1.0 = perfectly even)."""
+    counts = np.bincount(np.asarray(parts, dtype=np.int64), minlength=B)
+    return counts.max() / max(counts.mean(), 1e-9)
+
+def run(n: int = 1_000_000, B: int = 64, sha_rows: int = 100_000) -> pd.DataFrame:
+    rows = []
+    for name, keys in key_sets(n, B).items():
+        for scheme, fn, m in (("sha256", sha256_partitions, sha_rows), ("v1", v1_partitions, n),
+                              ("hashing", hash_partitions, n)):
+            sample = keys.slice(0, m)
+            t0 = time.perf_counter()
+            parts = fn(sample, B)
+            secs = time.perf_counter() - t0
+            # Recursive repartitioning: split partition 0 again with seed 1
+            sub = sample.filter(pa.array(np.asarray(parts) == 0))
+            rows.append({"keys": name, "scheme": scheme, "Mkeys/s": m / secs / 1e6,
+                         "balance": balance(parts, B),
+                         "seed-1 balance of partition 0": balance(fn(sub, B, seed=1), B) if len(sub) else float("nan")})
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(run(n).to_string(index=False, float_format=lambda x: f"{x:.2f}"))
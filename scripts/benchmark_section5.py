@@ -20,11 +20,14 @@ class ForcedPlanner(QueryPlanner):
         self.force_algo2 = force_algo2
     def plan(self, parquet_paths: dict, parsed_query: dict, avail_mem_mb: float = 10_000):
         plan = super().plan(parquet_paths, parsed_query, avail_mem_mb)
-        plan["steps"][0]["algo"] = self.force_algo1
-        plan["steps"][1]["algo"] = self.force_algo2
+        for step, algo in zip(plan["steps"], (self.force_algo1, self.force_algo2)):
+            step["algo"] = algo
+            if algo == "HPJ":
+                # One partition would run the in-memory pipelined HashJoin, not the grace hash join
+                step["partitions"] = max(step.get("partitions", 1), 2)
         return plan
 
-def _make_dataset(dir_path: str, size_label: str):
+def _make_dataset(dir_path: str, size_label: str, zipf_s=None):
     os.makedirs(dir_path, exist_ok=True)
     if size_label == "100MB":
         n_songs, n_users, n_listens = 10_000, 50_000, 1_000_000
@@ -34,7 +37,7 @@ def _make_dataset(dir_path: str, size_label: str):
         raise ValueError("size_label must be '100MB' or '1GB'")
     write_parquet(generate_songs(n_songs), os.path.join(dir_path, "Songs.parquet"))
     write_parquet(generate_users(n_users), os.path.join(dir_path, "Users.parquet"))
-    write_parquet(generate_listens(n_listens, n_users, n_songs), os.path.join(dir_path, "Listens.parquet"))
+    write_parquet(generate_listens(n_listens, n_users, n_songs, zipf_s=zipf_s), os.path.join(dir_path, "Listens.parquet"))
     return {
         "Songs": os.path.join(dir_path, "Songs.parquet"),
         "Users": os.path.join(dir_path, "Users.parquet"),
@@ -55,11 +58,11 @@ def _run_once(paths: dict, algo: str, workdir: str) -> Tuple[pd.DataFrame, float
     # We don't separate I/O vs join precisely; leave as total and None fields
     return df, total_s, None, peak_mem_gb
 
-def run_benchmarks(base_dir: str, sizes=("100MB","1GB")) -> pd.DataFrame:
+def run_benchmarks(base_dir: str, sizes=("100MB","1GB"), zipf_s=None) -> pd.DataFrame:
     rows = []
     for sz in sizes:
         ds_dir = os.path.join(base_dir, f"data_{sz}")
-        paths = _make_dataset(ds_dir, sz)
+        paths = _make_dataset(ds_dir, sz, zipf_s=zipf_s)
         for algo in ("HPJ","SMJ"):
             df, total_s, io_s, peak_gb = _run_once(paths, algo, os.path.join(base_dir, f"work_{sz}_{algo}"))
             rows.append({
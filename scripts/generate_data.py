@@ -29,11 +29,16 @@ def generate_users(n, string_length=100):
         df[f"extra_col_{i}"] = np.roll(base, i)
     return df
 
-def generate_listens(n, num_users, num_songs, string_length=16):
+def generate_listens(n, num_users, num_songs, string_length=16, zipf_s=None):
+    # zipf_s > 1 draws song popularity from a Zipf distribution (song 0 hottest) instead of uniform
+    if zipf_s:
+        song_ids = (np.random.zipf(zipf_s, size=n) - 1) % num_songs
+    else:
+        song_ids = np.random.randint(0, num_songs, size=n)
     df = pd.DataFrame({
         "listen_id": range(n),
         "user_id": np.random.randint(0, num_users, size=n),
-        "song_id": np.random.randint(0, num_songs, size=n),
+        "song_id": song_ids,
     })
     base = generate_base_strings(n, string_length)
     for i in range(1, 11):
@@ -1,5 +1,6 @@
 import os
 import pandas as pd
+import pytest
 import pyarrow as pa
 import pyarrow.parquet as pq
 from nanoquery.aggregation import aggregate_final
@@ -27,3 +28,141 @@ def test_aggregation_matches_pandas(tmp_path):
     pd.testing.assert_frame_equal(got, exp)
 
 
+
+def test_streaming_aggregation_spills_and_matches_pandas(tmp_path):
+    import numpy as np
+    from nanoquery.aggregation import StreamingAggregator
+    rng = np.random.default_rng(6)
+    n = 20_000
+    song = rng.integers(0, 300, n)
+    df = pd.DataFrame({"song_id": song, "title": [f"T{s}" for s in song],
+                       "user_id": rng.integers(0, 2_000, n), "age": rng.integers(18, 80, n)})
+    agg = StreamingAggregator(memory_budget_mb=0.05, temp_dir=str(tmp_path), spill_partitions=4)
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    for off in range(0, n, 1_000):
+        agg.consume(tbl.slice(off, 1_000))
+    got = agg.finish()
+    assert agg.stats["spilled_pairs"] > 0
+    assert os.listdir(tmp_path) == []  # spill files cleaned up
+    exp = (df.groupby(["song_id","title"])
+             .agg(avg_age=("age","mean"), count_distinct_users=("user_id", pd.Series.nunique))
+             .reset_index()
+             .sort_values(["count_distinct_users","song_id"], ascending=[False, True]))
+    exp = exp[["song_id","avg_age","count_distinct_users"]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, exp)
+
+
+def test_hll_error_bound_and_merge():
+    import numpy as np
+    from nanoquery.hll import HyperLogLog
+    rng = np.random.default_rng(7)
+    true = np.array([0, 1, 10, 1_000, 50_000])
+    groups = np.repeat(np.arange(len(true)), true)
+    users = np.concatenate([rng.choice(10**9, t, replace=False) for t in true])
+    whole = HyperLogLog(12, len(true))
+    whole.add(groups, users)
+    # Two partial sketches over a random split (with duplicates) merge to the same registers
+    a, b = HyperLogLog(12), HyperLogLog(12)
+    half = rng.random(len(users)) < 0.5
+    a.add(groups[half], users[half]); a.add(groups, users)
+    b.add(groups[~half], users[~half])
+    a.merge(b)
+    np.testing.assert_array_equal(a.registers, whole.registers)
+    est = whole.estimate()
+    assert est[0] == 0 and round(est[1]) == 1 and round(est[2]) == 10
+    assert np.all(np.abs(est[3:] - true[3:]) <= 4 * whole.relative_error * true[3:])
+
+
+def test_approx_aggregator_merges_partials():
+    import numpy as np
+    from nanoquery.aggregation import StreamingAggregator
+    rng = np.random.default_rng(8)
+    n = 30_000
+    song = rng.integers(0, 20, n)
+    df = pd.DataFrame({"song_id": song, "title": [f"T{s}" for s in song],
+                       "user_id": rng.integers(0, 5_000, n), "age": rng.integers(18, 80, n)})
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    parts = [StreamingAggregator(approx_distinct=True, hll_precision=12) for _ in range(3)]
+    for i, off in enumerate(range(0, n, 2_000)):
+        parts[i % 3].consume(tbl.slice(off, 2_000))
+    parts[0].merge(parts[1]); parts[0].merge(parts[2])
+    got = parts[0].finish().sort_values("song_id").reset_index(drop=True)
+    exp = (df.groupby("song_id").agg(avg_age=("age", "mean"), n=("user_id", pd.Series.nunique)).reset_index())
+    np.testing.assert_allclose(got["avg_age"], exp["avg_age"])
+    assert np.all(np.abs(got["count_distinct_users"] - exp["n"]) <= 0.07 * exp["n"])
+
+
+@pytest.mark.parametrize("approx", [False, True])
+def test_late_materialized_titles_regroup_after_spill(tmp_path, approx):
+    import numpy as np
+    from nanoquery.aggregation import StreamingAggregator
+    from nanoquery.storage import ColumnarDbFile
+    rng = np.random.default_rng(10)
+    # Several Songs rows per (song_id, title), and one song with two different titles
+    songs = pd.DataFrame({"song_id": np.repeat(np.arange(100), 3), "title": [f"T{i // 3}" for i in range(300)]})
+    songs.loc[299, "title"] = "other"
+    cdf = ColumnarDbFile("Songs", file_dir=str(tmp_path / "src"))
+    cdf.build_table(songs, row_group_size=64)
+    n = 20_000
+    row = rng.integers(0, 300, n)
+    df = pd.DataFrame({"song_id": songs["song_id"].to_numpy()[row], "title": songs["title"].to_numpy()[row],
+                       "songs_row_id": row, "user_id": rng.integers(0, 500, n), "age": rng.integers(18, 80, n)})
+    agg = StreamingAggregator(memory_budget_mb=0.05, temp_dir=str(tmp_path), spill_partitions=4,
+                              approx_distinct=approx, title_rows=(cdf, "songs_row_id"))
+    tbl = pa.Table.from_pandas(df.drop(columns="title"), preserve_index=False)
+    for off in range(0, n, 1_000):
+        agg.consume(tbl.slice(off, 1_000))
+    got = agg.finish()
+    assert approx or agg.stats["spilled_pairs"] > 0
+    ref = StreamingAggregator(approx_distinct=approx)
+    ref.consume(pa.Table.from_pandas(df.drop(columns="songs_row_id"), preserve_index=False))
+    pd.testing.assert_frame_equal(got, ref.finish())
+    assert len(got) == 101
+
+@pytest.mark.parametrize("approx", [False, True])
+def test_sorted_aggregation_matches_hash_aggregation(approx):
+    import numpy as np
+    from nanoquery.aggregation import SortedAggregator, StreamingAggregator
+    rng = np.random.default_rng(21)
+    n = 10_000
+    song = np.sort(rng.integers(0, 400, n))
+    song[:3000] = 7  # one key run spanning several batches
+    tbl = pa.table({"song_id": song, "title": [f"T{s % 97}" for s in song],
+                    "user_id": rng.integers(0, 900, n), "age": rng.integers(18, 80, n)})
+    sorted_agg, hash_agg = SortedAggregator("song_id", approx_distinct=approx), StreamingAggregator(approx_distinct=approx)
+    for off in range(0, n, 700):
+        sorted_agg.consume(tbl.slice(off, 700))
+        hash_agg.consume(tbl.slice(off, 700))
+    pd.testing.assert_frame_equal(sorted_agg.finish(), hash_agg.finish())
+    assert sorted_agg.stats["rows"] == n and sorted_agg.stats["flushes"] > 1
+
+@pytest.mark.parametrize("approx", [False, True])
+def test_sorted_aggregation_fetches_late_titles_once(tmp_path, approx):
+    import numpy as np
+    from nanoquery.aggregation import SortedAggregator, StreamingAggregator
+    from nanoquery.storage import ColumnarDbFile
+    rng = np.random.default_rng(12)
+    # Songs 0-49 have one row, 50-99 three rows sharing a title; song 99's last row has another title
+    songs = pd.DataFrame({"song_id": np.r_[np.arange(50), np.repeat(np.arange(50, 100), 3)]})
+    songs["title"] = [f"T{s}" for s in songs["song_id"]]
+    songs.loc[len(songs) - 1, "title"] = "other"
+    cdf = ColumnarDbFile("Songs", file_dir=str(tmp_path / "src"))
+    cdf.build_table(songs, row_group_size=64)
+    n = 20_000
+    row = np.sort(rng.integers(0, len(songs), n))  # sorted on row id, hence on song_id
+    tbl = pa.table({"song_id": songs["song_id"].to_numpy()[row], "songs_row_id": row,
+                    "user_id": rng.integers(0, 500, n), "age": rng.integers(18, 80, n)})
+    takes = []
+    take = cdf.take
+    cdf.take = lambda rows, columns=None: takes.append(len(rows)) or take(rows, columns)
+    sorted_agg = SortedAggregator("song_id", approx_distinct=approx, title_rows=(cdf, "songs_row_id"))
+    hash_agg = StreamingAggregator(approx_distinct=approx, title_rows=(cdf, "songs_row_id"))
+    for off in range(0, n, 700):
+        sorted_agg.consume(tbl.slice(off, 700))
+        hash_agg.consume(tbl.slice(off, 700))
+    got = sorted_agg.finish()
+    assert takes == [len(songs)] and sorted_agg.stats["flushes"] > 1
+    exp = hash_agg.finish()
+    assert len(got) == 101
+    key = ["song_id", "avg_age"]
+    pd.testing.assert_frame_equal(got.sort_values(key).reset_index(drop=True), exp.sort_values(key).reset_index(drop=True))
@@ -1,11 +1,18 @@
 import os
+import threading
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pytest
 
-from nanoquery.storage import ColumnarDbFile
+from nanoquery.storage import ColumnarDbFile, co_bucketed
 from nanoquery.hash_join import HashPartitionJoin
+from nanoquery.hash_table import ColumnarHashTable
+from nanoquery.sort_merge_join import SortMergeJoin
+from nanoquery.background_io import IOStats, read_ahead
+from nanoquery.utils import hash_partitions, hash_value
+from scripts.generate_data import generate_listens
 
 def _write_parquet(df, path):
     pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
@@ -63,3 +70,196 @@ def test_hpj_empty_side(tmp_path):
     assert df_out.empty
 
 
+
+def test_hash_partitions_match_scalar_hash():
+    ints = [0, 3, 7, 8, 123456789]
+    strs = ["a", "song", "", "Zürich"]
+    assert list(hash_partitions(pa.array(ints), 8)) == [hash_value(v, 8) for v in ints]
+    assert list(hash_partitions(pa.array(strs), 8)) == [hash_value(v, 8) for v in strs]
+    # float-typed integral keys (e.g. from an empty/null-widened side) land with their int twins
+    assert list(hash_partitions(np.array([3.0, 8.0]), 8)) == list(hash_partitions(np.array([3, 8]), 8))
+    # strided integer keys spread over all partitions; other seeds give independent splits
+    strided = np.arange(0, 8 * 4000, 8)
+    assert np.bincount(hash_partitions(strided, 8), minlength=8).min() > 400
+    part = strided[hash_partitions(strided, 8) == 0]
+    assert np.bincount(hash_partitions(part, 8, seed=1), minlength=8).min() > 40
+    # sliced / chunked / large string arrays hash like plain ones
+    words = pa.array([f"k{i}" * (i % 5) for i in range(100)])
+    assert (hash_partitions(words.slice(10, 50), 16) == hash_partitions(pa.array(words.to_pylist()[10:60]), 16)).all()
+    assert (hash_partitions(pa.chunked_array([words[:30], words[30:]]).cast(pa.large_string()), 16)
+            == hash_partitions(words, 16)).all()
+
+def test_hpj_string_keys(tmp_path):
+    d = tmp_path / "strkeys"; d.mkdir()
+    left = pd.DataFrame({"k": ["a", "b", "b", "c"], "lv": [1, 2, 3, 4]})
+    right = pd.DataFrame({"k": ["b", "c", "c", "d"], "rv": [10, 20, 30, 40]})
+    _write_parquet(left, d / "Left.parquet")
+    _write_parquet(right, d / "Right.parquet")
+    out = HashPartitionJoin(3).join(ColumnarDbFile("Left", file_dir=str(d)), ColumnarDbFile("Right", file_dir=str(d)),
+                                    "k", "k", temp_dir=str(tmp_path))
+    got = pd.read_parquet(out.path).sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    exp = left.merge(right, on="k").sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+def test_hpj_narrowed_dictionary_keys_with_all_null_row_group(tmp_path):
+    d = tmp_path / "dictkeys"; d.mkdir()
+    left = pd.DataFrame({"k": [None] * 100 + ["a", "b", "b", "c"] * 25, "lv": range(200)})
+    right = pd.DataFrame({"k": ["b", "c", "c", "d"] * 25, "rv": range(100)})
+    pq.write_table(pa.Table.from_pandas(left, preserve_index=False), d / "Left.parquet", row_group_size=100)
+    _write_parquet(right, d / "Right.parquet")
+    dict_key = {"k": pa.dictionary(pa.int32(), pa.large_string())}
+    L = ColumnarDbFile("Left", file_dir=str(d)).narrowed(dict_key)
+    R = ColumnarDbFile("Right", file_dir=str(d)).narrowed(dict_key)
+    # the first row group is all null: its dictionary chunk has no values at all
+    assert len(next(L.iter_batches(["k"], 100)).column("k").dictionary) == 0
+    out = HashPartitionJoin(2, join_filter=True).join(L, R, "k", "k", temp_dir=str(tmp_path))
+    got = out.read().to_pandas().astype({"k": object}).sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    exp = left.dropna().merge(right, on="k").sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp, check_dtype=False)
+
+def test_columnar_hash_table_probe_pairs():
+    table = ColumnarHashTable(pa.array([5, 7, 5, None, 9]))
+    assert len(table) == 4
+    brows, prows = table.probe(pa.array([5, 1, 9, None, 5]))
+    assert sorted(zip(prows.tolist(), brows.tolist())) == [(0, 0), (0, 2), (2, 4), (4, 0), (4, 2)]
+
+def test_hpj_parallel_partitions_match_serial(tiny_data, tmp_path):
+    songs = ColumnarDbFile("Songs", file_dir=tiny_data)
+    listens = ColumnarDbFile("Listens", file_dir=tiny_data)
+    outs = []
+    for workers in (1, 4):
+        out = HashPartitionJoin(4, num_workers=workers).join(songs, listens, "song_id", "song_id",
+                                                             temp_dir=str(tmp_path))
+        df = pd.read_parquet(out.path)
+        outs.append(df.sort_values(list(df.columns)).reset_index(drop=True))
+    pd.testing.assert_frame_equal(outs[0], outs[1])
+
+def test_hpj_recursive_repartition_under_tiny_budget(tmp_path, monkeypatch):
+    d = tmp_path / "grace"; d.mkdir()
+    rng = np.random.default_rng(2)
+    left = pd.DataFrame({"k": np.arange(0, 4000, 2), "lv": rng.integers(0, 100, 2000)})
+    right = pd.DataFrame({"k": rng.integers(0, 4000, 5000), "rv": np.arange(5000)})
+    _write_parquet(left, d / "Left.parquet")
+    _write_parquet(right, d / "Right.parquet")
+    hpj = HashPartitionJoin(2, memory_budget_mb=0.01)
+    seeds = []
+    real = hpj._partition_to_disk
+    def spy(*args, **kw):
+        seeds.append(kw.get("seed", 0))
+        return real(*args, **kw)
+    monkeypatch.setattr(hpj, "_partition_to_disk", spy)
+    out = hpj.join(ColumnarDbFile("Left", file_dir=str(d)), ColumnarDbFile("Right", file_dir=str(d)),
+                   "k", "k", temp_dir=str(tmp_path))
+    assert max(seeds) >= 1  # each half of a 2-way split still exceeds the budget; a reseeded split is required
+    got = pd.read_parquet(out.path).sort_values(["k", "rv"]).reset_index(drop=True)
+    exp = left.merge(right, on="k").sort_values(["k", "rv"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+@pytest.mark.parametrize("budget_mb", [100.0, 0.06])
+def test_hpj_hybrid_matches_pandas(tmp_path, budget_mb):
+    d = tmp_path / "hybrid"; d.mkdir()
+    rng = np.random.default_rng(3)
+    left = pd.DataFrame({"k": np.arange(3000), "lv": rng.integers(0, 100, 3000)})
+    right = pd.DataFrame({"k": rng.integers(0, 3500, 8000), "rv": np.arange(8000)})
+    _write_parquet(left, d / "Left.parquet")
+    _write_parquet(right, d / "Right.parquet")
+    hpj = HashPartitionJoin(4, batch_rows=1000, memory_budget_mb=budget_mb, hybrid=True)
+    out = hpj.join(ColumnarDbFile("Left", file_dir=str(d)), ColumnarDbFile("Right", file_dir=str(d)),
+                   "k", "k", temp_dir=str(tmp_path / "w"))
+    spilled = [f for f in os.listdir(os.path.dirname(out.path)) if "_part" in f]
+    if budget_mb >= 100:
+        assert hpj.stats["resident_partitions"] == 4 and spilled == []
+    else:
+        assert 0 < hpj.stats["resident_partitions"] < 4 and spilled
+    got = pd.read_parquet(out.path).sort_values(["k", "rv"]).reset_index(drop=True)
+    exp = left.merge(right, on="k").sort_values(["k", "rv"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_hpj_skewed_keys_broadcast(tmp_path, hybrid):
+    d = tmp_path / "skew"; d.mkdir()
+    np.random.seed(4)
+    listens = generate_listens(6000, num_users=50, num_songs=300, string_length=4, zipf_s=1.3)
+    listens = listens[["listen_id", "song_id", "user_id"]]
+    songs = pd.DataFrame({"song_id": np.arange(300), "title": [f"S{i}" for i in range(300)]})
+    _write_parquet(songs, d / "Songs.parquet")
+    _write_parquet(listens, d / "Listens.parquet")
+    hpj = HashPartitionJoin(4, batch_rows=500, num_workers=2, memory_budget_mb=100 if hybrid else None,
+                            hybrid=hybrid, skew_threshold=0.05)
+    out = hpj.join(ColumnarDbFile("Songs", file_dir=str(d)), ColumnarDbFile("Listens", file_dir=str(d)),
+                   "song_id", "song_id", temp_dir=str(tmp_path / "w"))
+    assert hpj.stats["heavy_hitters"] >= 1
+    got = pd.read_parquet(out.path).sort_values(["listen_id"]).reset_index(drop=True)
+    exp = songs.merge(listens, on="song_id").sort_values(["listen_id"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+def test_hpj_co_bucketed_tables_skip_partitioning(tmp_path, monkeypatch):
+    rng = np.random.default_rng(14)
+    d = str(tmp_path / "bkt")
+    songs = pd.DataFrame({"song_id": np.arange(500), "title": [f"S{i}" for i in range(500)]})
+    listens = pd.DataFrame({"listen_id": np.arange(5_000), "song_id": rng.integers(0, 600, 5_000),
+                            "user_id": rng.integers(0, 100, 5_000)})
+    s, l = ColumnarDbFile("Songs", file_dir=d), ColumnarDbFile("Listens", file_dir=d)
+    s.build_bucketed_table(songs, "song_id", 8, row_group_size=20)
+    l.build_bucketed_table(listens, "song_id", 8, row_group_size=300)
+    assert co_bucketed(s, l, "song_id", "song_id") == 8 and co_bucketed(s, l, "song_id", "user_id") is None
+    b3 = l.read_bucket(3)["song_id"].to_numpy()
+    assert len(b3) and (hash_partitions(b3, 8) == 3).all()
+    monkeypatch.setattr(HashPartitionJoin, "_partition_to_disk", lambda *a, **k: pytest.fail("partitioned"))
+    hpj = HashPartitionJoin(4, num_workers=2, bucketed=True)
+    out = hpj.join(s, l, "song_id", "song_id", temp_dir=str(tmp_path / "w"))
+    assert hpj.stats["bucketed"] == 8
+    got = pd.read_parquet(out.path).sort_values("listen_id").reset_index(drop=True)
+    exp = songs.merge(listens, on="song_id").sort_values("listen_id").reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+    # Appending changes the file fingerprint: the bucket spec no longer applies
+    l.append_data(listens.head(1))
+    assert l.bucket_spec is None and co_bucketed(s, l, "song_id", "song_id") is None
+
+@pytest.mark.parametrize("fmt", ["arrow", "arrow-lz4"])
+def test_arrow_spill_format_matches_parquet(tmp_path, fmt):
+    d = tmp_path / "fmt"; d.mkdir()
+    np.random.seed(5)
+    listens = generate_listens(6000, num_users=50, num_songs=300, string_length=4, zipf_s=1.3)
+    listens = listens[["listen_id", "song_id", "user_id"]]
+    songs = pd.DataFrame({"song_id": np.arange(300), "title": [f"S{i}" for i in range(300)]})
+    _write_parquet(songs, d / "Songs.parquet")
+    _write_parquet(listens, d / "Listens.parquet")
+    s, l = ColumnarDbFile("Songs", file_dir=str(d)), ColumnarDbFile("Listens", file_dir=str(d))
+    exp = songs.merge(listens, on="song_id").sort_values(["listen_id"]).reset_index(drop=True)
+    ops = [HashPartitionJoin(4, batch_rows=500, skew_threshold=0.05, spill_format=fmt),
+           HashPartitionJoin(4, batch_rows=500, memory_budget_mb=0.01, hybrid=True, spill_format=fmt),
+           SortMergeJoin(run_rows=700, merge_batch_rows=300, join_filter=True, spill_format=fmt)]
+    for op in ops:
+        out = op.join(s, l, "song_id", "song_id", temp_dir=str(tmp_path / "w"))
+        assert out.path.endswith(".arrow") and out.num_rows == len(exp)
+        got = ColumnarDbFile.from_path(out.path).retrieve_data().sort_values(["listen_id"]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+def test_background_io_matches_inline(tiny_data, tmp_path):
+    io, together = IOStats(2), threading.Barrier(4)
+    def stall():
+        io.add("read_stall_s", 1.5)
+        together.wait()  # all alive at once, so thread ids are distinct
+    workers = [threading.Thread(target=stall) for _ in range(4)]
+    for t in workers: t.start()
+    for t in workers: t.join()
+    io.add("read_stall_s", 0.5)
+    assert io.as_dict()["read_stall_s"] == 6.5 and io.as_dict()["max_read_stall_s"] == 1.5  # summed vs per thread
+
+    def failing():
+        yield 1
+        raise OSError("disk gone")
+    it = read_ahead(failing(), depth=2)
+    assert next(it) == 1
+    with pytest.raises(OSError):
+        next(it)
+    assert list(read_ahead(iter(range(50)), depth=3)) == list(range(50))
+
+    s, l = ColumnarDbFile("Songs", file_dir=tiny_data), ColumnarDbFile("Listens", file_dir=tiny_data)
+    for op in (HashPartitionJoin(3, batch_rows=2, io_depth=2), SortMergeJoin(run_rows=2, merge_batch_rows=2, io_depth=2)):
+        out = op.join(s, l, "song_id", "song_id", temp_dir=str(tmp_path))
+        got = pd.read_parquet(out.path).sort_values(["listen_id"]).reset_index(drop=True)
+        exp = s.retrieve_data().merge(l.retrieve_data(), on="song_id").sort_values(["listen_id"]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+        assert op.stats["io"]["depth"] == 2 and op.stats["io"]["read_stall_s"] >= 0
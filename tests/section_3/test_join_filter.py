@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nanoquery.bloom import BloomFilter, build_join_filter
+from nanoquery.storage import ColumnarDbFile
+from nanoquery.hash_join import HashPartitionJoin
+from nanoquery.sort_merge_join import SortMergeJoin
+
+def _write_parquet(df, path):
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+
+def test_bloom_no_false_negatives():
+    keys = np.array([f"k{i}" for i in range(0, 5000, 2)], dtype=object)
+    f = BloomFilter(len(keys), fp_rate=0.01)
+    f.add(keys)
+    assert f.contains(keys).all()
+    others = np.array([f"k{i}" for i in range(1, 5000, 2)], dtype=object)
+    assert f.contains(others).mean() < 0.05
+
+def test_dense_int_keys_use_exact_bitmap():
+    f = build_join_filter(np.arange(100, 200))
+    assert f.kind == "bitmap"
+    assert f.contains(np.array([99, 100, 150, 199, 200])).tolist() == [False, True, True, True, False]
+
+@pytest.mark.parametrize("algo", ["HPJ", "SMJ"])
+def test_join_filter_drops_probe_rows_and_keeps_results(tmp_path, algo):
+    d = tmp_path / "jf"; d.mkdir()
+    rng = np.random.default_rng(5)
+    small = pd.DataFrame({"k": np.arange(0, 200, 4), "sv": np.arange(50)})
+    big = pd.DataFrame({"k": rng.integers(0, 1000, 4000), "bv": np.arange(4000)})
+    _write_parquet(small, d / "Small.parquet")
+    _write_parquet(big, d / "Big.parquet")
+    op = HashPartitionJoin(4, join_filter=True) if algo == "HPJ" else SortMergeJoin(join_filter=True)
+    out = op.join(ColumnarDbFile("Big", file_dir=str(d)), ColumnarDbFile("Small", file_dir=str(d)),
+                  "k", "k", temp_dir=str(tmp_path / "w"))
+    stats = op.stats["join_filter"]
+    assert stats["probe_rows_in"] == 4000 and stats["probe_rows_out"] < 400
+    got = pd.read_parquet(out.path).sort_values("bv").reset_index(drop=True)
+    exp = big.merge(small, on="k").sort_values("bv").reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
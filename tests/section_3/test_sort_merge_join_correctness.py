@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
@@ -61,3 +62,68 @@ def test_smj_matches_pandas_already_sorted(tmp_path):
     )
 
 
+
+def test_smj_key_groups_span_batches(tmp_path):
+    d = tmp_path / "span"; d.mkdir()
+    rng = np.random.default_rng(0)
+    left = pd.DataFrame({"k": rng.integers(0, 6, 40), "lv": np.arange(40)})
+    right = pd.DataFrame({"k": rng.integers(0, 8, 50), "rv": np.arange(50)})
+    _write_parquet(left, d / "Left.parquet")
+    _write_parquet(right, d / "Right.parquet")
+    # tiny runs/batches force many runs and equal-key groups crossing batch boundaries
+    out = SortMergeJoin(run_rows=7, merge_batch_rows=3).join(
+        ColumnarDbFile("Left", file_dir=str(d)), ColumnarDbFile("Right", file_dir=str(d)),
+        "k", "k", temp_dir=str(tmp_path))
+    got = pd.read_parquet(out.path).sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    exp = left.merge(right, on="k").sort_values(["k", "lv", "rv"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got[list(exp.columns)], exp)
+
+def test_external_sort_batch_merge_sorted(tmp_path):
+    d = tmp_path / "sort"; d.mkdir()
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({"k": rng.integers(0, 20, 101), "v": np.arange(101)})
+    _write_parquet(df, d / "T.parquet")
+    smj = SortMergeJoin(run_rows=9, merge_batch_rows=4)
+    out = smj._external_sort(ColumnarDbFile("T", file_dir=str(d)), "k", str(tmp_path / "w"), "T")
+    got = pd.read_parquet(out)
+    assert got["k"].is_monotonic_increasing
+    assert sorted(got["v"]) == list(range(101))
+
+def test_smj_parallel_run_generation(tiny_data, tmp_path):
+    songs = ColumnarDbFile("Songs", file_dir=tiny_data)
+    listens = ColumnarDbFile("Listens", file_dir=tiny_data)
+    out = SortMergeJoin(run_rows=2, merge_batch_rows=2, num_workers=3).join(
+        songs, listens, "song_id", "song_id", temp_dir=str(tmp_path))
+    got = pd.read_parquet(out.path)
+    exp = pd.read_parquet(os.path.join(tiny_data, "Songs.parquet")).merge(
+        pd.read_parquet(os.path.join(tiny_data, "Listens.parquet")), on="song_id")
+    cols = list(exp.columns)
+    assert got[cols].sort_values(cols).reset_index(drop=True).equals(exp.sort_values(cols).reset_index(drop=True))
+
+def test_smj_skips_sort_for_presorted_inputs(tmp_path):
+    rng = np.random.default_rng(20)
+    songs = pd.DataFrame({"song_id": rng.permutation(300), "title": [f"T{i}" for i in range(300)]})
+    listens = pd.DataFrame({"listen_id": np.arange(2_000), "song_id": rng.integers(0, 300, 2_000),
+                            "user_id": rng.integers(0, 50, 2_000)})
+    s = ColumnarDbFile("Songs", file_dir=str(tmp_path / "in"))
+    l = ColumnarDbFile("Listens", file_dir=str(tmp_path / "in"))
+    s.build_table(songs, sort_by=["song_id"], row_group_size=64)
+    l.build_table(listens, sort_by=["song_id"], row_group_size=256)
+    assert s.sort_order == ["song_id"]
+    smj = SortMergeJoin(merge_batch_rows=100, join_filter=True)
+    out = smj.join(s, l, "song_id", "song_id", temp_dir=str(tmp_path / "t"), cols_right=["song_id", "user_id"])
+    assert smj.stats["presorted"] == ["left", "right"] and out.sort_order == ["song_id"]
+    got = pd.read_parquet(out.path)
+    assert got["song_id"].is_monotonic_increasing and list(got.columns) == ["song_id", "title", "user_id"]
+    exp = songs.merge(listens[["song_id", "user_id"]], on="song_id")
+    key = ["song_id", "user_id"]
+    pd.testing.assert_frame_equal(got.sort_values(key, kind="mergesort").reset_index(drop=True),
+                                  exp.sort_values(key, kind="mergesort").reset_index(drop=True))
+    # pre-sorted sides are still read at their narrowed types
+    narrow_out = SortMergeJoin().join(s.narrowed({"song_id": pa.int16()}), l.narrowed({"user_id": pa.int8()}),
+                                      "song_id", "song_id", temp_dir=str(tmp_path / "t"),
+                                      cols_right=["song_id", "user_id"])
+    assert narrow_out.schema.field("song_id").type == pa.int16() and narrow_out.schema.field("user_id").type == pa.int8()
+    # Rewriting the file invalidates the recorded order
+    _write_parquet(listens, l.path)
+    assert l.sort_order is None
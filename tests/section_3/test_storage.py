@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from nanoquery.catalog import StatsCatalog
+from nanoquery.storage import ColumnarDbFile, fragment_paths, table_fingerprint
+from nanoquery.utils import file_fingerprint, parquet_metadata
+
+def test_appends_add_fragments_and_compaction_merges_them(tmp_path):
+    d = tmp_path / "frag"; d.mkdir()
+    listens = pd.DataFrame({"listen_id": np.arange(1_500), "song_id": np.arange(1_500) % 7,
+                            "user_id": np.arange(1_500) % 11})
+    cdf = ColumnarDbFile("Listens", file_dir=str(d))
+    cdf.build_table(listens.head(1_000), sort_by=["listen_id"])
+    base = file_fingerprint(cdf.path)
+    StatsCatalog(str(d)).analyze(cdf.path)
+    for off in range(1_000, 1_500, 100):
+        cdf.append_data(listens.iloc[off:off + 100])
+    # appends never touch the table file; every read sees all fragments in order
+    assert file_fingerprint(cdf.path) == base and len(cdf.fragments) == 6
+    assert cdf.num_rows == 1_500 and cdf.sort_order is None
+    pd.testing.assert_frame_equal(cdf.read().to_pandas(), listens)
+    rows = np.array([1_499, 3, 1_050, 999, 1_200])
+    assert cdf.take(rows, ["listen_id"]).column("listen_id").to_pylist() == rows.tolist()
+    assert StatsCatalog(str(d)).get(cdf.path) is None
+    # footer metadata and ANALYZE cover the fragments too
+    assert parquet_metadata(fragment_paths(cdf.path))["rows"] == 1_500
+    assert StatsCatalog(str(d)).analyze(cdf.path)["rows"] == 1_500
+
+    # 100-row fragments merge into runs of >= 300 rows, written as full 100-row row groups
+    assert cdf.compact(target_rows=300, row_group_size=100) == 5
+    frags = cdf.fragments
+    assert len(frags) == 3 and [pq.ParquetFile(p).metadata.num_rows for p in frags] == [1_000, 300, 200]
+    assert [pq.ParquetFile(frags[1]).metadata.row_group(i).num_rows for i in range(3)] == [100, 100, 100]
+    pd.testing.assert_frame_equal(cdf.retrieve_data(), listens)
+    # merged-away files outlive one compaction (scans that listed them can finish), then go
+    assert len(os.listdir(d / "Listens.fragments")) == 7
+    fp = table_fingerprint(cdf.path)
+    assert cdf.compact(target_rows=300, background=True).join() is None
+    assert len(os.listdir(d / "Listens.fragments")) == 2
+    assert table_fingerprint(cdf.path) == fp  # nothing merged: cached plans and stats stay valid
+    cdf.build_table(listens.head(10))
+    assert cdf.fragments == [cdf.path] and not os.path.exists(d / "Listens.fragments")
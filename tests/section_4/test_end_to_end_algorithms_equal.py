@@ -18,8 +18,11 @@ class ForcedPlanner(QueryPlanner):
         self.force_algo2 = force_algo2
     def plan(self, parquet_paths: dict, parsed_query: dict, avail_mem_mb: float = 10_000):
         plan = super().plan(parquet_paths, parsed_query, avail_mem_mb)
-        plan["steps"][0]["algo"] = self.force_algo1
-        plan["steps"][1]["algo"] = self.force_algo2
+        for step, algo in zip(plan["steps"], (self.force_algo1, self.force_algo2)):
+            step["algo"] = algo
+            if algo == "HPJ":
+                # One partition would run the in-memory pipelined HashJoin, not the grace hash join
+                step["partitions"] = max(step.get("partitions", 1), 2)
         return plan
 
 @pytest.mark.parametrize("algo", ["HPJ","SMJ"])
@@ -31,6 +34,7 @@ def test_end_to_end_forced(tmp_data_dir, tmp_path, algo):
     df, plan = execu.execute(SQL)
     assert list(df.columns) == ["song_id", "avg_age", "count_distinct_users"]
     assert df["count_distinct_users"].is_monotonic_decreasing
+    assert [s["runtime"]["mode"] for s in plan["steps"]] == ["materialized", "materialized"]
 
 def test_end_to_end_hpjsmj_identical(tmp_data_dir, tmp_path):
     paths = {"Songs": f"{tmp_data_dir}/Songs.parquet",
@@ -42,4 +46,27 @@ def test_end_to_end_hpjsmj_identical(tmp_data_dir, tmp_path):
     dfs, _ = exec_sm.execute(SQL)
     pd.testing.assert_frame_equal(dfh.reset_index(drop=True), dfs.reset_index(drop=True))
 
+def test_end_to_end_approx_count_distinct(tmp_data_dir, tmp_path):
+    paths = {"Songs": f"{tmp_data_dir}/Songs.parquet",
+             "Listens": f"{tmp_data_dir}/Listens.parquet",
+             "Users": f"{tmp_data_dir}/Users.parquet"}
+    exact, _ = QueryExecutor(paths, working_dir=str(tmp_path)).execute(SQL)
+    approx_sql = SQL.replace("COUNT(DISTINCT l.user_id)", "APPROX_COUNT_DISTINCT(l.user_id)")
+    approx, plan = QueryExecutor(paths, working_dir=str(tmp_path), hll_precision=12).execute(approx_sql)
+    assert plan["aggregation"]["count_distinct"] == "hll"
+    m = exact.merge(approx, on="song_id", suffixes=("", "_hll"))
+    assert len(m) == len(exact)
+    pd.testing.assert_series_equal(m["avg_age"], m["avg_age_hll"], check_names=False)
+    assert ((m["count_distinct_users"] - m["count_distinct_users_hll"]).abs()
+            <= 0.07 * m["count_distinct_users"] + 1).all()
 
+@pytest.mark.parametrize("algo", ["HPJ","SMJ"])
+def test_end_to_end_late_materialized_title(tmp_data_dir, tmp_path, algo):
+    paths = {"Songs": f"{tmp_data_dir}/Songs.parquet",
+             "Listens": f"{tmp_data_dir}/Listens.parquet",
+             "Users": f"{tmp_data_dir}/Users.parquet"}
+    exact, _ = QueryExecutor(paths, working_dir=str(tmp_path), planner=ForcedPlanner(algo, algo)).execute(SQL)
+    late, plan = QueryExecutor(paths, working_dir=str(tmp_path), planner=ForcedPlanner(algo, algo),
+                               late_materialize=True).execute(SQL)
+    assert plan["late_materialize"] == {"columns": {"Songs": ["title"]}, "applied": True}
+    pd.testing.assert_frame_equal(late, exact)
@@ -0,0 +1,120 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from nanoquery.storage import ColumnarDbFile
+from nanoquery.hash_join import HashPartitionJoin
+from nanoquery.sort_merge_join import SortMergeJoin
+from nanoquery.pipeline import AdaptiveJoin, Scan, HashJoin, MaterializedJoin
+from nanoquery.aggregation import aggregate_batches, aggregate_final
+
+def _scans(d):
+    return (Scan(ColumnarDbFile("Songs", file_dir=d), ["song_id", "title"], batch_rows=2),
+            Scan(ColumnarDbFile("Listens", file_dir=d), ["song_id", "user_id"], batch_rows=2),
+            Scan(ColumnarDbFile("Users", file_dir=d), ["user_id", "age"], batch_rows=2))
+
+def _expected(d, tmp_path):
+    s = pd.read_parquet(os.path.join(d, "Songs.parquet"))
+    l = pd.read_parquet(os.path.join(d, "Listens.parquet"))[["song_id", "user_id"]]
+    u = pd.read_parquet(os.path.join(d, "Users.parquet"))
+    path = tmp_path / "joined.parquet"
+    pq.write_table(pa.Table.from_pandas(s.merge(l, on="song_id").merge(u, on="user_id"), preserve_index=False), path)
+    return aggregate_final(str(path)).reset_index(drop=True)
+
+def test_pipelined_hash_joins_stream_into_aggregate(tmp_data_dir, tmp_path):
+    songs, listens, users = _scans(tmp_data_dir)
+    step1 = HashJoin(songs, listens, "song_id", "song_id", build="left")
+    step2 = HashJoin(step1, users, "user_id", "user_id", build="right", num_workers=2)
+    got = aggregate_batches(step2.batches()).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, _expected(tmp_data_dir, tmp_path))
+    assert step1.stats["mode"] == "pipelined" and step1.stats["probe_rows"] == 5
+    # nothing but the caller's own expected-result file was written
+    assert os.listdir(tmp_path) == ["joined.parquet"]
+
+@pytest.mark.parametrize("op", [HashPartitionJoin(2), SortMergeJoin()])
+def test_materialized_join_between_pipelined_operators(tmp_data_dir, tmp_path, op):
+    songs, listens, users = _scans(tmp_data_dir)
+    step1 = HashJoin(songs, listens, "song_id", "song_id", build="left")
+    step2 = MaterializedJoin(op, step1, users, "user_id", "user_id", temp_dir=str(tmp_path / "w"))
+    got = aggregate_batches(step2.batches()).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, _expected(tmp_data_dir, tmp_path))
+    assert step2.stats["mode"] == "materialized"
+    # the streamed left input was written to a pipe_ file, removed once the join had read it
+    assert not [f for f in os.listdir(tmp_path / "w") if f.startswith("pipe_")]
+
+def test_adaptive_join_spills_over_budget_and_cleans_up(tmp_data_dir, tmp_path):
+    songs, listens, users = _scans(tmp_data_dir)
+    step1 = HashJoin(songs, listens, "song_id", "song_id", build="left")
+    seen = []
+    def decide(observed, source):
+        seen.append(observed)
+        return HashJoin(source, users, "user_id", "user_id", build="right")
+    step2 = AdaptiveJoin(step1, "user_id", decide, temp_dir=str(tmp_path / "w"), buffer_mb=0)
+    os.makedirs(tmp_path / "w")
+    got = aggregate_batches(step2.batches()).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, _expected(tmp_data_dir, tmp_path))
+    assert seen[0]["source"] == "file"
+    assert os.listdir(tmp_path / "w") == []  # the spilled left input is gone once the join is done
+
+def test_preaggregated_listens_match_aggregate_final(tmp_path):
+    import numpy as np
+    from nanoquery.executor import QueryExecutor
+    from nanoquery.parser import parse_sql_hardcoded
+    rng = np.random.default_rng(9)
+    d = tmp_path / "data"; d.mkdir()
+    songs = pd.DataFrame({"song_id": np.arange(50), "title": [f"T{i}" for i in range(50)]})
+    users = pd.DataFrame({"user_id": np.arange(200), "age": rng.integers(18, 80, 200)})
+    listens = pd.DataFrame({"listen_id": np.arange(5_000), "song_id": rng.integers(0, 50, 5_000),
+                            "user_id": rng.integers(0, 200, 5_000)})
+    paths = {}
+    for name, df in (("Songs", songs), ("Users", users), ("Listens", listens)):
+        paths[name] = str(d / f"{name}.parquet")
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), paths[name])
+    got, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    assert plan["preaggregate"]["applied"]
+    assert plan["preaggregate"]["runtime"]["rows_out"] < plan["preaggregate"]["runtime"]["rows_in"] == 5_000
+    path = tmp_path / "joined.parquet"
+    joined = songs.merge(listens[["song_id", "user_id"]], on="song_id").merge(users, on="user_id")
+    pq.write_table(pa.Table.from_pandas(joined, preserve_index=False), path)
+    pd.testing.assert_frame_equal(got, aggregate_final(str(path)))
+
+@pytest.mark.parametrize("algos", [("HPJ", "SMJ"), ("SMJ", "HPJ")])
+def test_narrowed_scans_stay_narrow_through_spilling_joins(tmp_path, algos):
+    import numpy as np
+    from nanoquery.executor import QueryExecutor
+    from nanoquery.planner import QueryPlanner
+    rng = np.random.default_rng(5)
+    d = tmp_path / "data"; d.mkdir()
+    songs = pd.DataFrame({"song_id": np.arange(60), "title": [f"T{i % 6}" for i in range(60)]})
+    users = pd.DataFrame({"user_id": np.arange(1_000), "age": rng.integers(18, 80, 1_000)})
+    listens = pd.DataFrame({"listen_id": np.arange(6_000), "song_id": rng.integers(0, 60, 6_000),
+                            "user_id": rng.integers(0, 1_000, 6_000)})
+    paths = {}
+    for name, df in (("Songs", songs), ("Users", users), ("Listens", listens)):
+        paths[name] = str(d / f"{name}.parquet")
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), paths[name], row_group_size=700)
+
+    class Spilling(QueryPlanner):
+        def plan(self, parquet_paths, parsed_query, avail_mem_mb=None):
+            p = super().plan(parquet_paths, parsed_query, avail_mem_mb)
+            for step, algo in zip(p["steps"], algos):
+                step.update(algo=algo, partitions=3)
+            p["preaggregate"]["applied"] = False
+            return p
+    got, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w"), planner=Spilling(), adaptive=False).execute("x")
+    exp, _ = QueryExecutor(paths, working_dir=str(tmp_path / "w"), planner=Spilling(narrow_types=False),
+                           adaptive=False).execute("x")
+    pd.testing.assert_frame_equal(got, exp)
+    assert plan["narrowing"]["Songs"] == {"song_id": pa.int8(), "title": pa.dictionary(pa.int32(), pa.large_string())}
+    assert plan["narrowing"]["Users"] == {"user_id": pa.int16(), "age": pa.int8()}
+    # the low-cardinality title reads straight from its Parquet dictionary pages and survives an Arrow spill
+    songs_cdf = ColumnarDbFile.from_path(paths["Songs"]).narrowed(plan["narrowing"]["Songs"])
+    spill = ColumnarDbFile("spill", file_dir=str(tmp_path / "s"), file_format="arrow")
+    w = spill.writer(songs_cdf.schema)
+    for b in songs_cdf.iter_batches(["song_id", "title"], batch_rows=7):
+        w.write_table(pa.Table.from_batches([b]))
+    w.close()
+    back = spill.read()
+    assert back.schema == songs_cdf.schema and back.column("title").to_pylist() == songs["title"].tolist()
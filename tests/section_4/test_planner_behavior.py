@@ -2,7 +2,7 @@ import os
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-from nanoquery.planner import QueryPlanner, choose_algo
+from nanoquery.planner import QueryPlanner, choose_algo, detect_memory_budget_mb
 from nanoquery.parser import parse_sql_hardcoded
 from nanoquery.executor import QueryExecutor
 import pytest
@@ -33,20 +33,23 @@ def test_column_pruning_executor(tmp_path, monkeypatch):
              "Listens": str(d / "Listens.parquet"),
              "Users": str(d / "Users.parquet")}
     calls = []
-    import pandas as _pd
-    real_read = _pd.read_parquet
-    def spy_read(path, columns=None, **kw):
-        calls.append((os.path.basename(str(path)), tuple(columns) if columns else None))
-        return real_read(path, columns=columns, **kw)
-    monkeypatch.setattr(_pd, "read_parquet", spy_read)
+    from nanoquery.storage import ColumnarDbFile
+    real_iter = ColumnarDbFile.iter_batches
+    def spy_iter(self, columns=None, *a, **kw):
+        calls.append((os.path.basename(str(self.path)), tuple(columns) if columns else None))
+        return real_iter(self, columns, *a, **kw)
+    monkeypatch.setattr(ColumnarDbFile, "iter_batches", spy_iter)
     from nanoquery.executor import QueryExecutor
-    ex = QueryExecutor(paths, working_dir=str(tmp_path))
+    work = tmp_path / "work"
+    ex = QueryExecutor(paths, working_dir=str(work))
     SQL = "SELECT s.song_id, AVG(u.age) AS avg_age, COUNT(DISTINCT l.user_id) FROM Songs s JOIN Listens l ON s.song_id = l.song_id JOIN Users u ON l.user_id = u.user_id GROUP BY s.song_id, s.title ORDER BY COUNT(DISTINCT l.user_id) DESC, s.song_id;"
     ex.execute(SQL)
-    # Ensure pruning happened
+    # Ensure pruning happened, directly on the source files
     assert ("Songs.parquet", ("song_id","title")) in calls
     assert ("Users.parquet", ("user_id","age")) in calls
     assert ("Listens.parquet", ("song_id","user_id")) in calls
+    # ...and no staged copies of the inputs were written
+    assert not [f for f in os.listdir(work) if f.endswith("_loaded.parquet")]
 
 def test_choose_algo_thresholds():
     # size * overhead < avail_mem_mb -> HPJ, else SMJ
@@ -66,4 +69,201 @@ def test_join_order_enforced(tmp_path):
     assert plan["steps"][0]["left"] == "Songs" and plan["steps"][0]["right"] == "Listens"
     assert plan["steps"][1]["right"] == "Users"
 
+def test_preaggregation_rewrite_detection():
+    from nanoquery.planner import preaggregation, expected_distinct_pairs
+    parsed = parse_sql_hardcoded("ignored")
+    assert preaggregation(parsed) == {"table": "Listens", "keys": ["song_id", "user_id"], "count_col": "listen_count"}
+    parsed["aggregations"]["count_distinct_users"]["expr"] = "l.listen_id"
+    assert preaggregation(parsed) is None
+    parsed = parse_sql_hardcoded("ignored")
+    parsed["group_by"].append("u.age")
+    assert preaggregation(parsed) is None
+    # only worth it when (song, user) pairs repeat
+    assert expected_distinct_pairs(1_000_000, 10_000, 50_000) > 0.99 * 1_000_000
+    assert expected_distinct_pairs(5_000, 50, 200) < 0.9 * 5_000
 
+def test_approx_count_distinct_needs_the_function_call():
+    func = lambda sql: parse_sql_hardcoded(sql)["aggregations"]["count_distinct_users"]["func"]
+    assert func("SELECT approx_count_distinct (l.user_id) FROM Listens l") == "APPROX_COUNT_DISTINCT"
+    assert func("SELECT COUNT(DISTINCT l.user_id) AS approx_count_distinct FROM Listens l") == "COUNT_DISTINCT"
+    assert func("SELECT COUNT(DISTINCT l.user_id) FROM Listens l -- not APPROX_COUNT_DISTINCT(l.user_id)") == "COUNT_DISTINCT"
+    assert func("SELECT COUNT(DISTINCT l.user_id), 'APPROX_COUNT_DISTINCT(x)' FROM Listens l") == "COUNT_DISTINCT"
+    assert func("SELECT /* APPROX_COUNT_DISTINCT( */ COUNT(DISTINCT l.user_id) FROM Listens l") == "COUNT_DISTINCT"
+
+
+
+def test_choose_partitions_from_budget():
+    from nanoquery.planner import choose_partitions
+    assert choose_partitions(100, avail_mem_mb=2000, overhead=5.0) == 1
+    assert choose_partitions(1000, avail_mem_mb=400, overhead=2.0) == 5
+
+def test_cost_based_join_order_and_estimates(tmp_path):
+    import numpy as np
+    d = tmp_path / "cbo"; d.mkdir()
+    rng = np.random.default_rng(11)
+    # Wide titles make carrying Songs through the big join expensive: Listens ⨝ Users should go first
+    _write_parquet(pd.DataFrame({"song_id": np.arange(100), "title": [f"{i:0>300}" for i in range(100)]}),
+                   d / "Songs.parquet")
+    _write_parquet(pd.DataFrame({"user_id": np.arange(500), "age": rng.integers(18, 80, 500)}), d / "Users.parquet")
+    _write_parquet(pd.DataFrame({"listen_id": np.arange(4_000), "song_id": rng.integers(0, 100, 4_000),
+                                 "user_id": rng.integers(0, 500, 4_000)}), d / "Listens.parquet")
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    plan = QueryPlanner().plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=10_000)
+    assert plan["join_order"] == ["Listens", "Users", "Songs"]
+    assert plan["steps"][0]["right"] == "Users" and plan["steps"][1]["right"] == "Songs"
+    assert plan["steps"][0]["est_rows"] == 4_000 and plan["steps"][1]["est_rows"] == 4_000  # key NDVs from min/max
+    # narrowed to int8/int16 keys and ages, the 4_000 joined rows (16KB) undercut the 100 wide titles (30KB)
+    assert plan["steps"][0]["build"] == "right" and plan["steps"][1]["build"] == "left"
+    # the reordered plan runs and gives the written order's answer
+    class Written(QueryPlanner):
+        def plan(self, parquet_paths, parsed_query, avail_mem_mb=None):
+            p = super().plan(parquet_paths, parsed_query, avail_mem_mb)
+            assert p["join_order_candidates"][0]["order"] == ["Songs", "Listens", "Users"]
+            return dict(p, steps=[
+                {"left": "Songs", "right": "Listens", "left_key": "song_id", "right_key": "song_id", "algo": "HPJ",
+                 "partitions": 1, "build": "left"},
+                {"left": "__prev__", "right": "Users", "left_key": "user_id", "right_key": "user_id", "algo": "HPJ",
+                 "partitions": 1, "build": "right"}])
+    got, _ = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    exp, _ = QueryExecutor(paths, working_dir=str(tmp_path / "w"), planner=Written()).execute("ignored")
+    pd.testing.assert_frame_equal(got, exp)
+
+def test_memory_budget_detected_from_machine(tmp_path):
+    import psutil
+    d = tmp_path / "mem"; d.mkdir()
+    _write_parquet(pd.DataFrame({"song_id":[1], "title":["A"]}), d / "Songs.parquet")
+    _write_parquet(pd.DataFrame({"user_id":[1], "age":[20]}), d / "Users.parquet")
+    _write_parquet(pd.DataFrame({"listen_id":[1], "song_id":[1], "user_id":[1]}), d / "Listens.parquet")
+    plan = QueryPlanner().plan({t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")},
+                               parse_sql_hardcoded("ignored"))
+    total_mb = psutil.virtual_memory().total / (1024*1024)
+    assert 0 < plan["memory_budget_mb"] < total_mb
+    # Half of the memory available right now (which drifts a little between the two reads)
+    assert plan["memory_budget_mb"] == pytest.approx(detect_memory_budget_mb(), rel=0.1)
+
+def test_adaptive_replan_from_observed_step_output(tmp_path):
+    import numpy as np
+    d = tmp_path / "adapt"; d.mkdir()
+    rng = np.random.default_rng(12)
+    # 20 Songs rows per song_id on a sparse id range: min/max NDV bounds overestimate NDV, so the
+    # step-1 estimate is 200 rows while it really produces 40,000
+    ids = np.repeat(np.arange(10) * 1000, 20)
+    _write_parquet(pd.DataFrame({"song_id": ids, "title": [f"T{i}" for i in ids]}), d / "Songs.parquet")
+    _write_parquet(pd.DataFrame({"user_id": np.arange(10_000), "age": rng.integers(18, 80, 10_000)}),
+                   d / "Users.parquet")
+    _write_parquet(pd.DataFrame({"listen_id": np.arange(2_000), "song_id": rng.choice(np.arange(10) * 1000, 2_000),
+                                 "user_id": rng.integers(0, 10_000, 2_000)}), d / "Listens.parquet")
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    got, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    (decision,) = plan["adaptive"]
+    assert decision["step"] == 1 and decision["est_rows"] == 200 and decision["observed"]["rows"] == 40_000
+    assert decision["changes"]["build"] == ["left", "right"]  # observed output is larger than Users: build on Users
+    assert plan["steps"][1]["build"] == "right" and plan["steps"][1]["runtime"]["build_rows"] == 10_000
+    exp, static = QueryExecutor(paths, working_dir=str(tmp_path / "w"), adaptive=False).execute("ignored")
+    assert static["adaptive"] == []
+    pd.testing.assert_frame_equal(got, exp)
+
+def test_replan_switches_algorithm_but_respects_forced_settings(tmp_path):
+    d = tmp_path / "rp"; d.mkdir()
+    _write_parquet(pd.DataFrame({"song_id":[1], "title":["A"]}), d / "Songs.parquet")
+    _write_parquet(pd.DataFrame({"user_id":[1], "age":[20]}), d / "Users.parquet")
+    _write_parquet(pd.DataFrame({"listen_id":[1], "song_id":[1], "user_id":[1]}), d / "Listens.parquet")
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    qp = QueryPlanner()
+    observed = {"rows": 10**9, "mb": 50_000.0, "top_key_share": 0.5}
+    plan = qp.plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=100)
+    plan["table_estimates"]["Users"]["mb"] = 10_000.0
+    step = qp.replan(plan, 1, observed)
+    assert step["algo"] == "SMJ" and step["partitions"] == 500 and step["skew"]
+    assert plan["adaptive"][0]["changes"]["algo"] == ["HPJ", "SMJ"]
+    # an algorithm forced after planning (as the benchmark's ForcedPlanner does) is kept
+    plan = qp.plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=10_000)
+    plan["steps"][1]["algo"] = "SMJ"
+    step = qp.replan(plan, 1, {"rows": 10, "mb": 0.001, "top_key_share": 0.1})
+    assert step["algo"] == "SMJ" and "algo" not in plan["adaptive"][0]["changes"]
+
+def test_stats_catalog_analyze_and_invalidation(tmp_path):
+    import time
+    import numpy as np
+    from nanoquery.catalog import StatsCatalog, CATALOG_FILE
+    from nanoquery.planner import base_relation, join_relation
+    d = tmp_path / "cat"; d.mkdir()
+    rng = np.random.default_rng(13)
+    ids = np.repeat(np.arange(10) * 1000, 20)  # 10 distinct ids spread over a 9001-wide range
+    _write_parquet(pd.DataFrame({"song_id": ids, "title": [f"T{i}" for i in ids]}), d / "Songs.parquet")
+    _write_parquet(pd.DataFrame({"user_id": np.arange(1_000), "age": rng.integers(18, 80, 1_000)}), d / "Users.parquet")
+    _write_parquet(pd.DataFrame({"listen_id": np.arange(2_000), "song_id": rng.choice(np.arange(20) * 1000, 2_000),
+                                 "user_id": rng.integers(0, 1_000, 2_000)}), d / "Listens.parquet")
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    footer = QueryPlanner().plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=10_000)
+    assert footer["metadata"]["Songs"]["stats_source"] == "footer"
+
+    cat = StatsCatalog(str(d))
+    for p in paths.values():
+        cat.analyze(p)
+    assert os.path.exists(d / CATALOG_FILE)
+    songs = StatsCatalog(str(d)).get(paths["Songs"])["columns"]
+    assert songs["song_id"]["ndv"] == 10 and songs["song_id"]["min"] == 0 and songs["song_id"]["max"] == 9000
+    assert len(songs["song_id"]["histogram"]) == 33 and songs["title"]["histogram"] is None
+    assert songs["title"]["avg_width"] > 0
+
+    plan = QueryPlanner().plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=10_000)
+    assert all(m["stats_source"] == "catalog" for m in plan["metadata"].values())
+    # Songs ⨝ Listens: only the ~half of listens inside Songs' key range match, 20 Songs rows each
+    actual = pd.read_parquet(paths["Songs"]).merge(pd.read_parquet(paths["Listens"]), on="song_id").shape[0]
+    def est(p):
+        rel = {t: base_relation(t, p["metadata"][t], p["columns"][t]) for t in ("Songs", "Listens")}
+        return join_relation(rel["Songs"], rel["Listens"], "song_id", "song_id")["rows"]
+    assert abs(est(plan) - actual) < 0.25 * actual
+    assert abs(est(footer) - actual) > 0.5 * actual
+
+    # Rewriting a file changes its size/mtime fingerprint: the stale entry is ignored
+    time.sleep(0.01)
+    _write_parquet(pd.DataFrame({"song_id": [1, 2], "title": ["A", "B"]}), d / "Songs.parquet")
+    assert StatsCatalog(str(d)).get(paths["Songs"]) is None
+    plan = QueryPlanner().plan(paths, parse_sql_hardcoded("ignored"), avail_mem_mb=10_000)
+    assert plan["metadata"]["Songs"]["stats_source"] == "footer" and plan["metadata"]["Songs"]["rows"] == 2
+
+def test_planner_runs_bucket_wise_join_for_co_bucketed_tables(tmp_path):
+    import numpy as np
+    from nanoquery.storage import ColumnarDbFile
+    rng = np.random.default_rng(15)
+    d = tmp_path / "bkt"; d.mkdir()
+    songs = pd.DataFrame({"song_id": np.arange(200), "title": [f"T{i}" for i in range(200)]})
+    listens = pd.DataFrame({"listen_id": np.arange(3_000), "song_id": rng.integers(0, 200, 3_000),
+                            "user_id": rng.integers(0, 300, 3_000)})
+    ColumnarDbFile("Songs", file_dir=str(d)).build_bucketed_table(songs, "song_id", 4)
+    ColumnarDbFile("Listens", file_dir=str(d)).build_bucketed_table(listens, "song_id", 4)
+    _write_parquet(pd.DataFrame({"user_id": np.arange(300), "age": rng.integers(18, 80, 300)}), d / "Users.parquet")
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    got, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    step = next(s for s in plan["steps"] if {s["left"], s["right"]} == {"Songs", "Listens"})
+    assert step["bucketed"] == 4 and step["runtime"]["bucketed"] == 4
+    for t in ("Songs", "Listens"):
+        _write_parquet(pd.read_parquet(paths[t]), paths[t])  # plain rewrite: spec goes stale
+    exp, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    assert not any(s.get("bucketed") for s in plan["steps"])
+    pd.testing.assert_frame_equal(got, exp)
+
+def test_sorted_inputs_give_sort_based_aggregation(tmp_path):
+    import numpy as np
+    from nanoquery.storage import ColumnarDbFile
+    rng = np.random.default_rng(22)
+    d = tmp_path / "srt"; d.mkdir()
+    songs = pd.DataFrame({"song_id": np.arange(100), "title": [f"{i:0>100}" for i in range(100)]})
+    listens = pd.DataFrame({"listen_id": np.arange(4_000), "song_id": rng.integers(0, 100, 4_000),
+                            "user_id": rng.integers(0, 500, 4_000)})
+    users = pd.DataFrame({"user_id": np.arange(500), "age": rng.integers(18, 80, 500)})
+    ColumnarDbFile("Songs", file_dir=str(d)).build_table(songs)
+    ColumnarDbFile("Listens", file_dir=str(d)).build_table(listens, sort_by=["song_id"], row_group_size=1_000)
+    ColumnarDbFile("Users", file_dir=str(d)).build_table(users)
+    paths = {t: str(d / f"{t}.parquet") for t in ("Songs", "Listens", "Users")}
+    # (Listens ⨝ Users) ⨝ Songs with pipelined hash joins probing Listens keeps its song_id order
+    got, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    assert plan["join_order"] == ["Listens", "Users", "Songs"]
+    assert plan["aggregation"]["strategy"] == plan["aggregation"]["planned_strategy"] == "sort"
+    assert plan["aggregation"]["key"] == "song_id"
+    ColumnarDbFile("Listens", file_dir=str(d)).build_table(listens)
+    exp, plan = QueryExecutor(paths, working_dir=str(tmp_path / "w")).execute("ignored")
+    assert plan["aggregation"]["strategy"] == "hash"
+    pd.testing.assert_frame_equal(got, exp)